@@ -9,6 +9,8 @@ from dapr.clients import DaprClient
 from dapr.ext.grpc import App, InvokeMethodRequest, InvokeMethodResponse
 # prometheus
 import prometheus_client
+# dapr client pool
+import daprpool
 # # util
 # from pathlib import Path
 # util_path = Path(__file__).parent.resolve() / '..' / 'pyutil'
@@ -19,6 +21,7 @@ import prometheus_client
 # global variables
 serviceAddress = int(os.getenv('ADDRESS', '5005'))
 promAddress = int(os.getenv('PROM_ADDRESS', '8084'))
+daprPoolSize = int(os.getenv('DAPR_POOL_SIZE', '10'))
 logging.basicConfig(level=logging.INFO)
 
 # LatBuckets generate a latency histogram buckets for prometheus histogram
@@ -45,6 +48,12 @@ promLat = prometheus_client.Histogram(
 
 MAX_PAYLOAD = 64 * 1024 * 1024 # 64MB
 # MAX_PAYLOAD=-1
+# warm dapr clients shared by all handlers of this process
+daprPool = daprpool.DaprClientPool(
+    name='proxy',
+    max_size=daprPoolSize,
+    max_grpc_message_length=MAX_PAYLOAD,
+)
 grpcOptions = [
     ('grpc.max_send_message_length', MAX_PAYLOAD),
     ('grpc.max_receive_message_length', MAX_PAYLOAD),
@@ -75,7 +84,7 @@ def forward(request: InvokeMethodRequest) -> InvokeMethodResponse:
     # logging.info('invoke service: %s, method: %s, payload: %s' %(
     #     downstream, method, json.dumps(req)
     # ))
-    with DaprClient(max_grpc_message_length=MAX_PAYLOAD) as d:
+    with daprPool.client() as d:
         resp = d.invoke_method(
             downstream,
             method,
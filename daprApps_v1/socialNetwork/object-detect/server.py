@@ -21,11 +21,13 @@ from pathlib import Path
 util_path = Path(__file__).parent.resolve() / '..' / 'pyutil'
 sys.path.append(str(util_path))
 import pyutil
+from pyutil import daprpool
 
 warnings.filterwarnings("ignore")
 # global variables
 serviceAddress = int(os.getenv('ADDRESS', '5005'))
 promAddress = int(os.getenv('PROM_ADDRESS', '8084'))
+daprPoolSize = int(os.getenv('DAPR_POOL_SIZE', '10'))
 pubsubName = os.getenv('PUBSUB_NAME', 'object-detect-pubsub')
 topicName = os.getenv('TOPIC_NAME', 'object-detect')
 imageStore = os.getenv('IMAGE_STORE', 'image-store')
@@ -71,6 +73,12 @@ def newMetaReq(post_id: str, objects: dict):
         'send_unix_ms': int(time.time() * 1000)
     }
 
+# warm dapr clients shared by all handlers of this process
+daprPool = daprpool.DaprClientPool(
+    name='object_detect',
+    max_size=daprPoolSize,
+)
+
 # server 
 app = App()
 # handlers
@@ -95,7 +103,7 @@ def objectDetect(event) -> None:
     if len(data['images']) > 0:
         promReq.inc()
         pil_images = []
-        with DaprClient() as d:
+        with daprPool.client() as d:
             try:
                 logging.info(data['images'])
                 items = d.get_bulk_state(
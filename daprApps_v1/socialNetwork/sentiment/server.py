@@ -16,12 +16,14 @@ from pathlib import Path
 util_path = Path(__file__).parent.resolve() / '..' / 'pyutil'
 sys.path.append(str(util_path))
 import pyutil
+from pyutil import daprpool
 # warnings
 import warnings
 warnings.filterwarnings("ignore")
 # global variables
 serviceAddress = int(os.getenv('ADDRESS', '5005'))
 promAddress = int(os.getenv('PROM_ADDRESS', '8084'))
+daprPoolSize = int(os.getenv('DAPR_POOL_SIZE', '10'))
 pubsubName = os.getenv('PUBSUB_NAME', 'sentiment-pubsub')
 topicName = os.getenv('TOPIC_NAME', 'sentiment')
 logging.basicConfig(level=logging.INFO)
@@ -68,6 +70,12 @@ def newMetaReq(post_id: str, sentiment: list):
         'send_unix_ms': int(time.time() * 1000)
     }
 
+# warm dapr clients shared by all handlers of this process
+daprPool = daprpool.DaprClientPool(
+    name='sentiment',
+    max_size=daprPoolSize,
+)
+
 # server 
 app = App()
 # handlers
@@ -104,7 +112,7 @@ def sentimentAnalysis(event) -> None:
     ))
     # wrap predictions into req
     meta_req = newMetaReq(post_id, pred)
-    with DaprClient() as d:
+    with daprPool.client() as d:
         try:
             resp = d.invoke_method(
                     'dapr-post',
@@ -0,0 +1,85 @@
+import time
+import unittest
+import importlib.util
+from pathlib import Path
+from threading import Thread
+
+# unit tests of the dapr client pool, e.g.
+#   python3 -m unittest test_daprpool.py
+# Every app ships its own copy of daprpool.py (each one is a separate docker
+# build context), the copies must stay the same. The pool tests need the
+# python requirements of the apps (dapr, prometheus_client).
+apps_path = Path(__file__).parent.resolve() / '..'
+copies = [
+    apps_path / 'video-sharing' / 'pyutil' / 'daprpool.py',
+    apps_path / 'video-pipe' / 'pyutil' / 'daprpool.py',
+    apps_path / 'socialNetwork' / 'pyutil' / 'daprpool.py',
+    apps_path / 'proxy' / 'daprpool.py',
+]
+
+try:
+    spec = importlib.util.spec_from_file_location('daprpool', str(copies[0]))
+    daprpool = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(daprpool)
+except ImportError:
+    daprpool = None
+
+class TestCopies(unittest.TestCase):
+    def test_same(self):
+        src = copies[0].read_bytes()
+        for path in copies[1:]:
+            self.assertEqual(path.read_bytes(), src, '%s differs from %s' %(path, copies[0]))
+
+class FakeClient:
+    def close(self):
+        pass
+
+@unittest.skipIf(daprpool is None, 'needs dapr and prometheus_client')
+class TestPool(unittest.TestCase):
+    seq = 0
+
+    def pool(self, **kwargs):
+        # metric names are per pool
+        TestPool.seq += 1
+        pool = daprpool.DaprClientPool('test_%d' %TestPool.seq, **kwargs)
+        pool.client_kwargs = {}
+        return pool
+
+    def setUp(self):
+        self.client = daprpool.DaprClient
+        daprpool.DaprClient = FakeClient
+
+    def tearDown(self):
+        daprpool.DaprClient = self.client
+
+    def test_reuse(self):
+        pool = self.pool(max_size=2)
+        d, hit = pool.acquire()
+        self.assertFalse(hit)
+        pool.release(d)
+        self.assertEqual(pool.acquire(), (d, True))
+
+    # a waiter is woken by a broken client and creates a new one
+    def test_broken_wakes_waiter(self):
+        pool = self.pool(max_size=1)
+        d, _ = pool.acquire()
+        got = []
+        waiter = Thread(target=lambda: got.append(pool.acquire()))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual(got, [])
+        pool.release(d, broken=True)
+        waiter.join(timeout=2)
+        self.assertEqual(len(got), 1)
+        self.assertIsNot(got[0][0], d)
+        self.assertFalse(got[0][1])
+        self.assertEqual(pool.created, 1)
+
+    def test_timeout(self):
+        pool = self.pool(max_size=1, timeout=0.1)
+        pool.acquire()
+        with self.assertRaises(RuntimeError):
+            pool.acquire()
+
+if __name__ == '__main__':
+    unittest.main()
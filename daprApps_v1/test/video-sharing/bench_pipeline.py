@@ -0,0 +1,374 @@
+import os
+import sys
+import json
+import time
+import base64
+import random
+import logging
+import argparse
+import resource
+import subprocess
+from pathlib import Path
+from concurrent import futures
+from threading import Thread, Lock
+
+# hermetic benchmark of video-frontend -> video-scale -> video-thumbnail:
+# the services run unmodified as local processes, with the dapr sdk replaced
+# by the in-memory stand-in under hermetic/ (no kubernetes, sidecar or redis).
+# ffmpeg and the python requirements of the services are still needed.
+# Uploads replay the sample videos of video-scale/test/test_store.py at a
+# fixed (or poisson) rate; once the pipeline is quiet the services are
+# stopped and per-stage latency percentiles, cpu seconds per video (services,
+# pool workers and ffmpeg) and peak rss are reported, e.g.
+#   python3 bench_pipeline.py --rate 2 --count 100 --env video-scale:SCALE_IO=pipe
+hermetic_path = Path(__file__).parent.resolve() / 'hermetic'
+sys.path.append(str(hermetic_path))
+import daprhub
+sharing_path = Path(__file__).parent.resolve() / '..' / '..' / 'video-sharing'
+sys.path.append(str(sharing_path / 'pyutil'))
+import framing
+
+logging.basicConfig(level=logging.INFO)
+parser = argparse.ArgumentParser()
+parser.add_argument('--rate', dest='rate', type=float, default=1.0,
+    help='uploads per second')
+parser.add_argument('--count', dest='count', type=int, default=20,
+    help='number of uploads')
+parser.add_argument('--poisson', dest='poisson', action='store_true',
+    help='exponential inter-arrival times instead of a fixed interval')
+parser.add_argument('--videos', dest='videos', type=str, default='',
+    help='comma separated sample videos (default: those of test_store.py found in --video-dir)')
+parser.add_argument('--video-dir', dest='video_dir', type=str,
+    default=str(Path(__file__).parent.resolve() / '..' / 'video'))
+parser.add_argument('--binary', dest='binary', action='store_true',
+    help='upload raw video bytes (binary framing) instead of base64 json')
+parser.add_argument('--env', dest='env', action='append', default=[],
+    help='KEY=VALUE set for every service, or SERVICE:KEY=VALUE for one (e.g. video-scale:SCALE_IO=pipe)')
+parser.add_argument('--stores', dest='stores', type=str, default='video-store,thumbnail-store',
+    help='state stores whose writes mark the end of a stage')
+parser.add_argument('--retry-ms', dest='retry_ms', type=float, default=1000,
+    help='redelivery delay of events answered with retry')
+parser.add_argument('--quiet-ms', dest='quiet_ms', type=float, default=3000,
+    help='the pipeline is drained once no event is pending and no state was saved for this long')
+parser.add_argument('--drain-timeout', dest='drain_timeout', type=float, default=600)
+parser.add_argument('--sample-ms', dest='sample_ms', type=float, default=200,
+    help='rss sampling period')
+parser.add_argument('--seed', dest='seed', type=int, default=0)
+parser.add_argument('--out', dest='out', type=str, default='',
+    help='also write the results as json to this file')
+args = parser.parse_args()
+
+services = ['video-frontend', 'video-scale', 'video-thumbnail']
+appIds = {
+    'video-frontend': 'dapr-video-frontend',
+    'video-scale': 'dapr-video-scale',
+    'video-thumbnail': 'dapr-video-thumbnail',
+}
+# go services called by video-frontend, answered by the hub
+stubApps = ['dapr-video-info', 'dapr-dates']
+# same list as video-scale/test/test_store.py
+sampleVideos = [
+    'short_sample_6.mp4',
+    'short_sample_5.mp4',
+    'short_sample_4.mp4',
+    'short_sample_3.mp4',
+    'short_sample_2.mp4',
+    'short_sample_1.mp4',
+    'sample-5s.mp4',
+    'sample-10s.mp4',
+    'SampleVideo_720x480_5mb.mp4',
+    'SampleVideo_720x480_2mb.mp4',
+    'SampleVideo_720x480_1mb.mp4',
+    'SampleVideo_1280x720_5mb.mp4',
+    'SampleVideo_1280x720_2mb.mp4',
+    'SampleVideo_1280x720_1mb.mp4',
+    'earth_1920.avi',
+]
+
+def loadVideos() -> dict:
+    names = sampleVideos
+    if args.videos != '':
+        names = [v.strip() for v in args.videos.split(',') if v.strip() != '']
+    videos = {}
+    for name in names:
+        path = Path(args.video_dir) / name
+        if not path.exists():
+            logging.warning('%s not found, skipped' %str(path))
+            continue
+        with open(str(path), 'rb') as f:
+            videos[name] = f.read()
+    if len(videos) == 0:
+        raise RuntimeError('No sample video found in %s' %args.video_dir)
+    return videos
+
+def serviceEnv(svc: str, hub_address, authkey: bytes, prom_port: int) -> dict:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [str(hermetic_path), str(sharing_path)] +
+        [p for p in [os.getenv('PYTHONPATH', '')] if p != ''])
+    env['HERMETIC_HUB'] = '%s:%d' %hub_address
+    env['HERMETIC_AUTHKEY'] = authkey.hex()
+    env['APP_ID'] = appIds[svc]
+    env['PROM_ADDRESS'] = str(prom_port)
+    for e in args.env:
+        target = None
+        if ':' in e.split('=')[0]:
+            target, e = e.split(':', 1)
+        if target is not None and target != svc:
+            continue
+        k, v = e.split('=', 1)
+        env[k] = v
+    return env
+
+# rss sampling of each service with all of its descendants (pool workers, ffmpeg)
+def procTable() -> dict:
+    table = {}
+    page = resource.getpagesize()
+    for p in os.listdir('/proc'):
+        if not p.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' %p) as f:
+                stat = f.read()
+            with open('/proc/%s/statm' %p) as f:
+                rss = int(f.read().split()[1]) * page
+        except (FileNotFoundError, ProcessLookupError, IndexError):
+            continue
+        ppid = int(stat[stat.rfind(')')+2:].split()[1])
+        table[int(p)] = (ppid, rss)
+    return table
+
+def treeRss(table: dict, root: int) -> int:
+    children = {}
+    for pid, (ppid, _) in table.items():
+        children.setdefault(ppid, []).append(pid)
+    total = 0
+    todo = [root]
+    while len(todo) > 0:
+        pid = todo.pop()
+        if pid in table:
+            total += table[pid][1]
+        todo += children.get(pid, [])
+    return total
+
+peakRss = {}
+samplerRunning = True
+
+def sampleRss(procs: dict):
+    while samplerRunning:
+        table = procTable()
+        total = 0
+        for svc, proc in procs.items():
+            rss = treeRss(table, proc.pid)
+            total += rss
+            peakRss[svc] = max(peakRss.get(svc, 0), rss)
+        peakRss['total'] = max(peakRss.get('total', 0), total)
+        time.sleep(args.sample_ms / 1000)
+
+uploads = []
+uploadsLock = Lock()
+
+def upload(hub, i: int, name: str, video: bytes):
+    send_ms = time.time()*1000
+    header = {
+        'user': 'bench-%d' %(i % 10),
+        'description': name,
+        'date': '',
+        'send_unix_ms': int(send_ms),
+    }
+    try:
+        if args.binary:
+            data, resp_type = hub.invoke(appIds['video-frontend'], 'upload',
+                framing.pack(header, video), framing.BINARY_CONTENT_TYPE)
+        else:
+            header['video_b64'] = base64.b64encode(video).decode('utf-8')
+            data, resp_type = hub.invoke(appIds['video-frontend'], 'upload',
+                json.dumps(header).encode('utf-8'), 'application/json')
+        video_id = json.loads(data)['video_id']
+        err = None
+    except Exception as e:
+        video_id = None
+        err = str(e)
+        logging.error('Upload %d (%s) failed: %s' %(i, name, err))
+    with uploadsLock:
+        uploads.append({
+            'name': name,
+            'size': len(video),
+            'video_id': video_id,
+            'send_ms': send_ms,
+            'resp_ms': time.time()*1000,
+            'error': err,
+        })
+
+def percentiles(vals: list) -> dict:
+    if len(vals) == 0:
+        return {}
+    vals = sorted(vals)
+    res = {'n': len(vals), 'mean': sum(vals) / len(vals)}
+    for p in [50, 90, 95, 99]:
+        res['p%d' %p] = vals[min(len(vals) - 1, int(p / 100 * len(vals)))]
+    res['max'] = vals[-1]
+    return res
+
+# stageLatencies derives, per uploaded video, when each stage wrote its last
+# output (state saves of the app matching the video id) relative to the upload
+# and to the first event of the video published to the stage's topics
+def stageLatencies(log: dict, apps: dict) -> dict:
+    stores = set(args.stores.split(','))
+    topics = {}
+    for app_id in apps:
+        for pubsub, topic in apps[app_id]['subscriptions']:
+            topics[(pubsub, topic)] = app_id
+    lat = {'upload': [], 'e2e': []}
+    incomplete = 0
+    for u in uploads:
+        if u['video_id'] is None:
+            continue
+        vid = u['video_id']
+        lat['upload'].append(u['resp_ms'] - u['send_ms'])
+        last = {}
+        for ts, app_id, store, key, _ in log['saves']:
+            if store in stores and vid in key:
+                last[app_id] = max(last.get(app_id, 0), ts)
+        published = {}
+        for ts, _, pubsub, topic, data in log['publishes']:
+            app_id = topics.get((pubsub, topic))
+            if app_id is not None and vid.encode('utf-8') in data:
+                published[app_id] = min(published.get(app_id, ts), ts)
+        for app_id in published:
+            stage = app_id.replace('dapr-', '')
+            if app_id not in last:
+                incomplete += 1
+                continue
+            lat.setdefault(stage, []).append(last[app_id] - u['send_ms'])
+            lat.setdefault(stage + '_since_publish', []).append(last[app_id] - published[app_id])
+        if len(last) > 0:
+            lat['e2e'].append(max(last.values()) - u['send_ms'])
+    return {stage: percentiles(vals) for stage, vals in lat.items()}, incomplete
+
+# reap waits for a stopped service and returns its rusage (descendants it
+# reaped included); services that do not exit in time are killed
+def reap(svc: str, proc, timeout: float = 60):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        except ChildProcessError:
+            return None
+        if pid != 0:
+            proc.returncode = status
+            return usage
+        if time.time() > deadline:
+            logging.warning('%s did not stop after %.0f s, killed (its cpu is incomplete)' %(svc, timeout))
+            proc.kill()
+            deadline = float('inf')
+        time.sleep(0.1)
+
+def waitDrained(hub, start: float):
+    while time.time() - start < args.drain_timeout:
+        outstanding, calls, last_save_ms = hub.idle()
+        if outstanding == 0 and calls == 0 and time.time()*1000 - last_save_ms >= args.quiet_ms:
+            return True
+        time.sleep(0.2)
+    logging.warning('Pipeline not drained after %.0f s' %args.drain_timeout)
+    return False
+
+def main():
+    global samplerRunning
+    random.seed(args.seed)
+    videos = loadVideos()
+    names = sorted(videos)
+    authkey = os.urandom(16)
+    hub = daprhub.Hub(retry_ms=args.retry_ms, stub_apps=stubApps)
+    address = daprhub.serveHub(hub, authkey)
+    logging.info('hub listening on %s:%d' %address)
+    # start the services
+    procs = {}
+    for i, svc in enumerate(services):
+        procs[svc] = subprocess.Popen(
+            [sys.executable, str(sharing_path / svc / 'server.py')],
+            cwd=str(sharing_path / svc),
+            env=serviceEnv(svc, address, authkey, 19100 + i),
+        )
+    deadline = time.time() + 120
+    while len(hub.registered()) < len(services):
+        for svc, proc in procs.items():
+            if proc.poll() is not None:
+                raise RuntimeError('%s exited with %d at startup' %(svc, proc.returncode))
+        if time.time() > deadline:
+            raise RuntimeError('Services not registered after 120 s: %s' %str(list(hub.registered())))
+        time.sleep(0.2)
+    sampler = Thread(target=sampleRss, args=(procs,), daemon=True)
+    sampler.start()
+    # replay uploads (open loop, each upload on its own thread)
+    self_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    next_ts = start
+    with futures.ThreadPoolExecutor(max_workers=max(4, int(args.rate * 60))) as pool:
+        for i in range(args.count):
+            delay = next_ts - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            name = names[i % len(names)]
+            pool.submit(upload, hub, i, name, videos[name])
+            if args.poisson:
+                next_ts += random.expovariate(args.rate)
+            else:
+                next_ts += 1 / args.rate
+    drained = waitDrained(hub, start)
+    wall_s = time.time() - start
+    # stop the services and collect their cpu (pool workers and ffmpeg
+    # included, as they are reaped by the services on exit)
+    hub.stop()
+    samplerRunning = False
+    sampler.join()
+    cpu = {}
+    maxrss = {}
+    for svc, proc in procs.items():
+        usage = reap(svc, proc)
+        if usage is None:
+            continue
+        cpu[svc] = usage.ru_utime + usage.ru_stime
+        maxrss[svc] = usage.ru_maxrss * 1024
+    self_end = resource.getrusage(resource.RUSAGE_SELF)
+    apps = hub.registered()
+    log = hub.log()
+    lat, incomplete = stageLatencies(log, apps)
+    done = len([u for u in uploads if u['video_id'] is not None])
+    results = {
+        'rate': args.rate,
+        'uploads': len(uploads),
+        'uploaded': done,
+        'incomplete_stages': incomplete,
+        'drained': drained,
+        'wall_s': wall_s,
+        'redeliveries': log['redeliveries'],
+        'dropped_events': log['dropped'],
+        'latency_ms': lat,
+        'cpu_s': cpu,
+        'cpu_s_per_video': {svc: cpu[svc] / max(done, 1) for svc in cpu},
+        'cpu_s_per_video_total': sum(cpu.values()) / max(done, 1),
+        'bench_cpu_s': (self_end.ru_utime + self_end.ru_stime) -
+            (self_start.ru_utime + self_start.ru_stime),
+        'peak_rss_bytes': peakRss,
+        'max_process_rss_bytes': maxrss,
+    }
+    print('uploads %d (%d ok), %d stages incomplete, %.1f s, %d redeliveries' %(
+        len(uploads), done, incomplete, wall_s, log['redeliveries']))
+    for stage in sorted(lat):
+        p = lat[stage]
+        if len(p) == 0:
+            continue
+        print('%-32s n %4d  p50 %9.1f  p90 %9.1f  p99 %9.1f  max %9.1f ms' %(
+            stage, p['n'], p['p50'], p['p90'], p['p99'], p['max']))
+    for svc in cpu:
+        print('%-16s cpu %8.2f s (%.3f s/video)  peak rss %8.1f MB' %(
+            svc, cpu[svc], results['cpu_s_per_video'][svc], peakRss.get(svc, 0) / (1024 * 1024)))
+    print('total cpu per video %.3f s, peak rss %.1f MB' %(
+        results['cpu_s_per_video_total'], peakRss.get('total', 0) / (1024 * 1024)))
+    if args.out != '':
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+# in-process stand-in of the dapr python sdk, backed by daprhub.Hub
@@ -0,0 +1,66 @@
+import daprhub
+from dapr.clients.grpc._state import Concurrency
+from dapr.clients.grpc._response import InvokeMethodResponse, StateResponse, BulkStateItem, BulkStatesResponse
+
+def toBytes(value) -> bytes:
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return bytes(value)
+
+def ttlOf(metadata):
+    if metadata is None or 'ttlInSeconds' not in metadata:
+        return None
+    return float(metadata['ttlInSeconds'])
+
+def isFirstWrite(options) -> bool:
+    return options is not None and options.concurrency == Concurrency.first_write
+
+# DaprClient implements the calls of the sdk client used by the services
+# against the hub; grpc options and addresses are accepted and ignored
+class DaprClient:
+    def __init__(self, address: str = None, **kwargs):
+        self.hub = daprhub.connectHub()
+        self.app_id = daprhub.appId()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def get_state(self, store_name: str, key: str, state_metadata: dict = None) -> StateResponse:
+        _, data, etag = self.hub.get(store_name, [key])[0]
+        return StateResponse(data, etag)
+
+    def get_bulk_state(self, store_name: str, keys: list, parallelism: int = 1,
+            states_metadata: dict = None) -> BulkStatesResponse:
+        return BulkStatesResponse([BulkStateItem(k, data, etag)
+            for k, data, etag in self.hub.get(store_name, list(keys))])
+
+    def save_state(self, store_name: str, key: str, value, etag: str = None,
+            options=None, state_metadata: dict = None):
+        self.hub.save(self.app_id, store_name, [
+            (key, toBytes(value), etag, isFirstWrite(options), ttlOf(state_metadata))])
+
+    def save_bulk_state(self, store_name: str, states: list, metadata: dict = None):
+        self.hub.save(self.app_id, store_name, [
+            (s.key, toBytes(s.value), s.etag, isFirstWrite(s.options), ttlOf(s.metadata))
+            for s in states])
+
+    def delete_state(self, store_name: str, key: str, etag: str = None,
+            options=None, state_metadata: dict = None):
+        self.hub.delete(self.app_id, store_name, key, etag)
+
+    def publish_event(self, pubsub_name: str, topic_name: str, data, metadata: dict = None,
+            data_content_type: str = None):
+        self.hub.publish(self.app_id, pubsub_name, topic_name, toBytes(data), data_content_type)
+
+    def invoke_method(self, app_id: str, method_name: str, data='', content_type: str = None,
+            metadata=None, http_verb: str = None, http_querystring=None,
+            timeout: float = None) -> InvokeMethodResponse:
+        resp_data, resp_type = self.hub.invoke(app_id, method_name, toBytes(data), content_type,
+            timeout if timeout is not None else 60)
+        return InvokeMethodResponse(resp_data, resp_type)
@@ -0,0 +1,10 @@
+class InvokeMethodRequest:
+    def __init__(self, data=b'', content_type: str = None, metadata: dict = None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.data = data
+        self.content_type = content_type
+        self.metadata = metadata or {}
+
+    def text(self) -> str:
+        return self.data.decode('utf-8')
@@ -0,0 +1,39 @@
+from enum import Enum
+
+class InvokeMethodResponse:
+    def __init__(self, data=b'', content_type: str = None, headers: dict = None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.data = data
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    def text(self) -> str:
+        return self.data.decode('utf-8')
+
+class StateResponse:
+    def __init__(self, data: bytes, etag: str):
+        self.data = data
+        self.etag = etag
+
+class BulkStateItem:
+    def __init__(self, key: str, data: bytes, etag: str, error: str = ''):
+        self.key = key
+        self.data = data
+        self.etag = etag
+        self.error = error
+
+class BulkStatesResponse:
+    def __init__(self, items: list):
+        self.items = items
+
+class TopicEventResponseStatus(Enum):
+    success = 0
+    retry = 1
+    drop = 2
+
+class TopicEventResponse:
+    def __init__(self, status):
+        if isinstance(status, str):
+            status = TopicEventResponseStatus[status.lower()]
+        self.status = status
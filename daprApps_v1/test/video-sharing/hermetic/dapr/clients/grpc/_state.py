@@ -0,0 +1,24 @@
+from enum import Enum
+
+class Consistency(Enum):
+    unspecified = 0
+    eventual = 1
+    strong = 2
+
+class Concurrency(Enum):
+    unspecified = 0
+    first_write = 1
+    last_write = 2
+
+class StateOptions:
+    def __init__(self, consistency=Consistency.unspecified, concurrency=Concurrency.unspecified):
+        self.consistency = consistency
+        self.concurrency = concurrency
+
+class StateItem:
+    def __init__(self, key: str, value, etag: str = None, options: StateOptions = None, metadata: dict = None):
+        self.key = key
+        self.value = value
+        self.etag = etag
+        self.options = options
+        self.metadata = metadata
@@ -0,0 +1,86 @@
+import os
+import logging
+import traceback
+from concurrent import futures
+import daprhub
+from dapr.clients.grpc._request import InvokeMethodRequest
+from dapr.clients.grpc._response import InvokeMethodResponse, TopicEventResponse
+
+# Event is the cloud event handed to subscribers
+class Event:
+    def __init__(self, event_id: int, topic: str, data: bytes, content_type: str):
+        self.event_id = event_id
+        self.topic = topic
+        self.data = data
+        self.content_type = content_type
+
+    def Data(self) -> bytes:
+        return self.data
+
+    def ContentType(self) -> str:
+        return self.content_type
+
+    def EventID(self) -> str:
+        return str(self.event_id)
+
+    def Subject(self) -> str:
+        return self.topic
+
+# App serves the registered handlers with messages polled from the hub, on
+# thread_pool like the grpc server of the sdk. run returns once the hub stops.
+class App:
+    def __init__(self, thread_pool: futures.ThreadPoolExecutor = None, **kwargs):
+        self.thread_pool = thread_pool
+        self.methods = {}
+        self.subscriptions = {}
+
+    def method(self, name: str):
+        def decorator(func):
+            self.methods[name] = func
+            return func
+        return decorator
+
+    def subscribe(self, pubsub_name: str, topic: str, **kwargs):
+        def decorator(func):
+            self.subscriptions[(pubsub_name, topic)] = func
+            return func
+        return decorator
+
+    def dispatch(self, hub, app_id: str, msg: tuple):
+        if msg[0] == 'event':
+            _, event_id, pubsub, topic, data, content_type = msg
+            status = 'success'
+            try:
+                resp = self.subscriptions[(pubsub, topic)](Event(event_id, topic, data, content_type))
+                if isinstance(resp, TopicEventResponse):
+                    status = resp.status.name
+            except Exception:
+                logging.error('%s/%s handler failed: %s' %(pubsub, topic, traceback.format_exc()))
+                status = 'retry'
+            hub.ack(app_id, msg, status)
+            return
+        _, call_id, method, data, content_type = msg
+        try:
+            resp = self.methods[method](InvokeMethodRequest(data, content_type))
+            if not isinstance(resp, InvokeMethodResponse):
+                resp = InvokeMethodResponse(resp if resp is not None else b'')
+            hub.respond(call_id, resp.data, resp.content_type)
+        except Exception as e:
+            logging.error('%s handler failed: %s' %(method, traceback.format_exc()))
+            hub.respond(call_id, b'', None, error=str(e))
+
+    def run(self, app_port: int = None):
+        hub = daprhub.connectHub()
+        app_id = daprhub.appId()
+        executor = self.thread_pool
+        if executor is None:
+            executor = futures.ThreadPoolExecutor(max_workers=10)
+        hub.register(app_id, os.getpid(), list(self.subscriptions), list(self.methods))
+        while True:
+            msg = hub.poll(app_id, 1.0)
+            if msg is None:
+                continue
+            if msg[0] == 'stop':
+                break
+            executor.submit(self.dispatch, hub, app_id, msg)
+        logging.info('%s stopped by the hub' %app_id)
@@ -0,0 +1,217 @@
+import os
+import time
+import json
+import queue
+import logging
+import itertools
+from threading import Lock, Condition, Thread, Timer
+from multiprocessing.managers import BaseManager
+
+# Hub stands in for the dapr sidecars (and redis) of a hermetic benchmark:
+# in-memory state stores, pub/sub delivering every event to each subscribed
+# app (redelivered after retry_ms on retry/failure) and method invocation
+# routed to the app registered under the app id. Invocations of app ids in
+# stub_apps (the go services) are answered at once with send_unix_ms.
+# The hub runs in the benchmark process; the services reach it through a
+# multiprocessing manager (see connectHub) from the stand-in dapr package.
+class Hub:
+    def __init__(self, retry_ms: float = 1000, stub_apps: list = []):
+        self.retry_ms = retry_ms
+        self.stub_apps = set(stub_apps)
+        self.lock = Lock()
+        self.stores = {}
+        self.apps = {}
+        self.inboxes = {}
+        self.routes = {}
+        self.calls = {}
+        self.ids = itertools.count()
+        # event log (unix ms) read by the benchmark
+        self.saves = []
+        self.publishes = []
+        self.redeliveries = 0
+        self.dropped = 0
+        self.outstanding = 0
+        self.last_save_ms = 0
+        self.stopping = False
+
+    def inbox(self, app_id: str) -> queue.Queue:
+        with self.lock:
+            if app_id not in self.inboxes:
+                self.inboxes[app_id] = queue.Queue()
+            return self.inboxes[app_id]
+
+    # register is called by App.run once the app handlers are known
+    def register(self, app_id: str, pid: int, subscriptions: list, methods: list):
+        self.inbox(app_id)
+        with self.lock:
+            self.apps[app_id] = {
+                'pid': pid,
+                'subscriptions': subscriptions,
+                'methods': methods,
+            }
+            for pubsub, topic in subscriptions:
+                self.routes.setdefault((pubsub, topic), []).append(app_id)
+        logging.info('%s (pid %d) registered, topics %s, methods %s' %(
+            app_id, pid, str(subscriptions), str(methods)))
+
+    def registered(self) -> dict:
+        with self.lock:
+            return dict(self.apps)
+
+    # state store
+    def get(self, store: str, keys: list) -> list:
+        now = time.time()
+        items = []
+        with self.lock:
+            kv = self.stores.get(store, {})
+            for k in keys:
+                data, etag, expire = kv.get(k, (b'', '', None))
+                if expire is not None and expire <= now:
+                    data, etag = b'', ''
+                items.append((k, data, etag))
+        return items
+
+    # save stores [(key, value, etag, first_write, ttl_s)] all or nothing
+    def save(self, app_id: str, store: str, items: list):
+        now = time.time()
+        with self.lock:
+            kv = self.stores.setdefault(store, {})
+            for key, _, etag, first_write, _ in items:
+                cur = kv.get(key)
+                if cur is not None and cur[2] is not None and cur[2] <= now:
+                    cur = None
+                if etag is not None and etag != '':
+                    if cur is None or cur[1] != etag:
+                        raise RuntimeError('possible etag mismatch saving %s in %s' %(key, store))
+                elif first_write and cur is not None:
+                    raise RuntimeError('first-write conflict saving %s in %s' %(key, store))
+            for key, value, _, _, ttl in items:
+                expire = now + ttl if ttl is not None else None
+                kv[key] = (value, str(next(self.ids)), expire)
+                self.saves.append((now*1000, app_id, store, key, len(value)))
+            self.last_save_ms = now*1000
+
+    def delete(self, app_id: str, store: str, key: str, etag: str = None):
+        with self.lock:
+            kv = self.stores.get(store, {})
+            if etag is not None and etag != '' and kv.get(key, (None, None))[1] != etag:
+                raise RuntimeError('possible etag mismatch deleting %s in %s' %(key, store))
+            kv.pop(key, None)
+
+    # pub/sub
+    def publish(self, app_id: str, pubsub: str, topic: str, data: bytes, content_type: str):
+        with self.lock:
+            self.publishes.append((time.time()*1000, app_id, pubsub, topic, data))
+            subscribers = list(self.routes.get((pubsub, topic), []))
+            if len(subscribers) == 0:
+                self.dropped += 1
+                logging.warning('No subscriber of %s/%s, event dropped' %(pubsub, topic))
+            self.outstanding += len(subscribers)
+        for sub in subscribers:
+            self.inbox(sub).put(('event', next(self.ids), pubsub, topic, data, content_type))
+
+    # ack settles a delivered event with the status returned by the subscriber
+    def ack(self, app_id: str, msg: tuple, status: str):
+        if status == 'retry':
+            with self.lock:
+                self.redeliveries += 1
+            t = Timer(self.retry_ms / 1000, self.inbox(app_id).put, args=(msg,))
+            t.daemon = True
+            t.start()
+            return
+        with self.lock:
+            self.outstanding -= 1
+            if status == 'drop':
+                self.dropped += 1
+
+    # poll returns the next message for app_id, None on timeout, or ('stop',)
+    def poll(self, app_id: str, timeout: float):
+        if self.stopping:
+            return ('stop',)
+        try:
+            return self.inbox(app_id).get(timeout=timeout)
+        except queue.Empty:
+            return ('stop',) if self.stopping else None
+
+    # method invocation
+    def invoke(self, app_id: str, method: str, data: bytes, content_type: str, timeout: float = 60):
+        with self.lock:
+            routed = app_id in self.apps
+        if not routed:
+            if app_id in self.stub_apps:
+                return json.dumps({'send_unix_ms': int(time.time()*1000)}).encode('utf-8'), 'application/json'
+            raise RuntimeError('app %s is not running' %app_id)
+        call_id = next(self.ids)
+        call = {'cond': Condition(), 'resp': None}
+        with self.lock:
+            self.calls[call_id] = call
+        self.inbox(app_id).put(('invoke', call_id, method, data, content_type))
+        with call['cond']:
+            call['cond'].wait_for(lambda: call['resp'] is not None, timeout=timeout)
+        with self.lock:
+            self.calls.pop(call_id, None)
+        if call['resp'] is None:
+            raise RuntimeError('%s/%s timed out after %s s' %(app_id, method, str(timeout)))
+        data, content_type, error = call['resp']
+        if error is not None:
+            raise RuntimeError('%s/%s failed: %s' %(app_id, method, error))
+        return data, content_type
+
+    def respond(self, call_id: int, data: bytes, content_type: str, error: str = None):
+        with self.lock:
+            call = self.calls.get(call_id)
+        if call is None:
+            return
+        with call['cond']:
+            call['resp'] = (data, content_type, error)
+            call['cond'].notify()
+
+    # idle returns (events not yet settled, pending invocations, last save unix ms)
+    def idle(self):
+        with self.lock:
+            return self.outstanding, len(self.calls), self.last_save_ms
+
+    def stop(self):
+        self.stopping = True
+
+    def log(self) -> dict:
+        with self.lock:
+            return {
+                'saves': list(self.saves),
+                'publishes': list(self.publishes),
+                'redeliveries': self.redeliveries,
+                'dropped': self.dropped,
+            }
+
+class HubManager(BaseManager):
+    pass
+
+# serveHub serves hub to other processes from a thread of this process and
+# returns the (host, port) it listens on
+def serveHub(hub: Hub, authkey: bytes):
+    HubManager.register('hub', callable=lambda: hub)
+    manager = HubManager(address=('127.0.0.1', 0), authkey=authkey)
+    server = manager.get_server()
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server.address
+
+# per process connection to the hub named by HERMETIC_HUB (host:port)
+hubLock = Lock()
+hubProxy = None
+hubPid = None
+
+def connectHub():
+    global hubProxy, hubPid
+    with hubLock:
+        if hubProxy is None or hubPid != os.getpid():
+            host, port = os.environ['HERMETIC_HUB'].split(':')
+            HubManager.register('hub')
+            manager = HubManager(address=(host, int(port)),
+                authkey=bytes.fromhex(os.environ['HERMETIC_AUTHKEY']))
+            manager.connect()
+            hubProxy = manager.hub()
+            hubPid = os.getpid()
+        return hubProxy
+
+def appId() -> str:
+    return os.getenv('APP_ID', 'app-%d' %os.getpid())
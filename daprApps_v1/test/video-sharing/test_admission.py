@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import unittest
+from pathlib import Path
+from multiprocessing import get_context
+
+# unit tests of the admission of video-scale and video-thumbnail, e.g.
+#   python3 -m unittest test_admission.py
+# Each service is imported (with the hermetic dapr stand-in) in its own
+# process, its jobs are held while more events than QUEUE_SIZE arrive at
+# once on its handler threads. Needs the python requirements of the services.
+hermetic_path = Path(__file__).parent.resolve() / 'hermetic'
+sharing_path = Path(__file__).parent.resolve() / '..' / '..' / 'video-sharing'
+
+# the QUEUE_SIZE of k8s/deployment.yaml
+queue_size = 20
+extra_events = 3
+
+# saturate returns the statuses of queue_size + extra_events single job events
+# handled concurrently by service, with the service defaults but queue_size
+def saturate(service: str, handler: str, job_fn: str) -> list:
+    os.environ['QUEUE_SIZE'] = str(queue_size)
+    os.environ['ADMIT_TIMEOUT_MS'] = '200'
+    os.environ.pop('HANDLER_THREADS', None)
+    sys.path = [str(hermetic_path), str(sharing_path), str(sharing_path / service)] + sys.path
+    from threading import Event
+    import server
+    from dapr.ext.grpc import Event as CloudEvent
+    release = Event()
+    # jobs hold their admission slot until released
+    def held(data, done):
+        release.wait()
+        server.jobDone()
+        done.set_result(True)
+    setattr(server, job_fn, held)
+    events = []
+    for i in range(queue_size + extra_events):
+        data = json.dumps({'data_id': 'video-%d' %i, 'send_unix_ms': 0}).encode()
+        events.append(server.executor.submit(getattr(server, handler),
+            CloudEvent(i, 'topic', data, 'application/json')))
+    statuses = []
+    # the events beyond queue_size come back while the others are held
+    for f in events[queue_size:]:
+        statuses.append(f.result(timeout=10).status.name)
+    release.set()
+    for f in events[:queue_size]:
+        statuses.append(f.result(timeout=10).status.name)
+    return statuses
+
+class TestAdmission(unittest.TestCase):
+    def check(self, service: str, handler: str, job_fn: str):
+        # a fresh process per service, they share module names
+        with get_context('spawn').Pool(1) as pool:
+            statuses = pool.apply(saturate, (service, handler, job_fn))
+        self.assertEqual(statuses, ['retry'] * extra_events + ['success'] * queue_size)
+
+    def test_scale(self):
+        self.check('video-scale', 'scaleVideo', 'scaleJob')
+
+    def test_thumbnail(self):
+        self.check('video-thumbnail', 'videoThumbnail', 'thumbnailJob')
+
+if __name__ == '__main__':
+    unittest.main()
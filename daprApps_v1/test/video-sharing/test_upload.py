@@ -11,6 +11,8 @@ from typing import List
 import io
 
 random.seed(int(time.time()))
+# upload raw video bytes (binary framing) instead of base64 json
+binary_upload = '--binary' in sys.argv
 
 upload_url = 'http://localhost:31985/v1.0/invoke/dapr-video-frontend/method/upload'
 info_url   = 'http://localhost:31985/v1.0/invoke/dapr-video-frontend/method/info'
@@ -23,6 +25,9 @@ from pathlib import Path
 # video_path = Path(__file__).parent.resolve() / '..' / 'video'
 video_path = Path(__file__).parent.resolve() / '..' / '..' / 'workload' / 'vpipe' / 'video'
 sys.path.append(str(video_path))
+framing_path = Path(__file__).parent.resolve() / '..' / '..' / 'video-sharing' / 'pyutil'
+sys.path.append(str(framing_path))
+import framing
 
 # read videos and encode as base64
 videos = {}
@@ -61,6 +66,18 @@ def upload_video(user: str, video_b64: str, desc: str, dt: str):
     print(r.text)
     return json.loads(r.text)['video_id']
 
+def upload_video_binary(user: str, video: bytes, desc: str, dt: str):
+    header = {
+        'user': user,
+        'description': desc,
+        'date': dt,
+        'send_unix_ms': int(time.time() * 1000),
+    }
+    r = requests.post(upload_url, data=framing.pack(header, video),
+        headers={'Content-Type': framing.BINARY_CONTENT_TYPE})
+    print(r.text)
+    return json.loads(r.text)['video_id']
+
 def get_video(video: str, res: str):
     payload = {
         'video': video,
@@ -107,13 +124,21 @@ print('#------------ upload-video -------------#')
 for v in b64_videos:
     # --- test upload
     unix_ms = int(time.time() * 1000)
-    vid = upload_video(
-        user=make_user(0), 
-        video_b64=b64_videos[v], 
-        # video_b64=b64_videos['SampleVideo_1280x720_2mb.mp4'],
-        desc='%s shouts out at %d: Fakers get out of academia! --- from %s' %(
-            make_user(0), unix_ms, v), 
-        dt=random.choice(test_dates))
+    desc = '%s shouts out at %d: Fakers get out of academia! --- from %s' %(
+        make_user(0), unix_ms, v)
+    if binary_upload:
+        vid = upload_video_binary(
+            user=make_user(0), 
+            video=videos[v], 
+            desc=desc, 
+            dt=random.choice(test_dates))
+    else:
+        vid = upload_video(
+            user=make_user(0), 
+            video_b64=b64_videos[v], 
+            # video_b64=b64_videos['SampleVideo_1280x720_2mb.mp4'],
+            desc=desc, 
+            dt=random.choice(test_dates))
     print('%s uploaded' %v)
     all_vids.append(vid)
     print(vid)
@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+import unittest
+import subprocess
+from pathlib import Path
+
+# unit tests of the spawn worker pool of pyutil/workerpool.py, e.g.
+#   python3 -m unittest test_workerpool.py
+# A fake server starts a pool, kills a worker and checks that neither the
+# first workers nor the replacement imported the server module.
+sharing_path = Path(__file__).parent.resolve() / '..' / '..' / 'video-sharing'
+
+worker_src = '''import os
+import sys
+import time
+
+def whoami():
+    return os.getpid(), sys.modules['__main__'].__file__
+
+def nap():
+    time.sleep(10)
+'''
+
+server_src = '''import os
+import sys
+import time
+import signal
+# every process importing the server logs its pid
+with open(os.environ['IMPORT_LOG'], 'a') as f:
+    f.write('%d\\n' %os.getpid())
+import worker
+from pyutil import workerpool
+
+if __name__ == '__main__':
+    print('server', os.getpid(), __file__)
+    pool, _, _ = workerpool.startPool(worker, 1)
+    pid, main = pool.apply(worker.whoami)
+    print('worker', pid, main)
+    # killed while running a job (an idle worker may hold the task queue lock)
+    pool.apply_async(worker.nap)
+    time.sleep(0.5)
+    os.kill(pid, signal.SIGKILL)
+    # the pool replaces the dead worker
+    for _ in range(100):
+        time.sleep(0.1)
+        res = pool.apply_async(worker.whoami)
+        try:
+            new_pid, main = res.get(timeout=1)
+        except Exception:
+            continue
+        if new_pid != pid:
+            print('replacement', new_pid, main)
+            break
+    pool.terminate()
+'''
+
+class TestWorkerPool(unittest.TestCase):
+    def test_replacement_skips_server(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            Path(tmp, 'worker.py').write_text(worker_src)
+            Path(tmp, 'server.py').write_text(server_src)
+            import_log = Path(tmp, 'imports.log')
+            env = dict(os.environ)
+            env['IMPORT_LOG'] = str(import_log)
+            env['PYTHONPATH'] = os.pathsep.join([str(sharing_path), env.get('PYTHONPATH', '')])
+            p = subprocess.run([sys.executable, str(Path(tmp, 'server.py'))], env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+            self.assertEqual(p.returncode, 0, p.stderr.decode())
+            lines = p.stdout.decode().splitlines()
+            self.assertEqual([l.split()[0] for l in lines], ['server', 'worker', 'replacement'], lines)
+            for l in lines[1:]:
+                self.assertTrue(l.endswith('worker.py'), l)
+            # only the server process itself imported server.py
+            self.assertEqual(import_log.read_text().split(), [lines[0].split()[1]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,12 +3,9 @@ import sys
 import json
 import logging
 import time
-import queue
 import numpy as np
 from pathlib import Path
 from concurrent import futures
-# worker pool
-from multiprocessing import Queue, Process
 from threading import Lock
 # dapr
 from dapr.clients import DaprClient
@@ -29,19 +26,34 @@ from pathlib import Path
 util_path = Path(__file__).parent.resolve() / '..' / 'pyutil'
 sys.path.append(str(util_path))
 import pyutil
+from pyutil import daprpool
+from pyutil import scheduler
 
 warnings.filterwarnings("ignore")
 # global variables
 serviceAddress  = int(os.getenv('ADDRESS', '5005'))
 promAddress     = int(os.getenv('PROM_ADDRESS', '8084'))
+daprPoolSize    = int(os.getenv('DAPR_POOL_SIZE', '2'))
 # pubsub
 videoPipePubsub = os.getenv('VIDEO_PIPE_PUBSUB', 'vpipe-events')
 faceTopic       = os.getenv('FACE_TOPIC', 'face')
 imageStore      = os.getenv('IMAGE_STORE', 'vpipe-image-store')
 numWorkers      = int(os.getenv('WORKERS', '10'))
 logLevel        = os.getenv('LOG_LEVEL', 'info')
-maxTimeout      = float(os.getenv('MAX_TIMEOUT', '0.1'))
-idleTime   = float(os.getenv('IDLE_TIME', '0.005'))
+# low priority requests go first after SCHED_HIGH_WEIGHT high priority ones in
+# a row, or once they waited SCHED_AGING_MS (0 disables either)
+schedHighWeight = int(os.getenv('SCHED_HIGH_WEIGHT', '8'))
+schedAgingMs    = float(os.getenv('SCHED_AGING_MS', '5000'))
+# fifo or edf (earliest deadline first, deadline = client_unix_ms + slo of the
+# priority), and what edf does with requests that cannot meet their deadline
+# (run, demote or shed). Slos of 0 set no deadline.
+schedPolicy     = os.getenv('SCHED_POLICY', 'fifo')
+schedLate       = os.getenv('SCHED_LATE', 'demote')
+# edf demoted requests go first once they waited SCHED_AGING_MS, at most
+# SCHED_DEMOTE_MAX of them wait (the oldest are shed beyond, 0 for no bound)
+schedDemoteMax  = int(os.getenv('SCHED_DEMOTE_MAX', '1000'))
+sloHighMs       = float(os.getenv('SLO_PRIO_1_MS', '0'))
+sloLowMs        = float(os.getenv('SLO_PRIO_2_MS', '0'))
 
 # multi-process prometheus dir (must exist and be empty)
 # todo: create this dir in dockerfile and set the env in deploy yaml
@@ -94,6 +106,12 @@ imageStoreUpdateLat = prometheus_client.Histogram(
 )
 
 MAX_PAYLOAD = 64 * 1024 * 1024 # 64MB
+# warm dapr clients shared by all handlers of this process
+daprPool = daprpool.DaprClientPool(
+    name='face_detect',
+    max_size=daprPoolSize,
+    max_grpc_message_length=MAX_PAYLOAD,
+)
 # folders to hold videos
 imageDir = Path('/tmp') / 'image'
 os.makedirs(str(imageDir), exist_ok=True)
@@ -110,7 +128,7 @@ def faceDetect(data):
     serv_lat = epoch - send_unix_ms
     read_store_lat = 0
     image = None
-    with DaprClient(max_grpc_message_length=MAX_PAYLOAD) as d:
+    with daprPool.client() as d:
         max_trial = 3
         data_fetched = False
         trials = 0
@@ -227,94 +245,44 @@ def faceDetect(data):
         ))
         return True
 
-# worker function
-def faceDetectWorker(
-    high_prio_queue: Queue,
-    low_prio_queue: Queue,
-    max_timeout: float = maxTimeout,
-    idle_time: float = idleTime,
-    interval: float=60,
-    ):
-    low_prio_ctr = 0
-    low_prio_rps = 0
-    stats_ts = time.time()
-    ts_empty = True
-    timeout = 0.05
-    while True:
-        # inifinite loop processing both high & low priority requests
-        high_prio_empty = False
-        low_prio_empty = False
-        # process high priority requests as long as there is any
-        while True:
-            epoch = time.time()
-            # todo: compute propoer timeout
-            if epoch - stats_ts >= interval:
-                rps = low_prio_ctr / (epoch - stats_ts)
-                if ts_empty:
-                    low_prio_rps = rps
-                    ts_empty = False
-                else:
-                    low_prio_rps = rps * 0.4 + low_prio_rps * 0.6
-                if rps > 0:
-                    timeout = min(idle_time / low_prio_rps, max_timeout)
-                else:
-                    timeout = max_timeout
-                logging.debug('low_prio_rps = %.3f, timeout set to %.3fs' %(
-                    low_prio_rps, timeout))
-                low_prio_ctr = 0
-                stats_ts = epoch
-            # actual work
-            try:
-                # req = high_prio_queue.get(block=False)
-                req = high_prio_queue.get(block=True, timeout=timeout)
-                faceDetect(data=req)
-            except queue.Empty:
-                high_prio_empty = True
-                break
-        # process low prioty requests when no high priority requests exist
-        try:
-            req = low_prio_queue.get(block=False)
-            faceDetect(data=req)
-            low_prio_ctr += 1
-        except queue.Empty:
-            low_prio_empty = True
-        # wait if no req is pending
-        if high_prio_empty and low_prio_empty:
-            time.sleep(0.01)
+# worker process
+def faceDetectWorker(worker_id: int, conn):
+    scheduler.serve(conn, lambda req: faceDetect(data=req))
 
-workerPool = [] # list of worker processes
-highPrioQueue = Queue()
-lowPrioQueue = Queue()
+# priority queues of the requests, dispatched to the worker processes
+reqScheduler = scheduler.PriorityScheduler(
+    high_weight=schedHighWeight,
+    aging_ms=schedAgingMs,
+    name='face_detect',
+    policy=schedPolicy,
+    slo_ms={
+        scheduler.HIGH: sloHighMs,
+        scheduler.LOW: sloLowMs,
+    },
+    late=schedLate,
+    demote_max=schedDemoteMax,
+)
 
 app = App()
 # upload a new video
 @app.subscribe(pubsub_name=videoPipePubsub, topic=faceTopic)
 def videoScene(event) -> None:
-    # request queues
-    global highPrioQueue
-    global lowPrioQueue
     data = json.loads(event.Data())
     if data['priority'] == 1:
         # high priority requests
         highPriReqTotal.inc()
-        highPrioQueue.put(data)
+        reqScheduler.submit(data, scheduler.HIGH, data['client_unix_ms'])
     elif data['priority'] == 2:
         lowPriReqTotal.inc()
         # low priority requests
-        lowPrioQueue.put(data)
+        reqScheduler.submit(data, scheduler.LOW, data['client_unix_ms'])
 
 if __name__ == '__main__':
     # create multiprocess registry and start prometheus service
     registry = CollectorRegistry()
     multiprocess.MultiProcessCollector(registry)
     prometheus_client.start_http_server(promAddress, registry=registry)
-    # worker pool
-    for i in range(0, numWorkers):
-        worker_p = Process(target=faceDetectWorker, kwargs={
-            'high_prio_queue': highPrioQueue,
-            'low_prio_queue': lowPrioQueue,
-        })
-        worker_p.start()  # Launch reader_p() as another proc
-        workerPool.append(worker_p)
+    # worker processes
+    reqScheduler.start(numWorkers, faceDetectWorker)
     # start the service
     app.run(serviceAddress)
\ No newline at end of file
@@ -0,0 +1,324 @@
+import os
+import copy
+import json
+import time
+import logging
+import subprocess
+from pathlib import Path
+# dapr
+from dapr.clients.grpc._state import StateItem
+# ffmpeg
+import ffmpeg
+# prometheus
+import prometheus_client
+# util
+from .util import latBuckets, latBucketsLong
+
+# outputs of the ffmpeg snapshots
+IMAGE2 = 'image2'
+IMAGE2PIPE = 'image2pipe'
+# samplings of the snapshots
+RATE = 'rate'
+SEEK = 'seek'
+KEYFRAME = 'keyframe'
+# jpeg start/end of image markers
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+
+# splitJpegs splits the concatenated jpeg images written by image2pipe.
+# Markers do not show up inside the entropy coded data (0xff is stuffed with
+# 0x00 there) and the mjpeg encoder writes no embedded thumbnails.
+def splitJpegs(buf: bytes) -> list:
+    images = []
+    pos = 0
+    while True:
+        start = buf.find(JPEG_SOI, pos)
+        if start < 0:
+            break
+        end = buf.find(JPEG_EOI, start + 2)
+        if end < 0:
+            logging.warning('Truncated jpeg image at byte %d of %d' %(start, len(buf)))
+            break
+        images.append(buf[start:end + 2])
+        pos = end + 2
+    return images
+
+# dropEnds returns the index of the first image kept and the images kept of
+# those sampled at rate: all but the first and the last, unless there are no
+# more than two (as the image2 output keeps them)
+def dropEnds(images: list):
+    if len(images) > 2:
+        return 1, images[1:-1]
+    return 0, images
+
+# SceneStage is the scene extraction of video-scene: snapshots of a local video
+# file every few seconds, saved to the image store and published one per image
+# to the face topic. It also runs inside video-meta workers in fused mode, on
+# the temp file of the meta stage, so it owns the video_scene_* metrics.
+#
+# image2: ffmpeg writes every snapshot to a temp dir of the request, the first
+# and last ones are dropped once listed.
+# image2pipe: ffmpeg writes the snapshots to its stdout, parsed in memory.
+# Sampled at rate, the filter graph only passes the frames image2 keeps (see
+# frames), so the first and last ones are never encoded.
+#
+# rate: ffmpeg decodes the whole video, sampled at rate frames per second.
+# seek: the same frames are taken by seeking the input to their timestamps
+# and decoding one frame from there, so the cpu per request depends on the
+# number of scenes rather than on the duration.
+# keyframe: as seek, each snapshot being the keyframe at or before its
+# timestamp (no decoding from the keyframe up to the timestamp, close
+# timestamps may yield the same image).
+class SceneStage:
+    def __init__(self, image_store: str, pubsub: str, face_topic: str,
+            interval: int, max_scenes: int, output: str = IMAGE2, sampling: str = RATE):
+        if output not in [IMAGE2, IMAGE2PIPE]:
+            raise ValueError('Unknown snapshot output %s' %output)
+        if sampling not in [RATE, SEEK, KEYFRAME]:
+            raise ValueError('Unknown snapshot sampling %s' %sampling)
+        self.output = output
+        self.sampling = sampling
+        self.image_store = image_store
+        self.pubsub = pubsub
+        self.face_topic = face_topic
+        self.interval = interval
+        self.max_scenes = max_scenes
+        self.highPriReqTotal = prometheus_client.Counter(
+            'video_scene_prio_1_total',
+            'Number of priority 1 (high) meta requests')
+        self.lowPriReqTotal = prometheus_client.Counter(
+            'video_scene_prio_2_total',
+            'Number of priority 2 (low) meta requests')
+        self.highPriDurTotal = prometheus_client.Counter(
+            'video_scene_prio_1_duration_total',
+            'Total video duration of priority 1 (high) scene-extraction requests')
+        self.lowPriDurTotal = prometheus_client.Counter(
+            'video_scene_prio_2_duration_total',
+            'Total video duration of priority 2 (low) scene-extraction requests')
+        # todo: the latency range needs refined
+        self.highPrioLat = prometheus_client.Histogram(
+            'video_scene_prio_1_lat_hist',
+            'Latency (ms) histogram of priority 1 (high) video-scene requests',
+            buckets=latBucketsLong()
+        )
+        self.lowPrioLat = prometheus_client.Histogram(
+            'video_scene_prio_2_lat_hist',
+            'Latency (ms) histogram of priority 2 (low) video-scene requests',
+            buckets=latBucketsLong()
+        )
+        self.imageStoreLat = prometheus_client.Histogram(
+            'image_store_scene_update_lat_hist',
+            'Latency (ms) histogram of updating image-store (kvs/db) in video-scene',
+            buckets=latBuckets()
+        )
+
+    # run extracts the scenes of tempf (removed once read) for request data.
+    # serv_lat is the service time (ms) of the stage accounted up to epoch,
+    # video_store_lat only goes to the debug log.
+    def run(self, d, data, tempf: Path, image_dir: Path, serv_lat: float, epoch: float,
+            video_store_lat: float = 0) -> bool:
+        req_id = data['req_id']
+        video_id = data['video_id']
+        is_high_prio = data['priority'] == 1
+        duration = data['meta']['duration']
+        # update prom workload metric
+        if is_high_prio:
+            self.highPriDurTotal.inc(duration)
+        else:
+            self.lowPriDurTotal.inc(duration)
+        if self.output == IMAGE2PIPE:
+            images = self.snapshotPipe(tempf, req_id, duration)
+        else:
+            images = self.snapshotFiles(tempf, image_dir / ('%s-%s' %(req_id, video_id)), req_id, duration)
+        # remove video data
+        if os.path.exists(str(tempf)):
+            os.remove(str(tempf))
+        if images is None:
+            return False
+        image_ids = [img_id for img_id, _ in images]
+        state_items = [StateItem(key=img_id, value=img_bytes) for img_id, img_bytes in images]
+        # latency metrics
+        cur_unix_ms = time.time()*1000
+        serv_lat += cur_unix_ms - epoch
+        epoch = cur_unix_ms
+        # save state
+        if len(state_items) > 0:
+            d.save_bulk_state(
+                store_name=self.image_store,
+                states=state_items,
+            )
+        # latency metrics
+        cur_unix_ms = time.time()*1000
+        img_store_lat = cur_unix_ms - epoch
+        self.imageStoreLat.observe(img_store_lat)
+        epoch = cur_unix_ms
+        # todo: send one request per image
+        if len(image_ids) > 0:
+            for img_id in image_ids:
+                req_data = copy.copy(data)
+                req_data['send_unix_ms'] = int(time.time()*1000)
+                req_data['image_id'] = img_id
+
+                # # todo: debug, remove later
+                # req_data['trace'] = data['trace']
+                # req_data['trace']['scene_serv_lat'] = serv_lat + time.time() * 1000 - epoch
+                # req_data['trace']['scene_store_lat'] = video_store_lat
+
+                resp = d.publish_event(
+                    pubsub_name=self.pubsub,
+                    topic_name=self.face_topic,
+                    data=json.dumps(req_data),
+                    data_content_type='application/json',
+                )
+        # update prom metrics
+        cur_unix_ms = time.time() * 1000
+        serv_lat += cur_unix_ms - epoch
+        if is_high_prio:
+            self.highPrioLat.observe(serv_lat)
+        else:
+            self.lowPrioLat.observe(serv_lat)
+        # for debugging
+        logging.debug('Processed req_id=%s, video_id=%s, images=%d, priority=%d, serv_lat=%d, video_store_lat=%d, img_store_lat=%d' %(
+            req_id, video_id, len(image_ids), data['priority'], serv_lat, video_store_lat, img_store_lat,
+        ))
+        return True
+
+    # frames returns the sampling rate of a video, the number of images of
+    # image2 sampled at rate (-r) and the range [first, last] of those kept.
+    # ffmpeg writes floor(duration * rate) + 2 images: the first frame twice,
+    # then one every 1/rate s, the last one after the end of the video. The
+    # first and the last are kept only when there are no more than two, image
+    # i of [first, last] is the frame at (i - first) / rate.
+    def frames(self, duration: float):
+        rate = max(1/self.interval, self.max_scenes/duration)
+        # duration * rate is a whole number for short videos, up to rounding
+        num_frames = int(duration * rate + 1e-6) + 2
+        if num_frames > 2:
+            return rate, num_frames, 1, num_frames - 2
+        return rate, num_frames, 0, num_frames - 1
+
+    # selected returns the ffmpeg stream of the frames [first, last] of tempf
+    # seeked to, with first, last and num_frames: the frames kept of image2
+    # sampled at rate, at the same timestamps. The output is expected to stop
+    # after last - first + 1 frames (vframes), inputs are read for 1/rate s at most.
+    def selected(self, tempf: Path, duration: float):
+        rate, num_frames, first, last = self.frames(duration)
+        # one input per timestamp, seeked before decoding
+        segments = []
+        for i in range(first, last + 1):
+            ts = (i - first) / rate
+            # no input is decoded up to the end of the video
+            kwargs = {'ss': '%.3f' %ts, 't': '%.3f' %(1 / rate)}
+            if self.sampling == KEYFRAME:
+                kwargs['noaccurate_seek'] = None
+            # each frame keeps its own timestamp, vfr would drop frames sharing one
+            segments.append(
+                ffmpeg
+                .input(str(tempf), **kwargs)
+                .video
+                .filter('trim', end_frame=1)
+                .filter('setpts', '%.6f/TB' %ts)
+            )
+        if len(segments) == 1:
+            return segments[0], first, last, num_frames
+        return ffmpeg.concat(*segments, v=1, a=0), first, last, num_frames
+
+    # snapshotFiles returns the (image_id, jpeg bytes) snapshots of tempf,
+    # written by ffmpeg to temp_img_dir (removed once read), None on failure
+    def snapshotFiles(self, tempf: Path, temp_img_dir: Path, req_id: str, duration: float):
+        if not os.path.isdir(temp_img_dir):
+            os.makedirs(temp_img_dir)
+        try:
+            if self.sampling == RATE:
+                # take snapshot every few seconds
+                rate = max(1/self.interval, self.max_scenes/duration)
+                (
+                    ffmpeg
+                    .input(str(tempf))
+                    .output(str(temp_img_dir) + '/' + str(req_id) + '_%02d.jpg',
+                        r=rate, format='image2', vcodec='mjpeg')
+                    .overwrite_output()
+                    # .run_async(pipe_stdout=True, pipe_stderr=True)
+                    .run(capture_stdout=True, capture_stderr=True)
+                )
+            else:
+                stream, first, last, _ = self.selected(tempf, duration)
+                (
+                    stream
+                    .output(str(temp_img_dir) + '/' + str(req_id) + '_%02d.jpg',
+                        format='image2', vcodec='mjpeg', vsync='vfr', start_number=first + 1,
+                        vframes=last - first + 1)
+                    .overwrite_output()
+                    .run(capture_stdout=True, capture_stderr=True)
+                )
+        except ffmpeg.Error as e:
+            out = e.stdout.decode()
+            err = e.stderr.decode()
+            logging.error('FFmpeg (req_id: %s) std_err: %s, std_out: %s' %(
+                req_id, err, out))
+            subprocess.run('rm -rf %s' %(str(temp_img_dir)), shell=True)
+            return None
+            # raise RuntimeError('ffprobe stdout: %s, stderr: %s' %(e.stdout, e.stderr))
+        images = []
+        # exclude the image at the beginning and the image at the end
+        # (only sampled at rate, seeks skip them)
+        num_images = 0
+        ignored_images = []
+        max_img_id = ''
+        for img in os.listdir(str(temp_img_dir)):
+            this_img_id = img.split('_')[-1].replace('.jpg', '')
+            if max_img_id == '' or int(this_img_id.lstrip('0')) > int(max_img_id.lstrip('0')):
+                max_img_id = this_img_id
+            num_images += 1
+        if num_images > 2 and self.sampling == RATE:
+            ignored_images = [str(req_id) + '_01.jpg', str(req_id) + '_%s.jpg' %max_img_id]
+            logging.debug('ignored images: %s' %(','.join(ignored_images)))
+        for img in os.listdir(str(temp_img_dir)):
+            if img in ignored_images:
+                logging.debug('images:%s ignored' %img)
+                continue
+            img_id = img.split('/')[-1]
+            if os.path.isfile(str(temp_img_dir / img)):
+                with open(str(temp_img_dir / img), 'rb') as f:
+                    images.append((img_id, f.read()))
+        # remove temp video directory
+        subprocess.run('rm -rf %s' %(str(temp_img_dir)), shell=True)
+        # shutil.rmtree(str(temp_img_dir))
+        return images
+
+    # snapshotPipe returns the (image_id, jpeg bytes) snapshots of tempf, read
+    # from the stdout of ffmpeg, None on failure. Image ids are those of image2.
+    def snapshotPipe(self, tempf: Path, req_id: str, duration: float):
+        if self.sampling == RATE:
+            # the frames kept of image2, the ones dropped are not encoded
+            rate, num_frames, first, last = self.frames(duration)
+            stream = (
+                ffmpeg
+                .input(str(tempf))
+                .filter('fps', fps=rate)
+                .filter('select', 'lt(n,%d)' %(last - first + 1))
+            )
+        else:
+            stream, first, last, num_frames = self.selected(tempf, duration)
+        kwargs = {'vsync': 'vfr', 'vframes': last - first + 1}
+        try:
+            out, _ = (
+                stream
+                .output('pipe:', format='image2pipe', vcodec='mjpeg', **kwargs)
+                .run(capture_stdout=True, capture_stderr=True)
+            )
+        except ffmpeg.Error as e:
+            logging.error('FFmpeg (req_id: %s) std_err: %s' %(
+                req_id, e.stderr.decode()))
+            return None
+        snapshots = splitJpegs(out)
+        if self.sampling == RATE and len(snapshots) > last - first + 1:
+            # not trimmed by the filter graph, drop the ends as image2 does
+            logging.warning('%d frames for req_id=%s, %d expected' %(
+                len(snapshots), req_id, last - first + 1))
+            first, snapshots = dropEnds(snapshots)
+        images = []
+        for i, img_bytes in enumerate(snapshots):
+            images.append(('%s_%02d.jpg' %(req_id, first + i + 1), img_bytes))
+        logging.debug('%d of %d frames kept for req_id=%s' %(len(images), num_frames, req_id))
+        return images
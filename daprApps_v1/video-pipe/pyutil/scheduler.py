@@ -0,0 +1,289 @@
+import time
+import heapq
+import logging
+import itertools
+from collections import deque
+from threading import Thread, Condition
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+# prometheus
+import prometheus_client
+
+# request priorities
+HIGH = 1
+LOW = 2
+
+# policies
+FIFO = 'fifo'
+EDF = 'edf'
+# what edf does with requests that can no longer meet their deadline
+LATE_RUN = 'run'
+LATE_DEMOTE = 'demote'
+LATE_SHED = 'shed'
+
+# buckets (ms) of the slack of a request at completion (negative when late)
+def slackBuckets():
+    return [-60000.0, -30000.0, -10000.0, -5000.0, -2000.0, -1000.0, -500.0,
+        -200.0, -100.0, -50.0, -20.0, 0.0, 20.0, 50.0, 100.0, 200.0, 500.0,
+        1000.0, 2000.0, 5000.0, 10000.0, 30000.0, 60000.0]
+
+# PriorityScheduler hands the requests of a service to its worker processes.
+# Requests wait in the server process; each worker gets one request at a time
+# over its own pipe and blocks on the pipe while idle, so no one polls.
+#
+# fifo: requests wait in two fifo queues (priority 1 and 2). The next request
+# is the oldest high priority one, unless a low priority one has waited
+# aging_ms, or high_weight high priority requests went first in a row while
+# low priority ones waited (0 disables either rule).
+#
+# edf: the next request is the one with the earliest deadline, i.e. its
+# client_unix_ms plus the slo (ms) of its priority (requests of a priority
+# without slo go last). A request that can no longer make it (now plus the
+# mean service time is past its deadline) is run anyway, demoted behind every
+# request still on time, or shed, as late says. A demoted request goes first
+# once it waited aging_ms since its demotion, and at most demote_max of them
+# wait (the oldest ones are shed beyond that, 0 for no bound).
+#
+# With an slo set, the deadline misses and slack of every completed request
+# are counted under <name>_prio_<priority>_* in both policies.
+class PriorityScheduler:
+    def __init__(self, high_weight: int = 8, aging_ms: float = 0, name: str = None,
+            policy: str = FIFO, slo_ms: dict = None, late: str = LATE_DEMOTE, alpha: float = 0.2,
+            demote_max: int = 1000):
+        if policy not in [FIFO, EDF]:
+            raise ValueError('Unknown scheduling policy %s' %policy)
+        if late not in [LATE_RUN, LATE_DEMOTE, LATE_SHED]:
+            raise ValueError('Unknown late request handling %s' %late)
+        self.high_weight = high_weight
+        self.aging_ms = aging_ms
+        self.policy = policy
+        self.slo_ms = slo_ms if slo_ms is not None else {}
+        self.late = late
+        self.alpha = alpha
+        self.demote_max = demote_max
+        self.queues = {
+            HIGH: deque(),
+            LOW: deque(),
+        }
+        # edf: heap of (deadline, seq, request) on time, fifo of the demoted ones
+        # with the time of their demotion
+        self.edf = []
+        self.demoted = deque()
+        self.seq = itertools.count()
+        self.cond = Condition()
+        self.conns = []
+        self.idle = []
+        self.running = {}
+        self.workers = []
+        # high priority requests dispatched since the last low priority one
+        self.high_run = 0
+        # ewma of the service time (ms) of a request
+        self.service_ms = 0
+        self.misses = {}
+        self.slack = {}
+        self.shed = {}
+        self.demotions = {}
+        self.demotedLen = None
+        if name is not None:
+            if self.policy == EDF and self.late == LATE_DEMOTE:
+                self.demotedLen = prometheus_client.Gauge(
+                    '%s_demoted_pending' %name,
+                    'Number of demoted requests waiting',
+                    multiprocess_mode='livesum')
+            for prio in [HIGH, LOW]:
+                if self.slo_ms.get(prio, 0) <= 0:
+                    continue
+                self.misses[prio] = prometheus_client.Counter(
+                    '%s_prio_%d_deadline_miss_total' %(name, prio),
+                    'Number of priority %d requests completed after their deadline' %prio)
+                self.slack[prio] = prometheus_client.Histogram(
+                    '%s_prio_%d_slack_ms' %(name, prio),
+                    'Slack (ms) histogram of priority %d requests at completion, negative when late' %prio,
+                    buckets=slackBuckets())
+                self.shed[prio] = prometheus_client.Counter(
+                    '%s_prio_%d_shed_total' %(name, prio),
+                    'Number of priority %d requests dropped as they could not meet their deadline' %prio)
+                self.demotions[prio] = prometheus_client.Counter(
+                    '%s_prio_%d_demoted_total' %(name, prio),
+                    'Number of priority %d requests demoted as they could not meet their deadline' %prio)
+
+    # deadline returns the deadline (unix ms) of a request, None without slo
+    def deadline(self, priority: int, client_unix_ms: float):
+        slo = self.slo_ms.get(priority, 0)
+        if slo <= 0 or client_unix_ms is None:
+            return None
+        return client_unix_ms + slo
+
+    def submit(self, req, priority: int, client_unix_ms: float = None):
+        priority = HIGH if priority == HIGH else LOW
+        entry = (time.time()*1000, self.deadline(priority, client_unix_ms), priority, req)
+        with self.cond:
+            if self.policy == EDF:
+                deadline = entry[1] if entry[1] is not None else float('inf')
+                heapq.heappush(self.edf, (deadline, next(self.seq), entry))
+            else:
+                self.queues[priority].append(entry)
+            self.cond.notify()
+
+    def pending(self) -> int:
+        return len(self.queues[HIGH]) + len(self.queues[LOW]) + len(self.edf) + len(self.demoted)
+
+    # pick pops the next request entry, with cond held (None if all were shed)
+    def pick(self):
+        if self.policy == EDF:
+            return self.pickEdf()
+        high = self.queues[HIGH]
+        low = self.queues[LOW]
+        if len(low) == 0:
+            self.high_run = 0
+            return high.popleft()
+        if len(high) == 0 or \
+            (self.high_weight > 0 and self.high_run >= self.high_weight) or \
+            (self.aging_ms > 0 and time.time()*1000 - low[0][0] >= self.aging_ms):
+            self.high_run = 0
+            return low.popleft()
+        self.high_run += 1
+        return high.popleft()
+
+    def pickEdf(self):
+        now = time.time()*1000
+        if len(self.demoted) > 0 and self.aging_ms > 0 and now - self.demoted[0][0] >= self.aging_ms:
+            return self.popDemoted()
+        while len(self.edf) > 0:
+            deadline, _, entry = self.edf[0]
+            if self.late == LATE_RUN or now + self.service_ms <= deadline:
+                heapq.heappop(self.edf)
+                return entry
+            heapq.heappop(self.edf)
+            prio = entry[2]
+            if self.late == LATE_SHED:
+                self.drop(entry, deadline - now)
+            else:
+                if prio in self.demotions:
+                    self.demotions[prio].inc()
+                self.demoted.append((now, entry))
+                if self.demote_max > 0 and len(self.demoted) > self.demote_max:
+                    _, oldest = self.demoted.popleft()
+                    self.drop(oldest, oldest[1] - now)
+                self.observeDemoted()
+        if len(self.demoted) > 0:
+            return self.popDemoted()
+        return None
+
+    def popDemoted(self):
+        _, entry = self.demoted.popleft()
+        self.observeDemoted()
+        return entry
+
+    def observeDemoted(self):
+        if self.demotedLen is not None:
+            self.demotedLen.set(len(self.demoted))
+
+    # drop sheds a request slack_ms before its deadline
+    def drop(self, entry, slack_ms: float):
+        prio = entry[2]
+        if prio in self.shed:
+            self.shed[prio].inc()
+        logging.debug('Shed a priority %d request %.0f ms before its deadline' %(prio, slack_ms))
+
+    # completed accounts for the request a worker just finished
+    def completed(self, conn):
+        start_ms, entry = self.running.pop(conn)
+        now = time.time()*1000
+        self.service_ms += self.alpha * (now - start_ms - self.service_ms)
+        _, deadline, prio, _ = entry
+        if deadline is None or prio not in self.slack:
+            return
+        self.slack[prio].observe(deadline - now)
+        if now > deadline:
+            self.misses[prio].inc()
+
+    # start forks num_workers processes running target(worker_id=i, conn=conn),
+    # which is expected to call serve(conn, ...)
+    def start(self, num_workers: int, target):
+        for i in range(num_workers):
+            conn, worker_conn = Pipe()
+            p = Process(target=target, kwargs={
+                'worker_id': i,
+                'conn': worker_conn,
+            })
+            p.start()
+            # the parent end alone gets eof if the worker dies
+            worker_conn.close()
+            self.workers.append(p)
+            self.conns.append(conn)
+            self.idle.append(conn)
+        Thread(target=self.dispatch, daemon=True).start()
+        Thread(target=self.collect, daemon=True).start()
+
+    # requeue puts back a request that could not be handed to a worker, first
+    # in line among the requests of its priority (fifo)
+    def requeue(self, entry):
+        if self.policy == EDF:
+            deadline = entry[1] if entry[1] is not None else float('inf')
+            heapq.heappush(self.edf, (deadline, next(self.seq), entry))
+        else:
+            self.queues[entry[2]].appendleft(entry)
+
+    # dispatch never exits: a request whose worker died is requeued for the
+    # others, and the worker is not used again
+    def dispatch(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.idle) > 0 and self.pending() > 0)
+                entry = self.pick()
+                if entry is None:
+                    continue
+                conn = self.idle.pop()
+                self.running[conn] = (time.time()*1000, entry)
+            try:
+                conn.send(entry[3])
+            except OSError as e:
+                logging.error('Failed to send a request to a worker, requeued: %s' %str(e))
+                with self.cond:
+                    self.running.pop(conn, None)
+                    self.requeue(entry)
+                    self.cond.notify()
+            except Exception as e:
+                # e.g. a request that cannot be pickled, the worker is still fine
+                logging.error('Failed to send a request to a worker, dropped: %s' %str(e))
+                with self.cond:
+                    self.running.pop(conn, None)
+                    self.idle.append(conn)
+                    self.cond.notify()
+
+    # collect puts workers back to idle as they finish their requests, and
+    # forgets the workers that exited
+    def collect(self):
+        conns = list(self.conns)
+        while len(conns) > 0:
+            for conn in wait(conns):
+                try:
+                    conn.recv()
+                except (EOFError, OSError):
+                    conns.remove(conn)
+                    with self.cond:
+                        if conn in self.idle:
+                            self.idle.remove(conn)
+                        lost = self.running.pop(conn, None)
+                    logging.error('A worker exited%s, %d workers left' %(
+                        ' while running a request' if lost is not None else '', len(conns)))
+                    conn.close()
+                    continue
+                with self.cond:
+                    self.completed(conn)
+                    self.idle.append(conn)
+                    self.cond.notify()
+
+# serve runs in a worker process, calling handle(req) for every request of conn
+def serve(conn, handle):
+    while True:
+        try:
+            req = conn.recv()
+        except EOFError:
+            return
+        try:
+            handle(req)
+        except Exception as e:
+            logging.error('Failed to handle request: %s' %str(e))
+        conn.send(True)
@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import statistics
+from pathlib import Path
+import ffmpeg
+
+# scene extraction latency and cpu per video duration, for each sampling of
+# the scene stage (rate: full decode, seek: input seek per snapshot, keyframe:
+# seek snapped to the previous keyframe). Longer videos are made by looping
+# the sample videos (stream copy), results go to stdout as a table and a text
+# chart of ms per video second, and optionally to a csv, e.g.
+#   python3 bench_sampling.py --loops 1,4,16,64 --csv sampling.csv
+# Needs ffmpeg and the python requirements of video-scene.
+pipe_path = Path(__file__).parent.resolve() / '..'
+sys.path.append(str(pipe_path))
+from pyutil import scene
+
+logging.basicConfig(level=logging.INFO)
+parser = argparse.ArgumentParser()
+parser.add_argument('--video-dir', dest='video_dir', type=str,
+    default=str(Path(__file__).parent.resolve() / '..' / '..' / 'test' / 'video'))
+parser.add_argument('--videos', dest='videos', type=str, default='',
+    help='comma separated sample videos (default: all the videos in --video-dir, '
+        'files without a video stream are skipped)')
+parser.add_argument('--loops', dest='loops', type=str, default='1,4,16',
+    help='comma separated number of times each video is looped')
+parser.add_argument('--samplings', dest='samplings', type=str, default='rate,seek,keyframe')
+parser.add_argument('--output', dest='output', type=str, default=scene.IMAGE2,
+    help='image2 (default of k8s/deployment.yaml) or image2pipe')
+# defaults of k8s/deployment.yaml
+parser.add_argument('--interval', dest='interval', type=int, default=10)
+parser.add_argument('--max-scenes', dest='max_scenes', type=int, default=3)
+parser.add_argument('--reps', dest='reps', type=int, default=3,
+    help='runs per video and sampling (medians are reported)')
+parser.add_argument('--width', dest='width', type=int, default=60,
+    help='width of the chart bars')
+parser.add_argument('--csv', dest='csv', type=str, default='',
+    help='also write every run to this csv file')
+args = parser.parse_args()
+
+def childCpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+# probeDuration returns the duration (s) of a video, None (logged) for files
+# ffprobe cannot read or without a video stream, e.g. empty or audio only
+def probeDuration(video: Path):
+    try:
+        probe = ffmpeg.probe(str(video))
+    except ffmpeg.Error as e:
+        logging.info('Skip %s, ffprobe failed: %s' %(video.name, e.stderr.decode('utf-8', 'replace').strip()))
+        return None
+    if not any(stream['codec_type'] == 'video' for stream in probe['streams']):
+        logging.info('Skip %s, no video stream' %video.name)
+        return None
+    if 'duration' not in probe['format']:
+        logging.info('Skip %s, unknown duration' %video.name)
+        return None
+    return float(probe['format']['duration'])
+
+def loopVideo(src: Path, loops: int, work_dir: Path) -> Path:
+    if loops <= 1:
+        return src
+    dst = work_dir / ('%dx_%s' %(loops, src.name))
+    (
+        ffmpeg
+        .input(str(src), stream_loop=loops - 1)
+        .output(str(dst), c='copy')
+        .overwrite_output()
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return dst
+
+def snapshot(stage: scene.SceneStage, video: Path, duration: float, work_dir: Path):
+    # the stage removes its input, so it gets a copy
+    tempf = work_dir / ('in_%s' %video.name)
+    shutil.copyfile(str(video), str(tempf))
+    cpu = childCpu()
+    epoch = time.time()*1000
+    if stage.output == scene.IMAGE2PIPE:
+        images = stage.snapshotPipe(tempf, 'bench', duration)
+    else:
+        images = stage.snapshotFiles(tempf, work_dir / 'images', 'bench', duration)
+    lat = time.time()*1000 - epoch
+    cpu = childCpu() - cpu
+    if os.path.exists(str(tempf)):
+        os.remove(str(tempf))
+    if images is None:
+        raise RuntimeError('ffmpeg failed on %s' %video.name)
+    return lat, cpu, len(images)
+
+video_dir = Path(args.video_dir)
+if args.videos != '':
+    videos = [video_dir / v for v in args.videos.split(',')]
+else:
+    videos = sorted(video_dir / v for v in os.listdir(str(video_dir)))
+videos = [v for v in videos if probeDuration(v) is not None]
+loops = [int(l) for l in args.loops.split(',')]
+samplings = args.samplings.split(',')
+# the stage registers its prometheus metrics once, samplings are switched in place
+stage = scene.SceneStage(
+    image_store='',
+    pubsub='',
+    face_topic='',
+    interval=args.interval,
+    max_scenes=args.max_scenes,
+    output=args.output,
+)
+
+work_dir = Path(tempfile.mkdtemp(prefix='bench_sampling_'))
+runs = []
+results = []
+try:
+    for v in videos:
+        for l in loops:
+            video = loopVideo(v, l, work_dir)
+            duration = probeDuration(video)
+            if duration is None:
+                if video != v:
+                    os.remove(str(video))
+                continue
+            for s in samplings:
+                stage.sampling = s
+                lats = []
+                cpus = []
+                for r in range(0, args.reps):
+                    lat, cpu, num_images = snapshot(stage, video, duration, work_dir)
+                    lats.append(lat)
+                    cpus.append(cpu)
+                    runs.append((v.name, l, duration, s, r, lat, cpu, num_images))
+                results.append({
+                    'video': v.name,
+                    'loops': l,
+                    'duration': duration,
+                    'sampling': s,
+                    'lat_ms': statistics.median(lats),
+                    'cpu_s': statistics.median(cpus),
+                    'images': num_images,
+                })
+                logging.info('%s x%d (%.1fs) %s: %.0f ms, %.2f cpu s, %d images' %(
+                    v.name, l, duration, s, results[-1]['lat_ms'], results[-1]['cpu_s'], num_images))
+            if video != v:
+                os.remove(str(video))
+finally:
+    shutil.rmtree(str(work_dir), ignore_errors=True)
+
+if args.csv != '':
+    with open(args.csv, 'w+') as f:
+        f.write('video,loops,duration_s,sampling,rep,lat_ms,cpu_s,images\n')
+        for run in runs:
+            f.write('%s,%d,%.3f,%s,%d,%.1f,%.3f,%d\n' %run)
+
+# table, then ms per video second against duration for every sampling
+results.sort(key=lambda x: (x['duration'], x['video']))
+print('\n%-32s %10s %-9s %10s %12s %8s %7s' %(
+    'video', 'duration_s', 'sampling', 'lat_ms', 'ms_per_vid_s', 'cpu_s', 'images'))
+for x in results:
+    print('%-32s %10.1f %-9s %10.0f %12.1f %8.2f %7d' %(
+        '%s x%d' %(x['video'], x['loops']), x['duration'], x['sampling'],
+        x['lat_ms'], x['lat_ms'] / x['duration'], x['cpu_s'], x['images']))
+max_ms = max([x['lat_ms'] / x['duration'] for x in results] + [1e-6])
+for s in samplings:
+    print('\n%s: ms per video second by duration (full bar = %.1f ms)' %(s, max_ms))
+    for x in results:
+        if x['sampling'] != s:
+            continue
+        ms = x['lat_ms'] / x['duration']
+        print('%8.1fs |%s %.1f' %(x['duration'], '#' * int(round(ms / max_ms * args.width)), ms))
@@ -0,0 +1,150 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+# unit tests of the snapshot selection of the scene stage, e.g.
+#   python3 -m unittest test_scene.py
+# Needs the python requirements of video-scene, the snapshot tests ffmpeg too.
+pipe_path = Path(__file__).parent.resolve() / '..'
+sys.path.append(str(pipe_path))
+from pyutil import scene
+
+video_dir = Path(__file__).parent.resolve() / '..' / '..' / 'test' / 'video'
+
+def jpeg(payload: bytes) -> bytes:
+    return scene.JPEG_SOI + payload + scene.JPEG_EOI
+
+class TestSplitJpegs(unittest.TestCase):
+    def test_split(self):
+        images = [jpeg(b'\x00\x01'), jpeg(b'\xff\x00\x02'), jpeg(b'')]
+        self.assertEqual(scene.splitJpegs(b''.join(images)), images)
+
+    def test_empty(self):
+        self.assertEqual(scene.splitJpegs(b''), [])
+
+    def test_truncated(self):
+        images = [jpeg(b'\x01'), jpeg(b'\x02')]
+        buf = b''.join(images) + scene.JPEG_SOI + b'\x03'
+        self.assertEqual(scene.splitJpegs(buf), images)
+
+class TestDropEnds(unittest.TestCase):
+    def test_drop(self):
+        self.assertEqual(scene.dropEnds([]), (0, []))
+        self.assertEqual(scene.dropEnds(['a']), (0, ['a']))
+        self.assertEqual(scene.dropEnds(['a', 'b']), (0, ['a', 'b']))
+        self.assertEqual(scene.dropEnds(['a', 'b', 'c']), (1, ['b']))
+        self.assertEqual(scene.dropEnds(['a', 'b', 'c', 'd']), (1, ['b', 'c']))
+
+class TestFrames(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the stage registers its prometheus metrics, so there is one per process
+        cls.stage = scene.SceneStage(
+            image_store='',
+            pubsub='',
+            face_topic='',
+            interval=10,
+            max_scenes=3,
+        )
+
+    def setUp(self):
+        self.stage.sampling = scene.RATE
+        self.stage.output = scene.IMAGE2
+
+    def test_frames(self):
+        # short videos are sampled at max_scenes / duration, long ones every interval s
+        for duration, num_frames, first, last in [
+                (1, 5, 1, 3),
+                (5, 5, 1, 3),
+                (30, 5, 1, 3),
+                (66, 8, 1, 6),
+                (0.4, 5, 1, 3),
+                (5.759, 5, 1, 3)]:
+            rate, n, f, l = self.stage.frames(duration)
+            self.assertEqual((n, f, l), (num_frames, first, last), duration)
+            # the frames kept are within the video
+            self.assertLess((l - f) / rate, duration)
+
+    def test_few_frames(self):
+        self.stage.max_scenes = 1
+        try:
+            self.assertEqual(self.stage.frames(5)[1:], (3, 1, 1))
+            # less than a frame per interval, the two images are kept
+            self.stage.max_scenes = 0
+            self.assertEqual(self.stage.frames(5)[1:], (2, 0, 1))
+        finally:
+            self.stage.max_scenes = 3
+
+    # snapshotIds returns the sorted image ids of src taken by the stage
+    def snapshotIds(self, work_dir: Path, src: Path, duration: float) -> list:
+        # the stage removes its input, so it gets a copy
+        tempf = work_dir / ('in_%s' %src.name)
+        shutil.copyfile(str(src), str(tempf))
+        if self.stage.output == scene.IMAGE2PIPE:
+            images = self.stage.snapshotPipe(tempf, 'test', duration)
+        else:
+            images = self.stage.snapshotFiles(tempf, work_dir / 'images', 'test', duration)
+        if os.path.exists(str(tempf)):
+            os.remove(str(tempf))
+        self.assertIsNotNone(images)
+        return sorted(img_id for img_id, _ in images)
+
+    # image2pipe keeps the same images as image2
+    @unittest.skipUnless(shutil.which('ffmpeg') is not None and shutil.which('ffprobe') is not None,
+        'needs ffmpeg')
+    def test_pipe_matches_files(self):
+        import ffmpeg
+        work_dir = Path(tempfile.mkdtemp(prefix='test_scene_'))
+        try:
+            for name in ['sample-5s.mp4', 'SampleVideo_720x480_1mb.mp4']:
+                src = video_dir / name
+                duration = float(ffmpeg.probe(str(src))['format']['duration'])
+                for interval, max_scenes in [(10, 3), (1, 3), (10, 1)]:
+                    self.stage.interval = interval
+                    self.stage.max_scenes = max_scenes
+                    snapshots = {}
+                    for output in [scene.IMAGE2, scene.IMAGE2PIPE]:
+                        self.stage.output = output
+                        snapshots[output] = self.snapshotIds(work_dir, src, duration)
+                    self.assertGreater(len(snapshots[scene.IMAGE2]), 0)
+                    self.assertEqual(snapshots[scene.IMAGE2PIPE], snapshots[scene.IMAGE2],
+                        '%s interval=%d max_scenes=%d' %(name, interval, max_scenes))
+        finally:
+            self.stage.interval = 10
+            self.stage.max_scenes = 3
+            shutil.rmtree(str(work_dir), ignore_errors=True)
+
+    # seeks keep as many images as the rate sampling, with the same ids
+    @unittest.skipUnless(shutil.which('ffmpeg') is not None and shutil.which('ffprobe') is not None,
+        'needs ffmpeg')
+    def test_seek_matches_rate(self):
+        import ffmpeg
+        work_dir = Path(tempfile.mkdtemp(prefix='test_scene_'))
+        try:
+            for name in ['sample-5s.mp4', 'SampleVideo_720x480_1mb.mp4']:
+                src = video_dir / name
+                duration = float(ffmpeg.probe(str(src))['format']['duration'])
+                for interval, max_scenes in [(10, 3), (1, 3)]:
+                    self.stage.interval = interval
+                    self.stage.max_scenes = max_scenes
+                    self.stage.output = scene.IMAGE2
+                    rate_ids = self.snapshotIds(work_dir, src, duration)
+                    self.assertGreater(len(rate_ids), 1)
+                    for sampling in [scene.SEEK, scene.KEYFRAME]:
+                        self.stage.sampling = sampling
+                        for output in [scene.IMAGE2, scene.IMAGE2PIPE]:
+                            self.stage.output = output
+                            self.assertEqual(self.snapshotIds(work_dir, src, duration), rate_ids,
+                                '%s %s %s interval=%d max_scenes=%d' %(
+                                    name, sampling, output, interval, max_scenes))
+                    self.stage.sampling = scene.RATE
+        finally:
+            self.stage.interval = 10
+            self.stage.max_scenes = 3
+            shutil.rmtree(str(work_dir), ignore_errors=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,10 +4,7 @@ import json
 import base64
 import logging
 import time
-import queue
 from pathlib import Path
-# worker pool
-from multiprocessing import Queue, Process
 # dapr
 from dapr.clients import DaprClient
 from dapr.ext.grpc import App, InvokeMethodRequest, InvokeMethodResponse
@@ -24,22 +21,52 @@ from pathlib import Path
 util_path = Path(__file__).parent.resolve() / '..' / 'pyutil'
 sys.path.append(str(util_path))
 import pyutil
+from pyutil import daprpool
+from pyutil import scheduler
+from pyutil import scene
 
 warnings.filterwarnings("ignore")
 # global variables
 serviceAddress = int(os.getenv('ADDRESS', '5005'))
 promAddress    = int(os.getenv('PROM_ADDRESS', '8084'))
+daprPoolSize   = int(os.getenv('DAPR_POOL_SIZE', '2'))
 # pubsub
 videoPipePubsub = os.getenv('VIDEO_PIPE_PUBSUB', 'vpipe-events')
 metaTopic       = os.getenv('META_TOPIC', 'meta')
 sceneTopic      = os.getenv('SCENE_TOPIC', 'scene')
+faceTopic       = os.getenv('FACE_TOPIC', 'face')
 # state store
 videoStore      = os.getenv('VIDEO_STORE', 'vpipe-video-store')
+imageStore      = os.getenv('IMAGE_STORE', 'vpipe-image-store')
+# fused mode: the worker runs the scene stage right after the meta stage, on
+# the same temp file, instead of publishing to the scene topic
+fuseScene       = os.getenv('FUSE_SCENE', 'false').lower() == 'true'
+# scene configuration (fused mode only)
+sceneInterval   = int(os.getenv('SCENE_INTERVAL', '5'))
+maxScenes       = int(os.getenv('MAX_SCENES', '4'))
+# image2 (snapshots written to a temp dir) or image2pipe (read from ffmpeg
+# stdout, first and last frames never encoded)
+sceneOutput     = os.getenv('SCENE_OUTPUT', 'image2')
+# rate (decode the whole video at the snapshot rate), seek (seek to every
+# snapshot timestamp) or keyframe (seek, snapped to the previous keyframe)
+sceneSampling   = os.getenv('SCENE_SAMPLING', 'rate')
 # worker
 numWorkers      = int(os.getenv('WORKERS', '10'))
 logLevel        = os.getenv('LOG_LEVEL', 'info')
-maxTimeout      = float(os.getenv('MAX_TIMEOUT', '0.1'))
-idleTime   = float(os.getenv('IDLE_TIME', '0.001'))
+# low priority requests go first after SCHED_HIGH_WEIGHT high priority ones in
+# a row, or once they waited SCHED_AGING_MS (0 disables either)
+schedHighWeight = int(os.getenv('SCHED_HIGH_WEIGHT', '8'))
+schedAgingMs    = float(os.getenv('SCHED_AGING_MS', '5000'))
+# fifo or edf (earliest deadline first, deadline = client_unix_ms + slo of the
+# priority), and what edf does with requests that cannot meet their deadline
+# (run, demote or shed). Slos of 0 set no deadline.
+schedPolicy     = os.getenv('SCHED_POLICY', 'fifo')
+schedLate       = os.getenv('SCHED_LATE', 'demote')
+# edf demoted requests go first once they waited SCHED_AGING_MS, at most
+# SCHED_DEMOTE_MAX of them wait (the oldest are shed beyond, 0 for no bound)
+schedDemoteMax  = int(os.getenv('SCHED_DEMOTE_MAX', '1000'))
+sloHighMs       = float(os.getenv('SLO_PRIO_1_MS', '0'))
+sloLowMs        = float(os.getenv('SLO_PRIO_2_MS', '0'))
 
 # multi-process prometheus dir (must exist and be empty)
 # todo: create this dir in dockerfile and set the env in deploy yaml
@@ -81,11 +108,29 @@ videoStoreLat = prometheus_client.Histogram(
     'Latency (ms) histogram of reading video-store (kvs/db) in video-meta',
     buckets=pyutil.latBuckets()
 )
+# scene stage of the fused mode, with the video_scene_* metrics of video-scene
+sceneStage = None
+if fuseScene:
+    sceneStage = scene.SceneStage(
+        image_store=imageStore,
+        pubsub=videoPipePubsub,
+        face_topic=faceTopic,
+        interval=sceneInterval,
+        max_scenes=maxScenes,
+        output=sceneOutput,
+        sampling=sceneSampling,
+    )
 
 MAX_PAYLOAD = 64 * 1024 * 1024 # 64MB
+# warm dapr clients shared by all handlers of this process
+daprPool = daprpool.DaprClientPool(
+    name='video_meta',
+    max_size=daprPoolSize,
+    max_grpc_message_length=MAX_PAYLOAD,
+)
 
 # meta extraction
-def extractMeta(data, video_dir: Path):
+def extractMeta(data, video_dir: Path, image_dir: Path = None):
     global MAX_PAYLOAD
     # dt = datetime.now(timezone.utc)
     video_id = data['video_id']
@@ -98,7 +143,7 @@ def extractMeta(data, video_dir: Path):
     epoch = time.time()*1000
     serv_lat = epoch - send_unix_ms 
     tempf = video_dir / video_id
-    with DaprClient(max_grpc_message_length=MAX_PAYLOAD) as d:
+    with daprPool.client() as d:
         try:
             # logging.info('%s width=%d' %(data['data_id'], data['width']))
             video_b64 = d.get_state(
@@ -129,8 +174,8 @@ def extractMeta(data, video_dir: Path):
             logging.error('ffprobe stdout: %s, stderr: %s' %(e.stdout, e.stderr))
             return False
             # raise RuntimeError('ffprobe stdout: %s, stderr: %s' %(e.stdout, e.stderr))
-        # remove temp files
-        if os.path.exists(str(tempf)):
+        # remove temp files, unless the scene stage reads it
+        if sceneStage is None and os.path.exists(str(tempf)):
             os.remove(str(tempf))
         # get metadata
         duration = float(probe['format']['duration'])
@@ -152,12 +197,13 @@ def extractMeta(data, video_dir: Path):
         # data['trace']['meta_serv_lat'] = time.time() * 1000 - epoch
         # data['trace']['meta_store_lat'] = store_lat
         
-        resp = d.publish_event(
-            pubsub_name=videoPipePubsub,
-            topic_name=sceneTopic,
-            data=json.dumps(data),
-            data_content_type='application/json',
-        )
+        if sceneStage is None:
+            resp = d.publish_event(
+                pubsub_name=videoPipePubsub,
+                topic_name=sceneTopic,
+                data=json.dumps(data),
+                data_content_type='application/json',
+            )
         # update prom metrics
         cur_unix_ms = time.time() * 1000
         serv_lat += cur_unix_ms - epoch
@@ -169,104 +215,61 @@ def extractMeta(data, video_dir: Path):
         logging.debug('Processed req_id=%s, video_id=%s, priority=%d, serv_lat=%d, store_lat=%d' %(
             req_id, video_id, data['priority'], serv_lat, store_lat,
         ))
-        return True
+        if sceneStage is None:
+            return True
+        # fused scene stage, served from now on without store read nor queueing
+        if is_high_prio:
+            sceneStage.highPriReqTotal.inc()
+        else:
+            sceneStage.lowPriReqTotal.inc()
+        return sceneStage.run(d, data, tempf, image_dir, 0, cur_unix_ms)
 
-# worker function
-def metaWorker(
-    worker_id: int,
-    high_prio_queue: Queue,
-    low_prio_queue: Queue,
-    max_timeout: float = maxTimeout,
-    idle_time: float = idleTime,
-    interval: float=60,
-    ):
+# worker process
+def metaWorker(worker_id: int, conn):
     video_dir = Path('/tmp') / str(worker_id) / 'video'
+    image_dir = Path('/tmp') / str(worker_id) / 'image'
     os.makedirs(str(video_dir), exist_ok=True)
-    low_prio_ctr = 0
-    low_prio_rps = 0
-    stats_ts = time.time()
-    ts_empty = True
-    timeout = 0.05
-    while True:
-        # inifinite loop processing both high & low priority requests
-        high_prio_empty = False
-        low_prio_empty = False
-        # process high priority requests as long as there is any
-        while True:
-            epoch = time.time()
-            # todo: compute propoer timeout
-            if epoch - stats_ts >= interval:
-                rps = low_prio_ctr / (epoch - stats_ts)
-                if ts_empty:
-                    low_prio_rps = rps
-                    ts_empty = False
-                else:
-                    low_prio_rps = rps * 0.4 + low_prio_rps * 0.6
-                if rps > 0:
-                    timeout = min(idle_time / low_prio_rps, max_timeout)
-                else:
-                    timeout = max_timeout
-                logging.debug('low_prio_rps = %.3f, timeout set to %.3fs' %(
-                    low_prio_rps, timeout))
-                low_prio_ctr = 0
-                stats_ts = epoch
-            # actual work
-            try:
-                # req = high_prio_queue.get(block=False)
-                req = high_prio_queue.get(block=True, timeout=timeout)
-                extractMeta(
-                    data=req,
-                    video_dir=video_dir)
-                low_prio_ctr += 1
-            except queue.Empty:
-                high_prio_empty = True
-                break
-        # process low prioty requests when no high priority requests exist
-        try:
-            req = low_prio_queue.get(block=False)
-            extractMeta(
-                data=req,
-                video_dir=video_dir)
-        except queue.Empty:
-            low_prio_empty = True
-        # wait if no req is pending
-        if high_prio_empty and low_prio_empty:
-            time.sleep(0.01)
+    if sceneStage is not None:
+        os.makedirs(str(image_dir), exist_ok=True)
+    scheduler.serve(conn, lambda req: extractMeta(
+        data=req,
+        video_dir=video_dir,
+        image_dir=image_dir))
 
-workerPool = [] # list of worker processes
-highPrioQueue = Queue()
-lowPrioQueue = Queue()
+# priority queues of the requests, dispatched to the worker processes
+reqScheduler = scheduler.PriorityScheduler(
+    high_weight=schedHighWeight,
+    aging_ms=schedAgingMs,
+    name='video_meta',
+    policy=schedPolicy,
+    slo_ms={
+        scheduler.HIGH: sloHighMs,
+        scheduler.LOW: sloLowMs,
+    },
+    late=schedLate,
+    demote_max=schedDemoteMax,
+)
 
 app = App()
 # upload a new video
 @app.subscribe(pubsub_name=videoPipePubsub, topic=metaTopic)
 def videoMeta(event) -> None:
-    # request queues
-    global highPrioQueue
-    global lowPrioQueue
     data = json.loads(event.Data())
     if data['priority'] == 1:
         # high priority requests
         highPriReqTotal.inc()
-        highPrioQueue.put(data)
+        reqScheduler.submit(data, scheduler.HIGH, data['send_unix_ms'])
     elif data['priority'] == 2:
         lowPriReqTotal.inc()
         # low priority requests
-        lowPrioQueue.put(data)
+        reqScheduler.submit(data, scheduler.LOW, data['send_unix_ms'])
 
 if __name__ == '__main__':
     # create multiprocess registry and start prometheus service
     registry = CollectorRegistry()
     multiprocess.MultiProcessCollector(registry)
     prometheus_client.start_http_server(promAddress, registry=registry)
-    # worker pool
-    for i in range(0, numWorkers):
-        worker_p = Process(target=metaWorker, kwargs={
-            'worker_id': i,
-            'high_prio_queue': highPrioQueue,
-            'low_prio_queue': lowPrioQueue,
-        })
-        worker_p.start()  # Launch reader_p() as another proc
-        workerPool.append(worker_p)
+    # worker processes
+    reqScheduler.start(numWorkers, metaWorker)
     # start the service
     app.run(serviceAddress)
\ No newline at end of file
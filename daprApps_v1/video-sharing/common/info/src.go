@@ -67,6 +67,8 @@ type RateReq struct {
 // view a video
 type ViewReq struct {
 	VideoId string `json:"video_id"`
+	// number of views to add (batched by upstream), 0 counts as a single view
+	Count int64 `json:"count"`
 	SendUnixMilli int64 `json:"send_unix_ms"`
 }
 // genenral response
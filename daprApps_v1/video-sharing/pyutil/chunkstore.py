@@ -0,0 +1,105 @@
+import json
+# dapr
+from dapr.clients.grpc._state import StateItem
+
+# A chunked video is stored as fixed-size chunks under <key>#<idx> plus a
+# <key>#manifest entry holding the total size and chunk size, so a byte range
+# only needs the chunks it covers. Unchunked videos live under <key> itself.
+
+def manifestKey(key: str) -> str:
+    return '%s#manifest' %key
+
+def chunkKey(key: str, idx: int) -> str:
+    return '%s#%d' %(key, idx)
+
+# saveChunked writes data as chunks (group_size chunks per bulk request)
+# and writes the manifest last, so readers never see missing chunks
+def saveChunked(d, store_name: str, key: str, data: bytes, chunk_size: int,
+        options=None, group_size: int = 8):
+    view = memoryview(data)
+    num_chunks = (len(view) + chunk_size - 1) // chunk_size
+    for g in range(0, num_chunks, group_size):
+        items = []
+        for i in range(g, min(g + group_size, num_chunks)):
+            items.append(StateItem(
+                key=chunkKey(key, i),
+                value=view[i*chunk_size:(i+1)*chunk_size].tobytes(),
+                options=options,
+            ))
+        d.save_bulk_state(
+            store_name=store_name,
+            states=items,
+        )
+    manifest = {
+        'size': len(view),
+        'chunk_size': chunk_size,
+        'chunks': num_chunks,
+    }
+    d.save_state(
+        store_name=store_name,
+        key=manifestKey(key),
+        value=json.dumps(manifest),
+        options=options,
+    )
+
+def readChunks(d, store_name: str, key: str, first: int, last: int) -> bytes:
+    keys = [chunkKey(key, i) for i in range(first, last + 1)]
+    items = d.get_bulk_state(
+        store_name=store_name,
+        keys=keys).items
+    chunks = {}
+    for it in items:
+        chunks[it.key] = it.data
+    for k in keys:
+        if k not in chunks or len(chunks[k]) == 0:
+            raise RuntimeError('Missing chunk %s in %s' %(k, store_name))
+    return b''.join([chunks[k] for k in keys])
+
+def parseManifest(data):
+    if len(data) == 0:
+        return None
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+# readAll returns the whole video, whichever layout it is stored in,
+# with a single store round trip for unchunked videos
+def readAll(d, store_name: str, key: str) -> bytes:
+    items = d.get_bulk_state(
+        store_name=store_name,
+        keys=[key, manifestKey(key)]).items
+    found = {}
+    for it in items:
+        found[it.key] = it.data
+    if len(found.get(key, b'')) > 0:
+        return found[key]
+    manifest = parseManifest(found.get(manifestKey(key), b''))
+    if manifest is None or manifest['chunks'] == 0:
+        return b''
+    return readChunks(d, store_name, key, 0, manifest['chunks'] - 1)
+
+# readRange returns bytes [start, end] (inclusive, end=None for the rest) and
+# the total size; only the covering chunks are fetched for chunked videos
+def readRange(d, store_name: str, key: str, start: int, end: int = None):
+    manifest = parseManifest(d.get_state(
+        store_name=store_name,
+        key=manifestKey(key)).data)
+    if manifest is None:
+        data = d.get_state(
+            store_name=store_name,
+            key=key).data
+        size = len(data)
+        if end is None or end >= size:
+            end = size - 1
+        return data[start:end+1], size
+    size = manifest['size']
+    chunk_size = manifest['chunk_size']
+    if end is None or end >= size:
+        end = size - 1
+    if start > end:
+        return b'', size
+    first = start // chunk_size
+    last = end // chunk_size
+    data = readChunks(d, store_name, key, first, last)
+    offset = start - first * chunk_size
+    return data[offset:offset + end - start + 1], size
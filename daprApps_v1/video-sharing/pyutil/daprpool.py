@@ -0,0 +1,105 @@
+import os
+import time
+import logging
+from threading import Condition
+from contextlib import contextmanager
+# dapr
+import grpc
+from dapr.clients import DaprClient
+# prometheus
+import prometheus_client
+
+# buckets (ms) of the time spent waiting for a pooled client
+def poolWaitBuckets():
+    return [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0,
+        100.0, 250.0, 500.0, 1000.0, 2500.0, 5000.0, 10000.0]
+
+# DaprClientPool keeps warm DaprClients (and their grpc channels) per process.
+# A client is lent to one thread at a time; clients are never shared with
+# forked/spawned children, which build their own on first use. A borrower
+# waits (up to timeout s) only while max_size clients are lent out, and is
+# woken by every release, so a broken client is replaced by the next waiter.
+class DaprClientPool:
+    def __init__(self, name: str, max_size: int = 20, timeout: float = None, **client_kwargs):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.client_kwargs = client_kwargs
+        self.hits = prometheus_client.Counter(
+            '%s_dapr_pool_hit_total' %name,
+            'Number of dapr client borrows served by a warm pooled client')
+        self.misses = prometheus_client.Counter(
+            '%s_dapr_pool_miss_total' %name,
+            'Number of dapr client borrows that created a new client')
+        self.waitLat = prometheus_client.Histogram(
+            '%s_dapr_pool_wait_lat_hist' %name,
+            'Latency (ms) histogram of waiting for a pooled dapr client',
+            buckets=poolWaitBuckets())
+        self.cond = Condition()
+        self.reset()
+
+    # reset drops the clients inherited from the parent process
+    def reset(self):
+        self.pid = os.getpid()
+        self.idle = []
+        self.created = 0
+
+    def acquire(self):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self.cond:
+            if self.pid != os.getpid():
+                self.reset()
+            while True:
+                if len(self.idle) > 0:
+                    return self.idle.pop(), True
+                if self.created < self.max_size:
+                    self.created += 1
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise RuntimeError('No dapr client available after %s s (pool size %d)' %(
+                        str(self.timeout), self.max_size))
+                self.cond.wait(remaining)
+        try:
+            return DaprClient(**self.client_kwargs), False
+        except Exception:
+            with self.cond:
+                self.created -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, d: DaprClient, broken: bool = False):
+        with self.cond:
+            stale = self.pid != os.getpid()
+            if not stale:
+                if broken:
+                    self.created -= 1
+                else:
+                    self.idle.append(d)
+                self.cond.notify()
+        if broken and not stale:
+            try:
+                d.close()
+            except Exception as e:
+                logging.debug('Failed to close dapr client: %s' %str(e))
+
+    # client lends a pooled DaprClient for the duration of a with block
+    @contextmanager
+    def client(self):
+        epoch = time.time()*1000
+        d, hit = self.acquire()
+        self.waitLat.observe(time.time()*1000 - epoch)
+        if hit:
+            self.hits.inc()
+        else:
+            self.misses.inc()
+        try:
+            yield d
+        except grpc.RpcError:
+            # the channel may be unusable, replace it on next borrow
+            self.release(d, broken=True)
+            raise
+        except BaseException:
+            self.release(d)
+            raise
+        else:
+            self.release(d)
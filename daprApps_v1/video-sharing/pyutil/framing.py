@@ -0,0 +1,24 @@
+import json
+import struct
+
+# binary framing used by clients that do not want base64 media in json bodies
+# layout: 4-byte big-endian header length | json header | raw payload
+BINARY_CONTENT_TYPE = 'application/x-video-frame'
+headerLen = struct.Struct('>I')
+
+# pack prepends a json header to the raw payload
+def pack(header: dict, payload: bytes = b'') -> bytes:
+    hdr = json.dumps(header).encode('utf-8')
+    return b''.join([headerLen.pack(len(hdr)), hdr, payload])
+
+# unpack returns the json header and a zero-copy view of the payload
+def unpack(data: bytes):
+    view = memoryview(data)
+    if len(view) < headerLen.size:
+        raise ValueError('Truncated frame: %d bytes' %len(view))
+    hdr_len = headerLen.unpack_from(view, 0)[0]
+    hdr_end = headerLen.size + hdr_len
+    if len(view) < hdr_end:
+        raise ValueError('Truncated frame header: %d < %d' %(len(view), hdr_end))
+    header = json.loads(view[headerLen.size:hdr_end].tobytes().decode('utf-8'))
+    return header, view[hdr_end:]
@@ -0,0 +1,77 @@
+import json
+import time
+import logging
+# dapr
+from dapr.clients.grpc._state import StateOptions, Consistency, Concurrency
+
+# claim results
+CLAIMED = 'claimed'
+DONE = 'done'
+BUSY = 'busy'
+
+# JobLedger records which jobs are running or done in a dapr state store, so
+# redelivered events are not processed twice. A claim is a first-write save,
+# which fails if the key exists, and expires after claim_ttl_s in case its
+# holder dies. Done marks expire after done_ttl_s.
+class JobLedger:
+    def __init__(self, dapr_pool, store_name: str, claim_ttl_s: int, done_ttl_s: int):
+        self.dapr_pool = dapr_pool
+        self.store_name = store_name
+        self.claim_ttl = claim_ttl_s
+        self.done_ttl = done_ttl_s
+
+    def save(self, d, key: str, state: str, ttl: int, options=None):
+        d.save_state(
+            store_name=self.store_name,
+            key=key,
+            value=json.dumps({
+                'state': state,
+                'unix_ms': int(time.time()*1000),
+            }),
+            options=options,
+            state_metadata={'ttlInSeconds': str(ttl)},
+        )
+
+    # claim returns CLAIMED if the caller should run the job, DONE if it is
+    # already done and BUSY if someone else is running it. Ledger errors
+    # fail open, i.e. the job runs.
+    def claim(self, key: str) -> str:
+        try:
+            with self.dapr_pool.client() as d:
+                data = d.get_state(
+                    store_name=self.store_name,
+                    key=key).data
+                if len(data) > 0:
+                    if json.loads(data)['state'] == DONE:
+                        return DONE
+                    return BUSY
+                try:
+                    self.save(d, key, 'running', self.claim_ttl,
+                        options=StateOptions(
+                            consistency=Consistency.strong,
+                            concurrency=Concurrency.first_write,
+                        ))
+                except Exception as e:
+                    # lost the race to another consumer
+                    logging.debug('Failed to claim job %s: %s' %(key, str(e)))
+                    return BUSY
+        except Exception as e:
+            logging.error('Job ledger unavailable for %s: %s' %(key, str(e)))
+        return CLAIMED
+
+    def done(self, key: str):
+        try:
+            with self.dapr_pool.client() as d:
+                self.save(d, key, DONE, self.done_ttl)
+        except Exception as e:
+            logging.error('Failed to mark job %s done: %s' %(key, str(e)))
+
+    # release drops the claim of a failed job, so a redelivery can run it again
+    def release(self, key: str):
+        try:
+            with self.dapr_pool.client() as d:
+                d.delete_state(
+                    store_name=self.store_name,
+                    key=key)
+        except Exception as e:
+            logging.error('Failed to release job %s: %s' %(key, str(e)))
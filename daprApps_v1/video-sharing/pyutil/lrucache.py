@@ -0,0 +1,44 @@
+from collections import OrderedDict
+from threading import Lock
+
+# ByteLRUCache is a thread-safe LRU cache of str/bytes values bounded by
+# the total length of the cached values rather than the number of entries
+class ByteLRUCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    # getMany returns the cached subset of keys as a dict
+    def getMany(self, keys) -> dict:
+        found = {}
+        with self.lock:
+            for k in keys:
+                if k in self.items:
+                    self.items.move_to_end(k)
+                    found[k] = self.items[k]
+        return found
+
+    def get(self, key):
+        return self.getMany([key]).get(key)
+
+    # put caches a value, evicting least recently used entries to stay in budget.
+    # values larger than the whole budget are not cached
+    def put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                self.bytes -= len(self.items.pop(key))
+            while self.bytes + size > self.max_bytes and len(self.items) > 0:
+                _, old = self.items.popitem(last=False)
+                self.bytes -= len(old)
+                self.evictions += 1
+            self.items[key] = value
+            self.bytes += size
@@ -0,0 +1,130 @@
+import os
+import glob
+import time
+import logging
+import resource
+# prometheus
+import prometheus_client
+from prometheus_client import multiprocess
+
+# buckets (ms) of the time a job waits for a free pool worker
+def queueWaitBuckets():
+    return [0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0,
+        1000.0, 2500.0, 5000.0, 10000.0, 25000.0, 60000.0]
+
+# buckets (ms) of ffmpeg/ffprobe wall time
+def ffmpegLatBuckets():
+    return [10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0, 2500.0, 5000.0,
+        10000.0, 25000.0, 60000.0, 120000.0, 300000.0]
+
+# buckets (s) of ffmpeg/ffprobe user+sys cpu time
+def ffmpegCpuBuckets():
+    return [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0,
+        60.0, 120.0, 300.0, 600.0]
+
+def byteBuckets():
+    return [16*1024, 64*1024, 256*1024, 1024*1024, 4*1024*1024, 16*1024*1024,
+        64*1024*1024, 256*1024*1024, 1024*1024*1024]
+
+def childCpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+# PoolMetrics are observed where the jobs run, i.e. in the pool workers and
+# not in the process serving /metrics. With PROMETHEUS_MULTIPROC_DIR set every
+# process writes its values to that dir, and serveMetrics exports the ones
+# named <name>_worker_* next to the metrics of the server process. They are
+# not registered in the registry of the process creating them.
+# Busy fraction of the pool is rate(<name>_worker_busy_seconds_total) over
+# <name>_pool_workers.
+class PoolMetrics:
+    def __init__(self, name: str):
+        self.prefix = '%s_worker_' %name
+        self.queueWait = prometheus_client.Histogram(
+            self.prefix + 'queue_wait_ms',
+            'Latency (ms) histogram of jobs waiting for a free %s pool worker' %name,
+            buckets=queueWaitBuckets(),
+            registry=None)
+        self.ffmpegLat = prometheus_client.Histogram(
+            self.prefix + 'ffmpeg_lat_ms',
+            'Latency (ms) histogram of the ffmpeg runs of %s pool jobs' %name,
+            buckets=ffmpegLatBuckets(),
+            registry=None)
+        self.ffmpegCpu = prometheus_client.Histogram(
+            self.prefix + 'ffmpeg_cpu_seconds',
+            'Histogram of the user+sys cpu seconds of the ffmpeg runs of %s pool jobs' %name,
+            buckets=ffmpegCpuBuckets(),
+            registry=None)
+        self.inputBytes = prometheus_client.Histogram(
+            self.prefix + 'input_bytes',
+            'Histogram of the input bytes of %s pool jobs' %name,
+            buckets=byteBuckets(),
+            registry=None)
+        self.outputBytes = prometheus_client.Histogram(
+            self.prefix + 'output_bytes',
+            'Histogram of the output bytes of %s pool jobs' %name,
+            buckets=byteBuckets(),
+            registry=None)
+        self.busy = prometheus_client.Counter(
+            self.prefix + 'busy_seconds',
+            'Seconds spent by %s pool workers running jobs' %name,
+            registry=None)
+
+    # submitted stamps a job when it is handed to the pool
+    def submitted(self, work: dict):
+        work['submit_unix_ms'] = time.time()*1000
+
+    # begin starts the measure of a job, observing its wait since submitted
+    def begin(self, submit_unix_ms: float = None):
+        epoch = time.time()*1000
+        if submit_unix_ms is not None:
+            self.queueWait.observe(max(epoch - submit_unix_ms, 0))
+        return epoch, childCpu()
+
+    # end observes a job run from begin. The cpu of ffmpeg is what the process
+    # children used meanwhile (one job at a time in a pool worker), unless
+    # cpu_s is given. Output bytes are only observed when known (not None).
+    def end(self, token, input_bytes: int = None, output_bytes: int = None, cpu_s: float = None):
+        epoch, cpu = token
+        lat = time.time()*1000 - epoch
+        if cpu_s is None:
+            cpu_s = childCpu() - cpu
+        self.ffmpegLat.observe(lat)
+        self.ffmpegCpu.observe(cpu_s)
+        self.busy.inc(lat / 1000)
+        if input_bytes is not None:
+            self.inputBytes.observe(input_bytes)
+        if output_bytes is not None:
+            self.outputBytes.observe(output_bytes)
+
+def fileSize(path) -> int:
+    try:
+        return os.path.getsize(str(path))
+    except OSError:
+        return 0
+
+# WorkerCollector exports the metrics named prefix* written by all processes
+# to the multiprocess dir path
+class WorkerCollector:
+    def __init__(self, path: str, prefix: str):
+        self.path = path
+        self.prefix = prefix
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        files = glob.glob(os.path.join(self.path, '*.db'))
+        for metric in multiprocess.MultiProcessCollector.merge(files, accumulate=True):
+            if metric.name.startswith(self.prefix):
+                yield metric
+
+# serveMetrics starts the prometheus endpoint of a service, with the metrics
+# of its pool workers when PROMETHEUS_MULTIPROC_DIR is set
+def serveMetrics(port: int, pool_metrics: PoolMetrics):
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR', '')
+    if path != '' and os.path.isdir(path):
+        prometheus_client.REGISTRY.register(WorkerCollector(path, pool_metrics.prefix))
+    else:
+        logging.warning('PROMETHEUS_MULTIPROC_DIR is not a dir, pool worker metrics are not exported')
+    prometheus_client.start_http_server(port)
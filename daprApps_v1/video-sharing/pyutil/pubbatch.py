@@ -0,0 +1,91 @@
+import time
+import logging
+from concurrent import futures
+from threading import Thread, Condition
+
+# a batched event carries its jobs under this key, plus the batch send_unix_ms
+BATCH_KEY = 'jobs'
+
+def packJobs(jobs: list) -> dict:
+    return {
+        BATCH_KEY: jobs,
+        'send_unix_ms': int(time.time()*1000),
+    }
+
+# unpackJobs returns the jobs of an event, which is either a single job or a batch
+def unpackJobs(data: dict) -> list:
+    if BATCH_KEY not in data:
+        return [data]
+    jobs = data[BATCH_KEY]
+    for job in jobs:
+        job['send_unix_ms'] = data['send_unix_ms']
+    return jobs
+
+# PublishBuffer groups jobs submitted by concurrent uploads and publishes
+# them as batched events per topic, at most window_ms after the first job
+# of a batch arrives (or as soon as max_batch jobs of a topic are pending).
+# An event carries at most max_batch jobs, which should stay well below the
+# QUEUE_SIZE of the consumers, as they admit the jobs of an event together.
+class PublishBuffer:
+    def __init__(self, publish, window_ms: float, max_batch: int):
+        # publish(topic, jobs) sends one batched event
+        self.publish = publish
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.cond = Condition()
+        self.pending = {}   # topic -> list of (job, future)
+        self.first_ts = None
+        self.flusher = Thread(target=self.run, daemon=True)
+        self.flusher.start()
+
+    def maxPending(self) -> int:
+        return max([len(v) for v in self.pending.values()] + [0])
+
+    # submit queues a job and returns a future resolved once it is published
+    def submit(self, topic: str, job: dict) -> futures.Future:
+        fut = futures.Future()
+        with self.cond:
+            if topic not in self.pending:
+                self.pending[topic] = []
+            self.pending[topic].append((job, fut))
+            if self.first_ts is None:
+                self.first_ts = time.time()
+            self.cond.notify()
+        return fut
+
+    def take(self):
+        with self.cond:
+            while self.first_ts is None:
+                self.cond.wait()
+            while self.maxPending() < self.max_batch:
+                remaining = self.first_ts + self.window - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(timeout=remaining)
+            # the jobs beyond max_batch go in the next events, right away
+            batches = {}
+            for topic in self.pending:
+                batches[topic] = self.pending[topic][:self.max_batch]
+                del self.pending[topic][:self.max_batch]
+            self.pending = {topic: v for topic, v in self.pending.items() if len(v) > 0}
+            if len(self.pending) == 0:
+                self.first_ts = None
+        return batches
+
+    def run(self):
+        while True:
+            batches = self.take()
+            for topic in batches:
+                jobs = [j for j, _ in batches[topic]]
+                err = None
+                try:
+                    self.publish(topic, jobs)
+                except Exception as e:
+                    logging.error('Failed to publish %d jobs to %s: %s' %(
+                        len(jobs), topic, str(e)))
+                    err = e
+                for _, fut in batches[topic]:
+                    if err is None:
+                        fut.set_result(len(jobs))
+                    else:
+                        fut.set_exception(err)
@@ -0,0 +1,145 @@
+import os
+import time
+import fcntl
+import hashlib
+import logging
+# prometheus
+import prometheus_client
+
+# SourceCache keeps source videos on a node-local disk shared by every process
+# (and pod) mounting root, so jobs deriving from the same video read it from
+# the store once. Entries are files named by the sha1 of the data id, written
+# to a temp file and renamed in place. A reader pins an entry with a shared
+# flock while it uses the file; eviction (least recently used by mtime, under
+# an exclusive lock of root/.lock) skips pinned entries. Pins are held by file
+# objects, so a job that fails without releasing still unpins once collected.
+class SourceCache:
+    def __init__(self, name: str, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.lock_path = os.path.join(root, '.lock')
+        self.hits = prometheus_client.Counter(
+            '%s_src_cache_hit_total' %name,
+            'Number of source video reads served by the local cache')
+        self.misses = prometheus_client.Counter(
+            '%s_src_cache_miss_total' %name,
+            'Number of source video reads that went to the store')
+        self.savedBytes = prometheus_client.Counter(
+            '%s_src_cache_saved_bytes_total' %name,
+            'Bytes of source video not read from the store thanks to the local cache')
+        self.evictions = prometheus_client.Counter(
+            '%s_src_cache_eviction_total' %name,
+            'Number of source videos evicted from the local cache')
+
+    def path(self, data_id: str) -> str:
+        return os.path.join(self.root, hashlib.sha1(data_id.encode('utf-8')).hexdigest())
+
+    # pin opens and share-locks the entry of data_id. Returns the pinned file,
+    # or None if the entry is missing or was evicted before it got locked.
+    def pin(self, data_id: str):
+        path = self.path(data_id)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if st is None or st.st_ino != os.fstat(f.fileno()).st_ino:
+            f.close()
+            return None
+        return f
+
+    def release(self, pinned):
+        pinned.close()
+
+    # acquire returns (path, pinned) of a local copy of data_id, calling
+    # fetch() to read it from the store on a miss. The path is valid until
+    # release(pinned). Returns (None, None) if fetch returns no data.
+    def acquire(self, data_id: str, fetch):
+        path = self.path(data_id)
+        pinned = self.pin(data_id)
+        if pinned is not None:
+            size = os.fstat(pinned.fileno()).st_size
+            self.hits.inc()
+            self.savedBytes.inc(size)
+            # refresh the lru position
+            os.utime(path)
+            return path, pinned
+        self.misses.inc()
+        data = fetch()
+        if len(data) == 0:
+            return None, None
+        tmp_path = '%s.tmp-%d-%d' %(path, os.getpid(), time.monotonic_ns())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        # pin the new entry before it is visible, so it cannot be evicted at once
+        pinned = open(tmp_path, 'rb')
+        fcntl.flock(pinned.fileno(), fcntl.LOCK_SH)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path, pinned
+
+    # evict removes the least recently used unpinned entries until the cache fits
+    def evict(self):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            for e in os.scandir(self.root):
+                if e.name.startswith('.') or '.tmp-' in e.name:
+                    continue
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except FileNotFoundError:
+                    total -= size
+                    continue
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # in use by a job
+                    os.close(fd)
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                    self.evictions.inc()
+                except FileNotFoundError:
+                    pass
+                finally:
+                    os.close(fd)
+            if total > self.max_bytes:
+                logging.debug('source cache over budget by %d bytes (entries in use)' %(
+                    total - self.max_bytes))
+
+# localSource makes a source video available as a local file, through cache
+# when it is set, or else as a temp file at tmp_path. Returns (path, pinned) to be
+# handed to releaseSource, or (None, None) if fetch returns no data.
+def localSource(cache, data_id: str, fetch, tmp_path):
+    if cache is not None:
+        return cache.acquire(data_id, fetch)
+    data = fetch()
+    if len(data) == 0:
+        return None, None
+    with open(str(tmp_path), 'wb+') as f:
+        f.write(data)
+    return tmp_path, None
+
+def releaseSource(cache, path, pinned):
+    if pinned is not None:
+        cache.release(pinned)
+    elif path is not None and os.path.exists(str(path)):
+        os.remove(str(path))
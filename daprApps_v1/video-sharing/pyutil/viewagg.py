@@ -0,0 +1,65 @@
+import logging
+from threading import Thread, Condition
+
+# ViewAggregator records views locally and flushes the summed increments
+# per video every interval_s seconds, or as soon as max_pending views are
+# unflushed. Counts a flush could not send are merged back and retried.
+class ViewAggregator:
+    def __init__(self, flush, interval_s: float, max_pending: int):
+        # flush(counts) sends {video_id: views} downstream and returns the unsent part
+        self.flush = flush
+        self.interval = interval_s
+        self.max_pending = max_pending
+        self.cond = Condition()
+        self.counts = {}
+        self.pending = 0
+        self.running = True
+        self.flusher = Thread(target=self.run, daemon=True)
+        self.flusher.start()
+
+    def add(self, video_id: str, views: int = 1):
+        with self.cond:
+            self.counts[video_id] = self.counts.get(video_id, 0) + views
+            self.pending += views
+            if self.pending >= self.max_pending:
+                self.cond.notify()
+
+    # unflushed returns the number of views not yet sent downstream
+    def unflushed(self) -> int:
+        return self.pending
+
+    def flushOnce(self):
+        with self.cond:
+            counts = self.counts
+            self.counts = {}
+        if len(counts) == 0:
+            return True
+        try:
+            unsent = self.flush(counts)
+        except Exception as e:
+            logging.error('Failed to flush views of %d videos: %s' %(len(counts), str(e)))
+            unsent = counts
+        with self.cond:
+            for vid in unsent:
+                self.counts[vid] = self.counts.get(vid, 0) + unsent[vid]
+            self.pending -= sum(counts.values()) - sum(unsent.values())
+        return len(unsent) == 0
+
+    def run(self):
+        # wait a full interval after a failed flush instead of retrying at once
+        backoff = False
+        while True:
+            with self.cond:
+                if self.running and (backoff or self.pending < self.max_pending):
+                    self.cond.wait(timeout=self.interval)
+                if not self.running:
+                    return
+            backoff = not self.flushOnce()
+
+    # close stops the flusher and flushes whatever is pending
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.flusher.join()
+        self.flushOnce()
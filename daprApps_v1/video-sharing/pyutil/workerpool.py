@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import resource
+from threading import Lock
+from multiprocessing.context import SpawnContext, SpawnProcess
+
+# Spawned workers re-import the __main__ module of the parent, which for the
+# services is the whole server.py (dapr app, executors, metrics...). The pool
+# of startPool points __main__ at a small worker module whenever it spawns a
+# worker, including the ones replacing workers that died, so workers only
+# import what the jobs need.
+
+# serializes the __main__ swaps of concurrent worker starts
+mainLock = Lock()
+
+# WorkerProcess is a spawned process whose __main__ is main_module
+class WorkerProcess(SpawnProcess):
+    main_module = None
+
+    def start(self):
+        # the spawn preparation data is taken from __main__ within start
+        with mainLock:
+            main = sys.modules['__main__']
+            sys.modules['__main__'] = self.main_module
+            try:
+                super().start()
+            finally:
+                sys.modules['__main__'] = main
+
+    # the process is pickled for the child, which has no use for the module
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('main_module', None)
+        return state
+
+class WorkerContext(SpawnContext):
+    def __init__(self, main_module):
+        super().__init__()
+        self.main_module = main_module
+
+    def Process(self, *args, **kwargs):
+        p = WorkerProcess(*args, **kwargs)
+        p.main_module = self.main_module
+        return p
+
+def workerReady(ready, started):
+    # only the first workers report, nobody reads the queue later on
+    if started.is_set():
+        return
+    # ru_maxrss is in KB on linux
+    ready.put((os.getpid(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+# startPool starts a spawn-context pool running the jobs of worker_module and
+# waits until every worker is up. Returns the pool, the startup time (ms) and
+# the mean peak rss (bytes) of the workers at startup.
+def startPool(worker_module, processes: int, maxtasksperchild: int = None):
+    ctx = WorkerContext(worker_module)
+    ready = ctx.SimpleQueue()
+    started = ctx.Event()
+    epoch = time.time()*1000
+    pool = ctx.Pool(processes=processes, initializer=workerReady, initargs=(ready, started),
+        maxtasksperchild=maxtasksperchild)
+    rss = 0
+    for _ in range(processes):
+        _, worker_rss = ready.get()
+        rss += worker_rss
+    started.set()
+    return pool, time.time()*1000 - epoch, rss / max(processes, 1)
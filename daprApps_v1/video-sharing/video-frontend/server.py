@@ -6,20 +6,25 @@ import logging
 import time
 from datetime import datetime, timezone
 import re
+import signal
+import atexit
+import struct
+import subprocess
 from pathlib import Path
 from concurrent import futures
+from functools import partial
 from threading import Lock
 # worker pool
-from multiprocessing import Pool, get_context
+import worker
+from worker import videoProcessor
 # dapr
 from dapr.clients import DaprClient
 from dapr.ext.grpc import App, InvokeMethodRequest, InvokeMethodResponse
 from dapr.clients.grpc._state import StateOptions, Consistency, Concurrency
 # import grpc
-# ffmpeg
-import ffmpeg
 # prometheus
 import prometheus_client
+from prometheus_client.core import CounterMetricFamily
 import warnings
 from typing import Dict
 # util
@@ -27,23 +32,64 @@ from pathlib import Path
 util_path = Path(__file__).parent.resolve() / '..' / 'pyutil'
 sys.path.append(str(util_path))
 import pyutil
+from pyutil import daprpool
+from pyutil import workerpool
+from pyutil import poolmetrics
+from pyutil import pubbatch
+from pyutil import lrucache
+from pyutil import chunkstore
+from pyutil import viewagg
+from pyutil import framing
 
 warnings.filterwarnings("ignore")
 # global variables
 serviceAddress = int(os.getenv('ADDRESS', '5005'))
 promAddress    = int(os.getenv('PROM_ADDRESS', '8084'))
+daprPoolSize   = int(os.getenv('DAPR_POOL_SIZE', '20'))
 videoPubsub    = os.getenv('VIDEO_PUBSUB', 'video-pubsub')
 scaleTopic     = os.getenv('SCALE_TOPIC', 'scale')
 thumbnailTopic = os.getenv('THUMBNAIL_TOPIC', 'thumbnail')
 videoStore     = os.getenv('VIDEO_STORE', 'video-store')
 thumbnailStore = os.getenv('THUMBNAIL_STORE', 'thumbnail-store')
 numWorkers = int(os.getenv('WORKERS', '10'))
+# size of the slices written to temp file for binary uploads
+uploadWriteChunk = int(os.getenv('UPLOAD_WRITE_CHUNK', str(1024 * 1024)))
+# how uploads are probed: file (temp file + worker pool), memfd or pipe (in memory)
+probeMode = os.getenv('PROBE_MODE', 'file')
+# bytes fed to ffprobe's stdin in pipe mode (mp4/mov with moov first only, others use memfd)
+probeHeadBytes = int(os.getenv('PROBE_HEAD_BYTES', str(2 * 1024 * 1024)))
+# issue the independent downstream calls of an upload concurrently
+parallelFanout = os.getenv('PARALLEL_FANOUT', 'true').lower() == 'true'
+fanoutWorkers = int(os.getenv('FANOUT_WORKERS', '20'))
+# how scale/thumbnail jobs are published: off (one event per job),
+# upload (one batched event per topic per upload) or window (batched across uploads)
+publishBatch = os.getenv('PUBLISH_BATCH', 'off')
+publishWindowMs = float(os.getenv('PUBLISH_WINDOW_MS', '5'))
+# jobs per batched event, kept well below the QUEUE_SIZE of video-scale/thumbnail
+publishMaxBatch = max(int(os.getenv('PUBLISH_MAX_BATCH', '4')), 1)
+# publish all widths of an upload as one ladder job, scaled from a single decode
+scaleLadder = os.getenv('SCALE_LADDER', 'false').lower() == 'true'
+# what thumbnails are extracted from: native (the upload) or smallest (the
+# smallest rendition, the thumbnail job is chained after its scale job)
+thumbnailSource = os.getenv('THUMBNAIL_SOURCE', 'native')
+# memory budget of the base64 thumbnail cache used by info requests (0 disables it)
+thumbnailCacheMB = int(os.getenv('THUMBNAIL_CACHE_MB', '64'))
+# store videos as fixed-size chunks so that ranged reads fetch only what they cover
+chunkedStore = os.getenv('CHUNKED_STORE', 'false').lower() == 'true'
+storeChunkSize = int(os.getenv('STORE_CHUNK_SIZE', str(1024 * 1024)))
+# count views locally and flush them to video-info in the background
+viewWriteBehind = os.getenv('VIEW_WRITE_BEHIND', 'false').lower() == 'true'
+viewFlushInterval = float(os.getenv('VIEW_FLUSH_INTERVAL', '1.0'))
+viewFlushMaxPending = int(os.getenv('VIEW_FLUSH_MAX_PENDING', '1000'))
 logging.basicConfig(level=logging.INFO)
 
 # prometheus metrics
 uploadReq = prometheus_client.Counter(
     'video_frontend_upload_total', 
     'Number of upload requests processed by video-frontend')
+binaryUploadReq = prometheus_client.Counter(
+    'video_frontend_upload_binary_total', 
+    'Number of upload requests with raw (non-base64) video body processed by video-frontend')
 infoReq = prometheus_client.Counter(
     'video_frontend_info_total', 
     'Number of info requests processed by video-frontend')
@@ -63,6 +109,9 @@ scaleReq = prometheus_client.Counter(
 thumbnailReq = prometheus_client.Counter(
     'video_frontend_thumbnail_total', 
     'Number of video thumbnail requests sent by video-frontend')
+publishRpc = prometheus_client.Counter(
+    'video_frontend_publish_rpc_total', 
+    'Number of publish_event calls (single or batched jobs) issued by video-frontend')
 # todo: the latency range needs refined
 uploadLat = prometheus_client.Histogram(
     'video_frontend_upload_lat_hist',
@@ -104,6 +153,35 @@ videoStoreLat = prometheus_client.Histogram(
     'Latency (ms) histogram of reading video-store (kvs/db) for video-frontend video requests',
     buckets=pyutil.latBuckets()
 )
+thumbnailCacheHit = prometheus_client.Counter(
+    'video_frontend_thumbnail_cache_hit_total', 
+    'Number of thumbnails served from the video-frontend thumbnail cache')
+thumbnailCacheMiss = prometheus_client.Counter(
+    'video_frontend_thumbnail_cache_miss_total', 
+    'Number of thumbnails read from thumbnail-store by video-frontend')
+thumbnailCacheBytes = prometheus_client.Gauge(
+    'video_frontend_thumbnail_cache_bytes', 
+    'Bytes of base64 thumbnails held in the video-frontend thumbnail cache')
+thumbnailCacheEntries = prometheus_client.Gauge(
+    'video_frontend_thumbnail_cache_entries', 
+    'Number of thumbnails held in the video-frontend thumbnail cache')
+viewsUnflushed = prometheus_client.Gauge(
+    'video_frontend_views_unflushed', 
+    'Number of views recorded by video-frontend and not yet flushed to video-info')
+viewFlushReq = prometheus_client.Counter(
+    'video_frontend_view_flush_total', 
+    'Number of batched view updates sent by video-frontend to video-info')
+# response encoding (json with base64 media or binary framing)
+respBytes = prometheus_client.Counter(
+    'video_frontend_resp_bytes_total', 
+    'Bytes of info/video responses sent by video-frontend',
+    ['method', 'encoding'])
+respEncodeLat = prometheus_client.Histogram(
+    'video_frontend_resp_encode_lat_hist',
+    'Latency (ms) histogram of encoding info/video responses in video-frontend',
+    ['method', 'encoding'],
+    buckets=pyutil.latBuckets()
+)
 e2eUploadLat = prometheus_client.Histogram(
     'e2e_video_upload_lat_hist',
     'End-to-end latency (ms) histogram of upload-video.',
@@ -130,41 +208,133 @@ e2eGetRateLat = prometheus_client.Histogram(
     buckets=pyutil.latBuckets()
 )
 
+# CacheEvictionCollector exports the evictions counted by a cache as a counter
+class CacheEvictionCollector:
+    def __init__(self, cache: lrucache.ByteLRUCache):
+        self.cache = cache
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        yield CounterMetricFamily(
+            'video_frontend_thumbnail_cache_evictions_total',
+            'Number of thumbnails evicted from the video-frontend thumbnail cache',
+            value=self.cache.evictions)
+
+# thumbnails never change once written, so info requests keep their
+# base64 encoding in an LRU cache bounded by thumbnailCacheMB
+thumbnailCache = None
+if thumbnailCacheMB > 0:
+    thumbnailCache = lrucache.ByteLRUCache(thumbnailCacheMB * 1024 * 1024)
+    thumbnailCacheBytes.set_function(lambda: thumbnailCache.bytes)
+    thumbnailCacheEntries.set_function(lambda: len(thumbnailCache))
+    prometheus_client.REGISTRY.register(CacheEvictionCollector(thumbnailCache))
+
 dateRegx = re.compile('[0-9]{4}-[0-9]{2}-[0-9]{2}')
 # checkDate returns true if given string conforms to requried date format
 def checkDate(dstr: str):
     global dateRegx
     return dateRegx.match(dstr) != None
 
+# worker pool startup
+poolStartup = prometheus_client.Gauge(
+    'video_frontend_pool_startup_ms',
+    'Time (ms) taken by the worker pool to start all of its workers')
+poolWorkerRss = prometheus_client.Gauge(
+    'video_frontend_pool_worker_rss_bytes',
+    'Mean peak rss (bytes) of the pool workers once started')
+poolWorkers = prometheus_client.Gauge(
+    'video_frontend_pool_workers',
+    'Number of pool workers, i.e. jobs running ffmpeg at once')
+
 # folders to hold videos
 dataDir = Path('/tmp') / 'video'
 os.makedirs(str(dataDir), exist_ok=True)
-# worker function
-def videoProcessor(req):
-    t = int(time.time() * 1000)
-    # logging.info('At %d videoProcessor receives work: %s' %(t, str(req['tempf'])))
-    tempf = req['tempf']
-    resp = {
-        'succ': False,
-        'err': None,
-        'probe': None,
-    }
+
+# ffprobe arguments shared by the in-memory probe modes
+probeArgs = ['ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json']
+
+def runProbe(args, **kwargs):
+    p = subprocess.run(probeArgs + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    if p.returncode != 0:
+        raise RuntimeError('ffprobe stdout: %s, stderr: %s' %(p.stdout, p.stderr))
+    return json.loads(p.stdout.decode('utf-8'))
+
+# probeMemfd exposes the video through an anonymous in-memory file,
+# which is seekable, so ffprobe only reads the parts of the container it needs
+def probeMemfd(video_bytes: bytes):
+    fd = os.memfd_create('probe', os.MFD_CLOEXEC)
     try:
-        resp['probe'] = ffmpeg.probe(str(tempf))
-        resp['succ'] = True
-    except ffmpeg.Error as e:
-        resp['err'] = e
-        # raise RuntimeError('ffprobe stdout: %s, stderr: %s' %(e.stdout, e.stderr))
-    # logging.info('videoProcessor completes work %d: %s, succ=%s' %(
-    #     t, str(req['tempf']), str(resp['succ'])))   
-    return resp
+        with open(fd, 'wb', closefd=False) as f:
+            f.write(video_bytes)
+        return runProbe(['/proc/self/fd/%d' %fd], pass_fds=(fd,))
+    finally:
+        os.close(fd)
+
+# moovFirst tells whether head starts an mp4/mov whose moov atom (which holds
+# the duration) comes before any media data, by walking the top level atoms
+def moovFirst(head: bytes) -> bool:
+    if len(head) < 8 or bytes(head[4:8]) != b'ftyp':
+        return False
+    pos = 0
+    while pos + 8 <= len(head):
+        size, kind = struct.unpack('>I4s', bytes(head[pos:pos+8]))
+        if kind == b'moov':
+            return True
+        if kind == b'mdat':
+            return False
+        if size == 1:
+            if pos + 16 > len(head):
+                return False
+            size = struct.unpack('>Q', bytes(head[pos+8:pos+16]))[0]
+        if size < 8:
+            return False
+        pos += size
+    return False
+
+# probePipe feeds only the head of the video through stdin when it holds the
+# container header (mp4/mov with moov first), other videos are probed from memfd,
+# as ffprobe may guess the duration of a truncated stream from its bitrate
+def probePipe(video_bytes: bytes):
+    head = memoryview(video_bytes)[:probeHeadBytes]
+    if moovFirst(head):
+        try:
+            probe = runProbe(['-i', 'pipe:0'], input=head)
+            if 'duration' in probe['format'] and len(probe['streams']) > 0:
+                return probe
+        except RuntimeError as e:
+            logging.debug('pipe probe failed, retry with memfd: %s' %str(e))
+    return probeMemfd(video_bytes)
+
+def probeVideo(video_bytes: bytes):
+    if probeMode == 'pipe':
+        return probePipe(video_bytes)
+    return probeMemfd(video_bytes)
 
 workerPool = None
 
 MAX_PAYLOAD = 64 * 1024 * 1024 # 64MB
 # MAX_PAYLOAD=-1
+# warm dapr clients shared by all handlers of this process
+daprPool = daprpool.DaprClientPool(
+    name='video_frontend',
+    max_size=daprPoolSize,
+    max_grpc_message_length=MAX_PAYLOAD,
+)
 # server
 executor = futures.ThreadPoolExecutor(max_workers=20)
+# threads issuing the concurrent downstream calls of uploads
+fanoutExecutor = futures.ThreadPoolExecutor(max_workers=fanoutWorkers)
+# per-topic job counters
+topicReq = {
+    scaleTopic: scaleReq,
+    thumbnailTopic: thumbnailReq,
+}
+# buffer batching jobs across concurrent uploads
+publishBuffer = None
+# write-behind view counter
+viewAggregator = None
 grpcOptions = [
     ('grpc.max_send_message_length', MAX_PAYLOAD),
     ('grpc.max_receive_message_length', MAX_PAYLOAD),
@@ -185,6 +355,95 @@ def getCtr():
         reqCtr += 1
     return ctr
 
+# each downstream stage of an upload returns the time (ms) spent inside
+# downstream services; the rest of its wall time counts as frontend time
+def publishJob(topic: str, req: dict) -> float:
+    with daprPool.client() as d:
+        req['send_unix_ms'] = int(time.time()*1000)
+        d.publish_event(
+            pubsub_name=videoPubsub,
+            topic_name=topic,
+            data=json.dumps(req),
+            data_content_type='application/json',
+        )
+    publishRpc.inc()
+    topicReq[topic].inc()
+    return 0.0
+
+# publishJobs sends all jobs as one batched event
+def publishJobs(topic: str, jobs: list) -> float:
+    with daprPool.client() as d:
+        d.publish_event(
+            pubsub_name=videoPubsub,
+            topic_name=topic,
+            data=json.dumps(pubbatch.packJobs(jobs)),
+            data_content_type='application/json',
+        )
+    publishRpc.inc()
+    topicReq[topic].inc(len(jobs))
+    return 0.0
+
+# bufferJobs hands jobs to the cross-upload buffer and waits until published
+def bufferJobs(topic: str, jobs: list) -> float:
+    fresults = [publishBuffer.submit(topic, job) for job in jobs]
+    for f in fresults:
+        f.result()
+    return 0.0
+
+def publishStages(topic_jobs: dict) -> list:
+    stages = []
+    for topic in topic_jobs:
+        jobs = topic_jobs[topic]
+        if len(jobs) == 0:
+            continue
+        if publishBatch == 'window':
+            stages.append(partial(bufferJobs, topic, jobs))
+        elif publishBatch == 'upload':
+            for i in range(0, len(jobs), publishMaxBatch):
+                stages.append(partial(publishJobs, topic, jobs[i:i+publishMaxBatch]))
+        else:
+            for job in jobs:
+                stages.append(partial(publishJob, topic, job))
+    return stages
+
+# invokeChain calls (app_id, method, req) in order
+def invokeChain(calls) -> float:
+    downstream_lat = 0.0
+    with daprPool.client() as d:
+        for app_id, method, req in calls:
+            send_unix_ms = int(time.time()*1000)
+            req['send_unix_ms'] = send_unix_ms
+            resp = d.invoke_method(
+                app_id,
+                method,
+                data=json.dumps(req),
+            )
+            resp_data = json.loads(resp.text())
+            # downstream replies with the time it sent the response
+            downstream_lat += resp_data['send_unix_ms'] - send_unix_ms
+    return downstream_lat
+
+def timedStage(stage):
+    downstream_lat = stage()
+    return time.time()*1000, downstream_lat
+
+# runStages runs independent stages (concurrently if parallelFanout is set) and
+# returns the frontend service time they add. Serially that is the wall time
+# minus all downstream time; when stages overlap only the stage finishing last
+# is on the critical path, so only its downstream time is excluded.
+def runStages(stages) -> float:
+    epoch = time.time()*1000
+    if parallelFanout and len(stages) > 1:
+        fresults = [fanoutExecutor.submit(timedStage, s) for s in stages]
+        results = [f.result() for f in fresults]
+        end_unix_ms = time.time()*1000
+        downstream_lat = max(results, key=lambda r: r[0])[1]
+    else:
+        results = [timedStage(s) for s in stages]
+        end_unix_ms = time.time()*1000
+        downstream_lat = sum([r[1] for r in results])
+    return end_unix_ms - epoch - downstream_lat
+
 # upload a new video
 @app.method(name='upload')
 def uploadVideo(request: InvokeMethodRequest) -> InvokeMethodResponse:
@@ -201,9 +460,15 @@ def uploadVideo(request: InvokeMethodRequest) -> InvokeMethodResponse:
     dt = datetime.now()
     dt_str = ''
     # parse request
-    data = json.loads(request.text())
+    # binary uploads carry a small json header followed by the raw video bytes,
+    # json uploads carry the video as a base64 string (legacy clients)
+    is_binary = request.content_type == framing.BINARY_CONTENT_TYPE
+    if is_binary:
+        binaryUploadReq.inc()
+        data, video_view = framing.unpack(request.data)
+    else:
+        data = json.loads(request.text())
     user_id = data['user']
-    video_b64 = data['video_b64']
     desc = data['description']
     if 'date' in data and data['date'] != '':
         if checkDate(data['date']):
@@ -215,27 +480,48 @@ def uploadVideo(request: InvokeMethodRequest) -> InvokeMethodResponse:
         dt_str = pyutil.dtToDate(dt)
     send_unix_ms = data['send_unix_ms']
     client_unix_ms = send_unix_ms
-    if len(video_b64) == 0:
+    if (is_binary and len(video_view) == 0) or (not is_binary and len(data['video_b64']) == 0):
         raise ValueError('Empty video uploaded')
     # decode video data into bytes, run ffprobe to get duration & resolution
-    tmp_video_id = pyutil.videoId(user_id, ts, None)
-    tempf = dataDir / ('%d-%s' %(getCtr(), tmp_video_id))
-    video_bytes = base64.b64decode(video_b64)
-    with open(str(tempf), 'wb+') as f:
-        f.write(video_bytes)
-    # dispatch to worker pool
-    work = {
-        'tempf': tempf,
-    }
-    fresult = workerPool.apply_async(videoProcessor, (work,))
-    result = fresult.get()
-    if not result['succ']:
-        e = result['err']
-        raise RuntimeError('ffprobe stdout: %s, stderr: %s' %(e.stdout, e.stderr)) 
-    # remove temp files
-    if os.path.exists(str(tempf)):
-        os.remove(str(tempf))
-    probe = result['probe']
+    if probeMode == 'file':
+        tmp_video_id = pyutil.videoId(user_id, ts, None)
+        tempf = dataDir / ('%d-%s' %(getCtr(), tmp_video_id))
+        if is_binary:
+            # write the payload straight from the request buffer, slice by slice
+            with open(str(tempf), 'wb+') as f:
+                for off in range(0, len(video_view), uploadWriteChunk):
+                    f.write(video_view[off:off+uploadWriteChunk])
+            video_bytes = video_view.tobytes()
+            video_view.release()
+        else:
+            video_bytes = base64.b64decode(data['video_b64'])
+            # drop the base64 string as soon as it is decoded
+            del data['video_b64']
+            with open(str(tempf), 'wb+') as f:
+                f.write(video_bytes)
+        # dispatch to worker pool
+        work = {
+            'tempf': tempf,
+        }
+        worker.poolMetrics.submitted(work)
+        fresult = workerPool.apply_async(videoProcessor, (work,))
+        result = fresult.get()
+        if not result['succ']:
+            e = result['err']
+            raise RuntimeError('ffprobe stdout: %s, stderr: %s' %(e.stdout, e.stderr)) 
+        # remove temp files
+        if os.path.exists(str(tempf)):
+            os.remove(str(tempf))
+        probe = result['probe']
+    else:
+        # probe in memory from the handler thread, no temp file or worker round trip
+        if is_binary:
+            video_bytes = video_view.tobytes()
+            video_view.release()
+        else:
+            video_bytes = base64.b64decode(data['video_b64'])
+            del data['video_b64']
+        probe = probeVideo(video_bytes)
     dur = float(probe['format']['duration'])
     format = pyutil.pickFormat(probe['format']['format_name'])
     video_id = pyutil.videoId(user_id, ts, format)
@@ -253,96 +539,94 @@ def uploadVideo(request: InvokeMethodRequest) -> InvokeMethodResponse:
     # latency metrics
     epoch = time.time()*1000
     serv_lat = epoch - send_unix_ms
-    with DaprClient(max_grpc_message_length=MAX_PAYLOAD) as d:
+    with daprPool.client() as d:
         # save the native video
-        d.save_state(
-            store_name=videoStore, 
-            key=native_data_id, 
-            value=video_bytes,
-            options=StateOptions(
-                consistency=Consistency.strong,
-                concurrency=Concurrency.last_write,
-            ),
+        store_options = StateOptions(
+            consistency=Consistency.strong,
+            concurrency=Concurrency.last_write,
         )
-        # video-store latency metric
-        uploadStoreLat.observe(time.time()*1000 - epoch)
-        epoch = time.time()*1000
-        # issue scale requests
-        for w in scale_widths:
-            h = int(w / width * height)
-            if h % 2 == 1:
-                h += 1
-            scale_req = {
-                'video_id': video_id,
-                'data_id': native_data_id,
-                'width': w,
-                'height': h,
-                'send_unix_ms': int(time.time()*1000),
-                'client_unix_ms': int(client_unix_ms),
-            }
-            resp = d.publish_event(
-                pubsub_name=videoPubsub,
-                topic_name=scaleTopic,
-                data=json.dumps(scale_req),
-                data_content_type='application/json',
+        if chunkedStore:
+            chunkstore.saveChunked(d, videoStore, native_data_id, video_bytes,
+                chunk_size=storeChunkSize,
+                options=store_options,
             )
-            scaleReq.inc()
-        # issue thumbnail requests
-        if video_stream != None:
-            thumbnail_req = {
-                'video_id': video_id,
-                'data_id': native_data_id,
-                'duration': dur,
-                'send_unix_ms': int(time.time()*1000),
-                'client_unix_ms': int(client_unix_ms),
-            }
-            resp = d.publish_event(
-                pubsub_name=videoPubsub,
-                topic_name=thumbnailTopic,
-                data=json.dumps(thumbnail_req),
-                data_content_type='application/json',
+        else:
+            d.save_state(
+                store_name=videoStore, 
+                key=native_data_id, 
+                value=video_bytes,
+                options=store_options,
             )
-            thumbnailReq.inc()
-        # save video meta
-        serv_lat += time.time()*1000 - epoch
-        meta_req = {
+    # video-store latency metric
+    uploadStoreLat.observe(time.time()*1000 - epoch)
+    # downstream stages
+    scale_jobs = []
+    thumbnail_jobs = []
+    # issue scale requests
+    for w in scale_widths:
+        h = int(w / width * height)
+        if h % 2 == 1:
+            h += 1
+        scale_req = {
             'video_id': video_id,
-            'user_id': user_id,
-            'resolutions': avail_reso,
-            'duration': dur,
-            'date': dt_str,
-            'description': desc,
-            'send_unix_ms': int(time.time()*1000),
+            'data_id': native_data_id,
+            'width': w,
+            'height': h,
+            'client_unix_ms': int(client_unix_ms),
         }
-        resp = d.invoke_method(
-            'dapr-video-info',
-            'upload',
-            data=json.dumps(meta_req),
-        )
-        resp_data = json.loads(resp.text())
-        epoch = time.time()*1000
-        serv_lat += epoch - resp_data['send_unix_ms']
-        # query dates service to add the video to the current date
-        dates_req = {
-            'date': dt_str,
+        scale_jobs.append(scale_req)
+    if scaleLadder and len(scale_jobs) > 1:
+        scale_jobs = [{
             'video_id': video_id,
-            'send_unix_ms': int(time.time()*1000),
-        }
-        resp = d.invoke_method(
-            'dapr-dates',
-            'upload',
-            data=json.dumps(dates_req),
-        )
-        resp_data = json.loads(resp.text())
-        # update latency metrics
-        epoch = time.time()*1000
-        serv_lat += epoch - resp_data['send_unix_ms']
-        uploadLat.observe(serv_lat)
-        e2eUploadLat.observe(epoch - client_unix_ms)
-        resp = {
+            'data_id': native_data_id,
+            'ladder': [{'width': j['width'], 'height': j['height']} for j in scale_jobs],
+            'client_unix_ms': int(client_unix_ms),
+        }]
+    # issue thumbnail requests
+    if video_stream != None:
+        thumbnail_req = {
             'video_id': video_id,
+            'data_id': native_data_id,
+            'duration': dur,
+            'client_unix_ms': int(client_unix_ms),
         }
-        return InvokeMethodResponse(json.dumps(resp), 'application/json')
+        if thumbnailSource == 'smallest' and len(scale_jobs) > 0:
+            # video-scale publishes it once the smallest rendition is saved
+            smallest = min(scale_jobs, key=lambda j: min([r['width'] for r in j.get('ladder', [j])]))
+            smallest['chain_thumbnail'] = thumbnail_req
+        else:
+            thumbnail_jobs.append(thumbnail_req)
+    # save video meta, then add the video to its date in dates service
+    # (dates should not list a video whose info is not yet saved)
+    meta_req = {
+        'video_id': video_id,
+        'user_id': user_id,
+        'resolutions': avail_reso,
+        'duration': dur,
+        'date': dt_str,
+        'description': desc,
+    }
+    dates_req = {
+        'date': dt_str,
+        'video_id': video_id,
+    }
+    stages = publishStages({
+        scaleTopic: scale_jobs,
+        thumbnailTopic: thumbnail_jobs,
+    })
+    stages.append(partial(invokeChain, [
+        ('dapr-video-info', 'upload', meta_req),
+        ('dapr-dates', 'upload', dates_req),
+    ]))
+    serv_lat += runStages(stages)
+    # update latency metrics
+    epoch = time.time()*1000
+    uploadLat.observe(serv_lat)
+    e2eUploadLat.observe(epoch - client_unix_ms)
+    resp = {
+        'video_id': video_id,
+    }
+    return InvokeMethodResponse(json.dumps(resp), 'application/json')
 
 # fetching info of specified videos (thumbnails included)
 @app.method(name='info')
@@ -359,6 +643,7 @@ def getVideoInfo(request: InvokeMethodRequest) -> InvokeMethodResponse:
     video_ids = data['videos']
     send_unix_ms = data['send_unix_ms']
     client_unix_ms = send_unix_ms
+    binary = wantsBinary(data)
     # thumbnail ids
     thumbnail_ids = []
     video_info = {}
@@ -368,25 +653,45 @@ def getVideoInfo(request: InvokeMethodRequest) -> InvokeMethodResponse:
     # latency metrics
     epoch = time.time()*1000
     serv_lat = epoch - send_unix_ms
-    with DaprClient(max_grpc_message_length=MAX_PAYLOAD) as d:
-        # fetch the thumbnail images
-        items = d.get_bulk_state(
-            store_name=thumbnailStore, 
-            keys=thumbnail_ids).items
+    with daprPool.client() as d:
+        # serve cached thumbnails and fetch only the missing ones
+        cache_keys = {}
+        for k in thumbnail_ids:
+            cache_keys[thumbnailCacheKey(k, binary)] = k
+        cached = {}
+        if thumbnailCache is not None:
+            cached = thumbnailCache.getMany(list(cache_keys.keys()))
+        missing = [cache_keys[ck] for ck in cache_keys if ck not in cached]
+        thumbnailCacheHit.inc(len(cached))
+        thumbnailCacheMiss.inc(len(missing))
+        items = []
+        if len(missing) > 0:
+            items = d.get_bulk_state(
+                store_name=thumbnailStore, 
+                keys=missing).items
         # video-store latency metric
         infoStoreLat.observe(time.time()*1000 - epoch)
         epoch = time.time()*1000
-        # encode image into b64
+        for ck in cached:
+            video_info[pyutil.thumbnailToVideo(cache_keys[ck])]['thumbnail'] = cached[ck]
+        # encode image into b64 (kept raw for binary responses)
         for it in items:
             k = it.key
             vid = pyutil.thumbnailToVideo(k)
             if vid not in video_info:
                 raise ValueError('Extracted video id %s does not match given videos' %(vid))
             else:
-                if isinstance(d, str):
-                    video_info[vid]['thumbnail'] = base64.b64encode(it.data.encode('ascii')).decode('ascii')
+                raw = it.data
+                if isinstance(raw, str):
+                    raw = raw.encode('ascii')
+                if binary:
+                    thumbnail = raw
                 else:
-                    video_info[vid]['thumbnail'] = base64.b64encode(it.data).decode('ascii')
+                    thumbnail = base64.b64encode(raw).decode('ascii')
+                video_info[vid]['thumbnail'] = thumbnail
+                # thumbnail not generated yet, do not cache the miss
+                if thumbnailCache is not None and len(thumbnail) > 0:
+                    thumbnailCache.put(thumbnailCacheKey(k, binary), thumbnail)
                 # logging.info('thumbnail type = %s' %type(video_info[vid]['thumbnail']))
         # query dapr-video-info to get video info 
         info_req = {
@@ -416,12 +721,75 @@ def getVideoInfo(request: InvokeMethodRequest) -> InvokeMethodResponse:
         # update latency metric
         epoch = time.time()*1000
         serv_lat += epoch - resp_data['send_unix_ms']
-        infoLat.observe(serv_lat)
-        e2eInfoLat.observe(epoch - client_unix_ms)
+        # binary responses replace each thumbnail by its [offset, length] in the payload
+        payload = []
+        if binary:
+            offset = 0
+            for vid in video_info:
+                if 'thumbnail' in video_info[vid]:
+                    thumbnail = video_info[vid]['thumbnail']
+                    video_info[vid]['thumbnail'] = [offset, len(thumbnail)]
+                    payload.append(thumbnail)
+                    offset += len(thumbnail)
         resp = {
             'video_info': video_info,
         }
-        return InvokeMethodResponse(json.dumps(resp), 'application/json')
+        # response encoding is part of the service latency, so encodings can be compared
+        resp = encodeResponse('info', resp, b''.join(payload), binary)
+        final_epoch = time.time()*1000
+        serv_lat += final_epoch - epoch
+        infoLat.observe(serv_lat)
+        e2eInfoLat.observe(final_epoch - client_unix_ms)
+        return resp
+
+# wantsBinary tells if the client asked for binary framing (json header
+# followed by raw media bytes) instead of base64 media in a json body
+def wantsBinary(data: dict) -> bool:
+    return data.get('encoding', 'json') == 'binary'
+
+# binary and base64 thumbnails are cached separately
+def thumbnailCacheKey(thumbnail_id: str, binary: bool) -> str:
+    if binary:
+        return thumbnail_id + '#raw'
+    return thumbnail_id
+
+# encodeResponse builds the response body in the negotiated encoding
+def encodeResponse(method: str, header: dict, payload: bytes, binary: bool) -> InvokeMethodResponse:
+    epoch = time.time()*1000
+    if binary:
+        encoding = 'binary'
+        body = framing.pack(header, payload)
+        content_type = framing.BINARY_CONTENT_TYPE
+    else:
+        encoding = 'json'
+        body = json.dumps(header)
+        content_type = 'application/json'
+    respEncodeLat.labels(method, encoding).observe(time.time()*1000 - epoch)
+    respBytes.labels(method, encoding).inc(len(body))
+    return InvokeMethodResponse(body, content_type)
+
+# flushViews sends the summed view increments to video-info, one call per
+# video, and returns the increments that could not be sent
+def flushViews(counts: dict) -> dict:
+    unsent = {}
+    with daprPool.client() as d:
+        for vid in counts:
+            view_req = {
+                'video_id': vid,
+                'count': counts[vid],
+                'send_unix_ms': int(time.time()*1000),
+            }
+            try:
+                d.invoke_method(
+                    'dapr-video-info',
+                    'view',
+                    data=json.dumps(view_req),
+                )
+                viewFlushReq.inc()
+            except Exception as e:
+                logging.error('Failed to flush %d views of %s: %s' %(counts[vid], vid, str(e)))
+                unsent[vid] = counts[vid]
+    return unsent
 
 # fetching actual video data with specified resolution
 @app.method(name='video')
@@ -440,43 +808,71 @@ def getVideoData(request: InvokeMethodRequest) -> InvokeMethodResponse:
     data_id = pyutil.videoDataId(video_id=video_id, res=res)
     send_unix_ms = float(data['send_unix_ms'])
     client_unix_ms = send_unix_ms
+    binary = wantsBinary(data)
+    # optional byte range ([start, end], inclusive, end may be null) or
+    # segment index (storeChunkSize bytes each); clients page through 'more'
+    ranged = False
+    start = 0
+    end = None
+    if data.get('range') is not None:
+        ranged = True
+        start = int(data['range'][0])
+        if len(data['range']) > 1 and data['range'][1] is not None:
+            end = int(data['range'][1])
+    elif data.get('segment') is not None:
+        ranged = True
+        start = int(data['segment']) * storeChunkSize
+        end = start + storeChunkSize - 1
+    if ranged and (start < 0 or (end is not None and end < start)):
+        raise ValueError('Invalid range [%s, %s]' %(str(start), str(end)))
     # latency metrics
     epoch = time.time()*1000
     serv_lat = epoch - send_unix_ms
-    with DaprClient(max_grpc_message_length=MAX_PAYLOAD) as d:
-        # call video-info to increment view count
-        view_req = {
-            'video_id': video_id,
-            'send_unix_ms': int(epoch),
-        }
-        resp = d.invoke_method(
-            'dapr-video-info',
-            'view',
-            data=json.dumps(view_req),
-        )
-        resp_data = json.loads(resp.text())
-        # update latency metric
-        epoch = time.time()*1000
-        serv_lat += epoch - resp_data['send_unix_ms']
-        # fetch the actual video
-        state = d.get_state(
-            store_name=videoStore, 
-            key=data_id)
+    with daprPool.client() as d:
+        if viewAggregator is not None:
+            # count the view locally, flushed to video-info in the background
+            viewAggregator.add(video_id)
+        else:
+            # call video-info to increment view count
+            view_req = {
+                'video_id': video_id,
+                'send_unix_ms': int(epoch),
+            }
+            resp = d.invoke_method(
+                'dapr-video-info',
+                'view',
+                data=json.dumps(view_req),
+            )
+            resp_data = json.loads(resp.text())
+            # update latency metric
+            epoch = time.time()*1000
+            serv_lat += epoch - resp_data['send_unix_ms']
+        # fetch the actual video, or only the requested byte range/segment
+        resp = {}
+        if ranged:
+            data, size = chunkstore.readRange(d, videoStore, data_id, start, end)
+            end = start + len(data) - 1
+            resp['range'] = [start, end]
+            resp['size'] = size
+            resp['more'] = end + 1 < size
+        else:
+            data = chunkstore.readAll(d, videoStore, data_id)
         # video-store latency metric
         videoStoreLat.observe(time.time()*1000 - epoch)
         epoch = time.time()*1000
-        data = state.data
-        resp = {}
-        # encode video into b64
         if isinstance(data, str):
-            resp['data'] = base64.b64encode(data.encode('ascii')).decode('ascii')
+            data = data.encode('ascii')
+        if binary:
+            resp = encodeResponse('video', resp, data, True)
         else:
+            # encode video into b64
             resp['data'] = base64.b64encode(data).decode('ascii')
+            resp = encodeResponse('video', resp, b'', False)
         final_epoch = time.time()*1000
         serv_lat += final_epoch - epoch
         videoLat.observe(serv_lat)
         e2eVideoLat.observe(final_epoch - client_unix_ms)
-        return InvokeMethodResponse(json.dumps(resp), 'application/json')
+        return resp
 
 # rate (or change rating) of a certain video
 @app.method(name='rate')
@@ -498,7 +894,7 @@ def rateVideo(request: InvokeMethodRequest) -> InvokeMethodResponse:
     # latency metrics
     epoch = time.time()*1000
     serv_lat = epoch - send_unix_ms
-    with DaprClient() as d:
+    with daprPool.client() as d:
         # call dapr-user-rating to update score & comment of user and get original rating
         ur_req = {
             'user_id': user_id,
@@ -560,7 +956,7 @@ def getVideoRating(request: InvokeMethodRequest) -> InvokeMethodResponse:
     # latency metrics
     epoch = time.time()*1000
     serv_lat = epoch - send_unix_ms
-    with DaprClient() as d:
+    with daprPool.client() as d:
         # call dapr-user-rating to update score & comment of user and get original rating
         ur_req = {
             'user_id': user_id,
@@ -589,9 +985,31 @@ def getVideoRating(request: InvokeMethodRequest) -> InvokeMethodResponse:
         return InvokeMethodResponse(json.dumps(resp), 'application/json')
 
 if __name__ == '__main__':
-    # worker pool
-    workerPool = get_context("spawn").Pool(processes=numWorkers)
-    # start prometheus
-    prometheus_client.start_http_server(promAddress)
+    # worker pool (only the temp file probe mode needs it)
+    if probeMode == 'file':
+        workerPool, startup_ms, worker_rss = workerpool.startPool(worker, numWorkers)
+        poolStartup.set(startup_ms)
+        poolWorkerRss.set(worker_rss)
+        poolWorkers.set(numWorkers)
+        logging.info('%d pool workers ready in %.1f ms, rss %.1f MB per worker' %(
+            numWorkers, startup_ms, worker_rss / (1024 * 1024)))
+    if publishBatch == 'window':
+        publishBuffer = pubbatch.PublishBuffer(
+            publish=publishJobs,
+            window_ms=publishWindowMs,
+            max_batch=publishMaxBatch,
+        )
+    if viewWriteBehind:
+        viewAggregator = viewagg.ViewAggregator(
+            flush=flushViews,
+            interval_s=viewFlushInterval,
+            max_pending=viewFlushMaxPending,
+        )
+        viewsUnflushed.set_function(viewAggregator.unflushed)
+        # flush pending views on shutdown (SIGTERM from kubernetes included)
+        atexit.register(viewAggregator.close)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # start prometheus (with the metrics written by the pool workers)
+    poolmetrics.serveMetrics(promAddress, worker.poolMetrics)
     # start the service
     app.run(serviceAddress)
\ No newline at end of file
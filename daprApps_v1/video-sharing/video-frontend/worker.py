@@ -0,0 +1,33 @@
+# Jobs run by the spawn-context worker pool of video-frontend. Workers run this
+# module instead of server.py (see pyutil/workerpool.py), so it only imports
+# what the jobs need.
+import time
+# ffmpeg
+import ffmpeg
+# metrics
+from pyutil import poolmetrics
+
+poolMetrics = poolmetrics.PoolMetrics('video_frontend')
+
+# worker function
+def videoProcessor(req):
+    t = int(time.time() * 1000)
+    # logging.info('At %d videoProcessor receives work: %s' %(t, str(req['tempf'])))
+    tempf = req['tempf']
+    resp = {
+        'succ': False,
+        'err': None,
+        'probe': None,
+    }
+    token = poolMetrics.begin(req.get('submit_unix_ms'))
+    try:
+        resp['probe'] = ffmpeg.probe(str(tempf))
+        resp['succ'] = True
+    except ffmpeg.Error as e:
+        resp['err'] = e
+        # raise RuntimeError('ffprobe stdout: %s, stderr: %s' %(e.stdout, e.stderr))
+    # ffprobe has no output file
+    poolMetrics.end(token, poolmetrics.fileSize(tempf))
+    # logging.info('videoProcessor completes work %d: %s, succ=%s' %(
+    #     t, str(req['tempf']), str(resp['succ'])))   
+    return resp
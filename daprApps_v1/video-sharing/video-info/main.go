@@ -417,7 +417,11 @@ func viewHandler(ctx context.Context, in *common.InvocationEvent) (out *common.C
 		} else {
 			views = 0
 		}
-		views += 1
+		if req.Count > 0 {
+			views += req.Count
+		} else {
+			views += 1
+		}
 		// try update store with etag
 		viewsjson, errl := json.Marshal(views)
 		if errl != nil {
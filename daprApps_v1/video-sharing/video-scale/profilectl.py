@@ -0,0 +1,101 @@
+import math
+from threading import Lock
+
+# rough encode cost of the x264 presets relative to medium, used until a
+# profile has measured encode times of its own
+presetCost = {
+    'ultrafast': 0.15,
+    'superfast': 0.2,
+    'veryfast': 0.3,
+    'faster': 0.5,
+    'fast': 0.7,
+    'medium': 1.0,
+    'slow': 1.6,
+    'slower': 2.8,
+    'veryslow': 5.5,
+}
+
+# parseLadder parses 'slow:18,medium:20,...' into [(preset, crf)], best quality first
+def parseLadder(ladder: str) -> list:
+    profiles = []
+    for p in ladder.split(','):
+        p = p.strip()
+        if p == '':
+            continue
+        preset, crf = p.split(':')
+        if preset not in presetCost:
+            raise ValueError('Unknown x264 preset %s in encoder ladder' %preset)
+        profiles.append((preset, int(crf)))
+    if len(profiles) == 0:
+        raise ValueError('Empty encoder ladder')
+    return profiles
+
+def profileName(profile) -> str:
+    return '%s:%d' %profile
+
+# ProfileController picks the encoder profile of each job: the best quality
+# one whose predicted end-to-end latency (time already spent + wait behind the
+# backlog + own encode) meets target_ms, or the fastest one otherwise.
+# Encode times are tracked per profile as an ewma of ms per MB of source.
+class ProfileController:
+    def __init__(self, ladder: list, target_ms: float, slots: int, alpha: float = 0.2):
+        self.ladder = ladder
+        self.target_ms = target_ms
+        self.slots = slots
+        self.alpha = alpha
+        self.ms_per_mb = [None] * len(ladder)
+        self.mean_mb = None
+        self.inflight = 0
+        self.lock = Lock()
+
+    # begin/end bracket a job, so the backlog is known when profiles are picked
+    def begin(self):
+        with self.lock:
+            self.inflight += 1
+
+    def end(self):
+        with self.lock:
+            self.inflight -= 1
+
+    def estimate(self, i: int) -> float:
+        if self.ms_per_mb[i] is not None:
+            return self.ms_per_mb[i]
+        # scale the nearest measured profile by the preset costs
+        measured = [j for j in range(len(self.ladder)) if self.ms_per_mb[j] is not None]
+        if len(measured) == 0:
+            return None
+        j = min(measured, key=lambda j: abs(j - i))
+        return self.ms_per_mb[j] * presetCost[self.ladder[i][0]] / presetCost[self.ladder[j][0]]
+
+    # pick returns the index of the profile for a job of size_bytes that has
+    # already spent elapsed_ms since it was published
+    def pick(self, elapsed_ms: float, size_bytes: int) -> int:
+        if self.target_ms <= 0 or len(self.ladder) == 1:
+            return 0
+        size_mb = size_bytes / (1024 * 1024)
+        with self.lock:
+            mean_mb = self.mean_mb if self.mean_mb is not None else size_mb
+            # jobs (other than this one) waiting for a free encoder
+            ahead = max(0, self.inflight - self.slots)
+            for i in range(len(self.ladder)):
+                est = self.estimate(i)
+                if est is None:
+                    # nothing measured yet
+                    return 0
+                wait = math.ceil(ahead / self.slots) * est * mean_mb
+                if elapsed_ms + wait + est * size_mb <= self.target_ms:
+                    return i
+            return len(self.ladder) - 1
+
+    # record feeds back the encode time of a job encoded with profile i
+    def record(self, i: int, size_bytes: int, encode_ms: float):
+        size_mb = max(size_bytes / (1024 * 1024), 1e-3)
+        with self.lock:
+            if self.ms_per_mb[i] is None:
+                self.ms_per_mb[i] = encode_ms / size_mb
+            else:
+                self.ms_per_mb[i] += self.alpha * (encode_ms / size_mb - self.ms_per_mb[i])
+            if self.mean_mb is None:
+                self.mean_mb = size_mb
+            else:
+                self.mean_mb += self.alpha * (size_mb - self.mean_mb)
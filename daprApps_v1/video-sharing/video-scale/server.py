@@ -7,14 +7,17 @@ import time
 import random
 from pathlib import Path
 from concurrent import futures
+from functools import partial
 # worker pool
-from multiprocessing import Pool, get_context
-from threading import Lock
+import worker
+from worker import videoProcessor
+import profilectl
+from threading import Lock, Semaphore, BoundedSemaphore
 # dapr
 from dapr.clients import DaprClient
 from dapr.ext.grpc import App
-# ffmpeg
-import ffmpeg
+from dapr.clients.grpc._response import TopicEventResponse
+from dapr.clients.grpc._state import StateItem
 # prometheus
 import prometheus_client
 import warnings
@@ -24,15 +27,49 @@ from pathlib import Path
 util_path = Path(__file__).parent.resolve() / '..' / 'pyutil'
 sys.path.append(str(util_path))
 import pyutil
+from pyutil import daprpool
+from pyutil import workerpool
+from pyutil import poolmetrics
+from pyutil import pubbatch
+from pyutil import chunkstore
+from pyutil import srccache
+from pyutil import jobledger
 
 warnings.filterwarnings("ignore")
 # global variables
 serviceAddress = int(os.getenv('ADDRESS', '5005'))
 promAddress = int(os.getenv('PROM_ADDRESS', '8084'))
+daprPoolSize = int(os.getenv('DAPR_POOL_SIZE', '20'))
 pubsubName  = os.getenv('PUBSUB_NAME', 'video-pubsub')
 topicName   = os.getenv('TOPIC_NAME', 'scale')
+# topic of the thumbnail jobs chained after scale jobs by video-frontend
+thumbnailTopic = os.getenv('THUMBNAIL_TOPIC', 'thumbnail')
 videoStore  = os.getenv('VIDEO_STORE', 'video-store')
 numWorkers  = int(os.getenv('WORKERS', '10'))
+# state store of the job ledger skipping redelivered jobs (empty disables it)
+ledgerStore = os.getenv('LEDGER_STORE', '')
+ledgerClaimTtl = int(os.getenv('LEDGER_CLAIM_TTL', '600'))
+ledgerDoneTtl = int(os.getenv('LEDGER_DONE_TTL', '86400'))
+# jobs accepted but not finished; a job waits up to ADMIT_TIMEOUT_MS for a
+# slot, beyond that its event is sent back for retry
+queueSize   = int(os.getenv('QUEUE_SIZE', str(2 * numWorkers)))
+admitTimeoutMs = float(os.getenv('ADMIT_TIMEOUT_MS', '10000'))
+# handler threads, more than QUEUE_SIZE: a handler holds on until the jobs of its
+# event are done, the ones beyond the admitted jobs send events back for retry
+handlerThreads = max(int(os.getenv('HANDLER_THREADS', str(queueSize + 10))), queueSize + 1)
+# node-local cache of source videos shared with the other video workers (empty disables it)
+srcCacheDir = os.getenv('SRC_CACHE_DIR', '')
+srcCacheMB = int(os.getenv('SRC_CACHE_MB', '2048'))
+# how ffmpeg gets the source and returns renditions: file (temp files + worker
+# pool) or pipe (stdin/stdout, fragmented mp4 output)
+scaleIO = os.getenv('SCALE_IO', 'file')
+# x264 preset:crf profiles (best quality first) picked per job to meet the
+# target end-to-end latency (0 always uses the first one)
+encoderLadder = profilectl.parseLadder(os.getenv('ENCODER_LADDER', 'slow:18'))
+targetE2eMs = float(os.getenv('TARGET_E2E_MS', '0'))
+# store scaled videos as fixed-size chunks (see video-frontend)
+chunkedStore = os.getenv('CHUNKED_STORE', 'false').lower() == 'true'
+storeChunkSize = int(os.getenv('STORE_CHUNK_SIZE', str(1024 * 1024)))
 logLevel    = os.getenv('LOG_LEVEL', 'info')
 if logLevel == 'debug':
     logging.basicConfig(level=logging.DEBUG)
@@ -43,6 +80,34 @@ else:
 promReq = prometheus_client.Counter(
     'video_scale_processed_total', 
     'Number of video-scale requests processed')
+chainReq = prometheus_client.Counter(
+    'video_scale_chained_thumbnail_total', 
+    'Number of thumbnail jobs published by video-scale after the smallest rendition')
+skipReq = prometheus_client.Counter(
+    'video_scale_skipped_total', 
+    'Number of redelivered video-scale jobs acknowledged without processing them (already done)')
+busyReq = prometheus_client.Counter(
+    'video_scale_busy_total', 
+    'Number of redelivered video-scale jobs sent back for retry because they are still running')
+rejectReq = prometheus_client.Counter(
+    'video_scale_rejected_total', 
+    'Number of video-scale events sent back for retry because the job queue was full')
+pipeFallback = prometheus_client.Counter(
+    'video_scale_pipe_fallback_total', 
+    'Number of sources that could not be piped into ffmpeg and went through a temp file')
+profileReq = prometheus_client.Counter(
+    'video_scale_profile_total', 
+    'Number of video-scale jobs encoded with each encoder profile',
+    ['profile'])
+encodeLat = prometheus_client.Histogram(
+    'video_scale_encode_lat_hist',
+    'Latency (ms) histogram of ffmpeg encoding in video-scale, per encoder profile',
+    ['profile'],
+    buckets=pyutil.latBucketsFFmpegScale()
+)
+renditionReq = prometheus_client.Counter(
+    'video_scale_renditions_total', 
+    'Number of renditions produced by video-scale')
 # todo: the latency range needs refined
 servLat = prometheus_client.Histogram(
     'video_scale_serv_lat_hist',
@@ -60,56 +125,73 @@ e2eVideoScaleLat = prometheus_client.Histogram(
     buckets=pyutil.latBucketsFFmpegScale()
 )
 
+# worker pool startup
+poolStartup = prometheus_client.Gauge(
+    'video_scale_pool_startup_ms',
+    'Time (ms) taken by the worker pool to start all of its workers')
+poolWorkerRss = prometheus_client.Gauge(
+    'video_scale_pool_worker_rss_bytes',
+    'Mean peak rss (bytes) of the pool workers once started')
+poolWorkers = prometheus_client.Gauge(
+    'video_scale_pool_workers',
+    'Number of pool workers, i.e. jobs running ffmpeg at once')
+
 # folders to hold videos
 dataDir = Path('/tmp') / 'video'
 os.makedirs(str(dataDir), exist_ok=True)
-# worker function
-def videoProcessor(req):
-    t = int(time.time() * 1000)
-    # logging.info('At %d videoProcessor receives work: %s width=%d' %(t, req['data_id'], req['width']))
-    data_id = req['data_id']
-    width = req['width']
-    height = req['height']
-    video_path = req['video_path']
-    scaled_data_path = req['scaled_data_path']
-
-    resp = {
-        'succ': False,
-        'error': '',
-    }
-    # rescale the video to certain resolutin #
-    try:
-        (
-            ffmpeg
-            .input(str(video_path))
-            .filter('scale', width, height)
-            .output(str(scaled_data_path), preset='slow', crf=18)
-            .overwrite_output()
-            # .run_async(pipe_stdout=True, pipe_stderr=True)
-            .run(capture_stdout=True, capture_stderr=True)
-        )
-        resp['succ'] = True
-    except ffmpeg.Error as e:
-        out = e.stdout.decode()
-        err = e.stderr.decode()
-        resp['error'] = 'FFmpeg (data_id: %s) std_err: %s, std_out: %s' %(
-            data_id, err, out)
-    # logging.info('videoProcessor completes work %d: %s width=%d' %(t, req['data_id'], req['width']))
-    return resp
+srcCache = None
+if srcCacheDir != '':
+    srcCache = srccache.SourceCache(
+        name='video_scale',
+        root=srcCacheDir,
+        max_bytes=srcCacheMB * 1024 * 1024,
+    )
 
 workerPool = None
+# bounds the ffmpeg processes of pipe mode like the pool bounds file mode
+pipeSlots = Semaphore(numWorkers)
+profileCtl = profilectl.ProfileController(
+    ladder=encoderLadder,
+    target_ms=targetE2eMs,
+    slots=numWorkers,
+)
+queueDepth = prometheus_client.Gauge(
+    'video_scale_admitted_jobs',
+    'Number of video-scale jobs accepted and not finished yet')
+queueDepth.set_function(lambda: profileCtl.inflight)
 
 # server 
 MAX_PAYLOAD = 64 * 1024 * 1024 # 64MB
 # MAX_PAYLOAD=-1
-executor = futures.ThreadPoolExecutor(max_workers=20)
+# warm dapr clients shared by all handlers of this process
+daprPool = daprpool.DaprClientPool(
+    name='video_scale',
+    max_size=daprPoolSize,
+    max_grpc_message_length=MAX_PAYLOAD,
+)
+executor = futures.ThreadPoolExecutor(max_workers=handlerThreads)
+# threads reading sources and dispatching encodes of admitted jobs
+intakeExecutor = futures.ThreadPoolExecutor(max_workers=numWorkers)
+# threads saving the renditions of finished encodes
+completionExecutor = futures.ThreadPoolExecutor(max_workers=numWorkers)
+admission = BoundedSemaphore(queueSize)
+jobLedger = None
+if ledgerStore != '':
+    jobLedger = jobledger.JobLedger(
+        dapr_pool=daprPool,
+        store_name=ledgerStore,
+        claim_ttl_s=ledgerClaimTtl,
+        done_ttl_s=ledgerDoneTtl,
+    )
 grpcOptions = [
     ('grpc.max_send_message_length', MAX_PAYLOAD),
     ('grpc.max_receive_message_length', MAX_PAYLOAD),
 ]
+# events beyond the handler threads are refused rather than queued in grpc
 app = App(
     thread_pool=executor, 
     options=grpcOptions,
+    maximum_concurrent_rpcs=handlerThreads,
 )
 
 reqCtr = 0
@@ -123,20 +205,29 @@ def getCtr():
         reqCtr += 1
     return ctr
 
+# renditions returns the (width, height) targets of a job: the ladder of a
+# multi-rendition job, or the single target of a plain one
+def renditions(data) -> list:
+    if 'ladder' in data:
+        return [(r['width'], r['height']) for r in data['ladder']]
+    return [(data['width'], data['height'])]
+
+# ledgerKey identifies a scale job by its source and widths
+def ledgerKey(data) -> str:
+    return 'scale||%s||%s' %(data['data_id'], ','.join([str(w) for w, _ in renditions(data)]))
+
 # handlers
-@app.subscribe(pubsub_name=pubsubName, topic=topicName)
-def scaleVideo(event) -> None:
+# a job runs in two phases: prepareScaleJob (on an intake thread) reads the
+# source and picks the encoder profile, then the encode is dispatched and
+# finishScaleJob (on a completion thread) saves the renditions
+def prepareScaleJob(data):
     global promReq
     global servLat
-    global workerPool
-    global grpcOptions
     # update req counter
     promReq.inc()
-    data = json.loads(event.Data())
     video_id = data['video_id']
     data_id = data['data_id']
-    width = data['width']   # resolutons 
-    height = data['height']
+    targets = renditions(data)  # resolutons 
     send_unix_ms = float(data['send_unix_ms'])
     # client_unix_ms = float(data['client_unix_ms'])
     # latency metrics
@@ -145,22 +236,41 @@ def scaleVideo(event) -> None:
     store_lat = 0
     # temp files saving video (add a random number to avoid conflict)
     unique_id = getCtr()
-    video_path = dataDir / ('%s-%d-%d' %(data_id, unique_id, width))
-    scaled_data_id = pyutil.scaledVideoDataId(video_id, width)
-    scaled_data_path = dataDir / ('%d-%s' %(unique_id, scaled_data_id))
+    video_path = dataDir / ('%s-%d-%d' %(data_id, unique_id, targets[0][0]))
+    scaled = []
+    for width, height in targets:
+        scaled_data_id = pyutil.scaledVideoDataId(video_id, width)
+        scaled.append({
+            'width': width,
+            'height': height,
+            'scaled_data_id': scaled_data_id,
+            'scaled_data_path': dataDir / ('%d-%s' %(unique_id, scaled_data_id)),
+        })
     # with DaprClient() as d:
-    with DaprClient(max_grpc_message_length=MAX_PAYLOAD) as d:
+    with daprPool.client() as d:
         try:
-            logging.debug('%s width=%d' %(data['data_id'], data['width']))
-            video = d.get_state(
-                store_name=videoStore, 
-                key=data_id).data
+            logging.debug('%s widths=%s' %(data_id, ','.join([str(w) for w, _ in targets])))
+            fetch = partial(chunkstore.readAll, d, videoStore, data_id)
+            video = None
+            if scaleIO == 'pipe' and srcCache is None:
+                # stream the source through stdin, unless the container needs seeking
+                video = fetch()
+                src_pin = None
+                if len(video) == 0:
+                    video_path = None
+                elif not worker.pipeable(video):
+                    pipeFallback.inc()
+                    video_path, src_pin = srccache.localSource(None, data_id, lambda: video, video_path)
+                    video = None
+            else:
+                # the source comes from the node-local cache when enabled
+                video_path, src_pin = srccache.localSource(srcCache, data_id, fetch, video_path)
             # update prom metrics
             cur_unix_ms = time.time()*1000
             store_lat += cur_unix_ms - epoch
             epoch = cur_unix_ms
             # return if video does not exist
-            if len(video) == 0:
+            if video_path is None:
                 logging.error('Cannot find video data: %s in %s, or video is empty' %(
                     data_id, videoStore))
                 # update prom metrics 
@@ -168,25 +278,58 @@ def scaleVideo(event) -> None:
                 storeLat.observe(store_lat)
                 servLat.observe(serv_lat)
                 e2eVideoScaleLat.observe(cur_unix_ms - send_unix_ms)
-                return
-            # write video to a file
-            with open(str(video_path), 'wb+') as f:
-                f.write(video)
+                return None
         except Exception as e:
             logging.error('Failed to read %s from %s: %s' %(
                 data_id, videoStore, str(e)
             ))
-            return
-        # dispatch to worker pool
-        work = {
-            'data_id': data_id,
-            'width': width,
-            'video_path': video_path,
-            'scaled_data_path': scaled_data_path,
-            'height': height, 
-        }
-        fresult = workerPool.apply_async(videoProcessor, (work,))
-        result = fresult.get()
+            return None
+    # pick the encoder profile from the backlog and recent encode times
+    if video is not None:
+        source_size = len(video)
+    else:
+        source_size = os.path.getsize(str(video_path))
+    profile = profileCtl.pick(time.time()*1000 - send_unix_ms, source_size)
+    preset, crf = encoderLadder[profile]
+    work = {
+        'preset': preset,
+        'crf': crf,
+        'data_id': data_id,
+        'video_path': video_path,
+        'renditions': [{
+            'width': r['width'],
+            'height': r['height'],
+            'scaled_data_path': r['scaled_data_path'],
+        } for r in scaled],
+    }
+    return {
+        'data_id': data_id,
+        'send_unix_ms': send_unix_ms,
+        'epoch': epoch,
+        'serv_lat': serv_lat,
+        'store_lat': store_lat,
+        'video': video,
+        'video_path': video_path,
+        'src_pin': src_pin,
+        'scaled': scaled,
+        'source_size': source_size,
+        'profile': profile,
+        'chain_thumbnail': data.get('chain_thumbnail', None),
+        'ledger_key': ledgerKey(data),
+        'work': work,
+    }
+
+def finishScaleJob(job, result) -> None:
+    global servLat
+    epoch = job['epoch']
+    serv_lat = job['serv_lat']
+    store_lat = job['store_lat']
+    send_unix_ms = job['send_unix_ms']
+    scaled = job['scaled']
+    profile = job['profile']
+    cur_unix_ms = time.time()*1000
+    saved = False
+    try:
         # logging.info(result)       
         if not result['succ']:
             logging.error('FFmpeg error: %s' %result['error'])
@@ -195,35 +338,205 @@ def scaleVideo(event) -> None:
             serv_lat += cur_unix_ms - epoch
             epoch = cur_unix_ms
             logging.debug('video_scale serv dur_ms=%.1f' %(serv_lat))
-            # save the scaled video
-            with open(str(scaled_data_path), 'rb') as f:
-                scaled_video = f.read()
-                d.save_state(
-                    store_name=videoStore, 
-                    key=scaled_data_id, 
-                    value=scaled_video
-                )
+            renditionReq.inc(len(scaled))
+            profileCtl.record(profile, job['source_size'], result['encode_ms'])
+            profileReq.labels(profilectl.profileName(encoderLadder[profile])).inc()
+            encodeLat.labels(profilectl.profileName(encoderLadder[profile])).observe(result['encode_ms'])
+            # save the scaled videos
+            with daprPool.client() as d:
+                items = []
+                for i, r in enumerate(scaled):
+                    if scaleIO == 'pipe':
+                        scaled_video = result['outputs'][i]
+                    else:
+                        with open(str(r['scaled_data_path']), 'rb') as f:
+                            scaled_video = f.read()
+                    if chunkedStore:
+                        chunkstore.saveChunked(d, videoStore, r['scaled_data_id'], scaled_video,
+                            chunk_size=storeChunkSize)
+                    else:
+                        items.append(StateItem(
+                            key=r['scaled_data_id'],
+                            value=scaled_video,
+                        ))
+                if len(items) == 1:
+                    d.save_state(
+                        store_name=videoStore, 
+                        key=items[0].key, 
+                        value=items[0].value
+                    )
+                elif len(items) > 1:
+                    d.save_bulk_state(
+                        store_name=videoStore,
+                        states=items,
+                    )
+            saved = True
             # update latency metric
             cur_unix_ms = time.time() * 1000
             store_lat += cur_unix_ms - epoch
             epoch = cur_unix_ms
-        # remove temp files
-        if os.path.exists(str(video_path)):
-            os.remove(str(video_path))
-        if os.path.exists(str(scaled_data_path)):
-            os.remove(str(scaled_data_path))                        
-        # update prom metrics 
-        serv_lat += time.time() * 1000 - epoch
-        storeLat.observe(store_lat)
-        servLat.observe(serv_lat)
-        logging.debug('e2e lat = %.1fms' %(cur_unix_ms - send_unix_ms))
-        # logging.info('---------------------------------------')
-        e2eVideoScaleLat.observe(cur_unix_ms - send_unix_ms)
+    except Exception as e:
+        logging.error('Failed to save renditions of %s to %s: %s' %(
+            job['data_id'], videoStore, str(e)
+        ))
+    finally:
+        # remove temp files (and unpin the cached source)
+        srccache.releaseSource(srcCache, job['video_path'], job['src_pin'])
+        for r in scaled:
+            if os.path.exists(str(r['scaled_data_path'])):
+                os.remove(str(r['scaled_data_path']))
+        if job['chain_thumbnail'] is not None:
+            chainThumbnail(job, saved)
+        jobDone(job['ledger_key'], saved)
+        # the event of the job can be acked
+        job['done'].set_result(saved)
+    # update prom metrics
+    serv_lat += time.time() * 1000 - epoch
+    storeLat.observe(store_lat)
+    servLat.observe(serv_lat)
+    logging.debug('e2e lat = %.1fms' %(cur_unix_ms - send_unix_ms))
+    # logging.info('---------------------------------------')
+    e2eVideoScaleLat.observe(cur_unix_ms - send_unix_ms)
+
+# chainThumbnail publishes the thumbnail job deferred by video-frontend, which
+# reads the smallest rendition, or the native video if it could not be saved
+def chainThumbnail(job, saved: bool) -> None:
+    req = dict(job['chain_thumbnail'])
+    if saved:
+        req['data_id'] = min(job['scaled'], key=lambda r: r['width'])['scaled_data_id']
+    req['send_unix_ms'] = int(time.time()*1000)
+    try:
+        with daprPool.client() as d:
+            d.publish_event(
+                pubsub_name=pubsubName,
+                topic_name=thumbnailTopic,
+                data=json.dumps(req),
+                data_content_type='application/json',
+            )
+        chainReq.inc()
+    except Exception as e:
+        logging.error('Failed to publish thumbnail job of %s: %s' %(req['video_id'], str(e)))
+
+# the pool calls back on its result thread, which must not block
+def encodeDone(job, result) -> None:
+    completionExecutor.submit(finishScaleJob, job, result)
+
+def encodeFailed(job, e) -> None:
+    completionExecutor.submit(finishScaleJob, job, {
+        'succ': False,
+        'error': str(e),
+    })
+
+# scaleJob prepares an admitted job and dispatches its encode, without
+# waiting for the encode in file mode
+def scaleJob(data, done: futures.Future) -> None:
+    try:
+        job = prepareScaleJob(data)
+    except Exception as e:
+        logging.error('Failed to prepare scale job of %s: %s' %(data['data_id'], str(e)))
+        job = None
+    if job is None:
+        # the deferred thumbnail falls back to the native video
+        if data.get('chain_thumbnail', None) is not None:
+            chainThumbnail({'chain_thumbnail': data['chain_thumbnail']}, saved=False)
+        jobDone(ledgerKey(data))
+        done.set_result(False)
+        return
+    job['done'] = done
+    try:
+        if scaleIO == 'pipe':
+            # ffmpeg runs from this thread, outputs are read from pipes
+            submit_unix_ms = time.time()*1000
+            with pipeSlots:
+                if job['video'] is not None:
+                    result = worker.pipeProcessor(job['data_id'], job['work']['renditions'],
+                        video=job['video'], preset=job['work']['preset'], crf=job['work']['crf'],
+                        submit_unix_ms=submit_unix_ms)
+                else:
+                    result = worker.pipeProcessor(job['data_id'], job['work']['renditions'],
+                        video_path=job['video_path'], preset=job['work']['preset'], crf=job['work']['crf'],
+                        submit_unix_ms=submit_unix_ms)
+            # release the source bytes before the renditions are saved
+            job['video'] = None
+        else:
+            worker.poolMetrics.submitted(job['work'])
+            workerPool.apply_async(videoProcessor, (job['work'],),
+                callback=partial(encodeDone, job),
+                error_callback=partial(encodeFailed, job))
+            return
+    except Exception as e:
+        result = {
+            'succ': False,
+            'error': str(e),
+        }
+    finishScaleJob(job, result)
+
+# admission bounds the jobs accepted but not finished (queued for an encoder
+# or encoding). Jobs are admitted one at a time, each
+# waiting up to timeout_s for a slot, so batches larger than the queue get in
+# as their first jobs finish.
+def admit(timeout_s: float) -> bool:
+    if not admission.acquire(timeout=timeout_s):
+        return False
+    profileCtl.begin()
+    return True
+
+# jobDone frees the slot of a job, and records its outcome in the ledger
+# when it was claimed there
+def jobDone(ledger_key: str = None, ok: bool = False) -> None:
+    if jobLedger is not None and ledger_key is not None:
+        if ok:
+            jobLedger.done(ledger_key)
+        else:
+            jobLedger.release(ledger_key)
+    profileCtl.end()
+    admission.release()
+
+# a batched event carries several jobs, processed as if they had been
+# delivered as separate events. The event is acked once its jobs are done,
+# so the jobs of a pod that dies are redelivered (at-least-once).
+@app.subscribe(pubsub_name=pubsubName, topic=topicName)
+def scaleVideo(event) -> TopicEventResponse:
+    data = json.loads(event.Data())
+    jobs = pubbatch.unpackJobs(data)
+    status = 'success'
+    running = []
+    for job in jobs:
+        if not admit(admitTimeoutMs / 1000):
+            # the jobs admitted so far still run, the ledger skips them when
+            # the event is redelivered
+            rejectReq.inc()
+            status = 'retry'
+            break
+        claim = jobledger.CLAIMED
+        if jobLedger is not None:
+            claim = jobLedger.claim(ledgerKey(job))
+        if claim == jobledger.DONE:
+            # redelivered after it completed
+            skipReq.inc()
+            jobDone()
+        elif claim == jobledger.BUSY:
+            # still running elsewhere, check again on redelivery
+            busyReq.inc()
+            jobDone()
+            status = 'retry'
+        else:
+            done = futures.Future()
+            intakeExecutor.submit(scaleJob, job, done)
+            running.append(done)
+    futures.wait(running)
+    return TopicEventResponse(status)
 
 if __name__ == '__main__':
-    # worker pool
-    workerPool = get_context("spawn").Pool(processes=numWorkers)
-    # start prometheus
-    prometheus_client.start_http_server(promAddress)
+    # worker pool (pipe mode runs ffmpeg from the handler threads)
+    poolWorkers.set(numWorkers)
+    if scaleIO == 'file':
+        workerPool, startup_ms, worker_rss = workerpool.startPool(worker, numWorkers)
+        poolStartup.set(startup_ms)
+        poolWorkerRss.set(worker_rss)
+        logging.info('%d pool workers ready in %.1f ms, rss %.1f MB per worker' %(
+            numWorkers, startup_ms, worker_rss / (1024 * 1024)))
+    # start prometheus (with the metrics written by the pool workers)
+    poolmetrics.serveMetrics(promAddress, worker.poolMetrics)
     # start the service
     app.run(serviceAddress)
\ No newline at end of file
@@ -0,0 +1,184 @@
+# Jobs run by the spawn-context worker pool of video-scale. Workers run this
+# module instead of server.py (see pyutil/workerpool.py), so it only imports
+# what the jobs need. pipeProcessor runs in the server process itself.
+import os
+import time
+import subprocess
+from threading import Thread
+# ffmpeg
+import ffmpeg
+# metrics
+from pyutil import poolmetrics
+
+poolMetrics = poolmetrics.PoolMetrics('video_scale')
+
+# fragmented mp4 needs no seek back to write the moov atom, so it can be
+# written to a pipe
+pipeOutputArgs = {
+    'format': 'mp4',
+    'movflags': 'frag_keyframe+empty_moov',
+}
+
+# scaleGraph builds the ffmpeg graph scaling source into every rendition;
+# several renditions share a single decode through a split filter
+def scaleGraph(source, renditions: list, targets: list, preset: str = 'slow', crf: int = 18,
+        **output_args):
+    if len(renditions) == 1:
+        streams = [source]
+    else:
+        split = source.filter_multi_output('split', len(renditions))
+        streams = [split[i] for i in range(len(renditions))]
+    outputs = []
+    for i, r in enumerate(renditions):
+        outputs.append(
+            streams[i]
+            .filter('scale', r['width'], r['height'])
+            .output(targets[i], preset=preset, crf=crf, **output_args)
+        )
+    return ffmpeg.merge_outputs(*outputs).overwrite_output()
+
+# worker function
+# a job scales one source into one or more renditions in one ffmpeg graph
+def videoProcessor(req):
+    t = time.time() * 1000
+    token = poolMetrics.begin(req.get('submit_unix_ms'))
+    # logging.info('At %d videoProcessor receives work: %s' %(t, req['data_id']))
+    data_id = req['data_id']
+    video_path = req['video_path']
+    renditions = req['renditions']
+
+    resp = {
+        'succ': False,
+        'error': '',
+        'encode_ms': 0,
+    }
+    # rescale the video to certain resolutins #
+    try:
+        (
+            scaleGraph(
+                ffmpeg.input(str(video_path)),
+                renditions,
+                [str(r['scaled_data_path']) for r in renditions],
+                preset=req.get('preset', 'slow'),
+                crf=req.get('crf', 18),
+            )
+            # .run_async(pipe_stdout=True, pipe_stderr=True)
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+        resp['succ'] = True
+        resp['encode_ms'] = time.time()*1000 - t
+    except ffmpeg.Error as e:
+        out = e.stdout.decode()
+        err = e.stderr.decode()
+        resp['error'] = 'FFmpeg (data_id: %s) std_err: %s, std_out: %s' %(
+            data_id, err, out)
+    output_bytes = None
+    if resp['succ']:
+        output_bytes = sum([poolmetrics.fileSize(r['scaled_data_path']) for r in renditions])
+    poolMetrics.end(token, poolmetrics.fileSize(video_path), output_bytes)
+    # logging.info('videoProcessor completes work %d: %s' %(t, req['data_id']))
+    return resp
+
+# pipeable tells if a source can be demuxed from a non-seekable pipe:
+# mp4/mov needs its moov atom before the media data
+def pipeable(data) -> bool:
+    view = memoryview(data)
+    if len(view) < 8 or bytes(view[4:8]) != b'ftyp':
+        return True
+    pos = 0
+    while pos + 8 <= len(view):
+        size = int.from_bytes(view[pos:pos+4], 'big')
+        box = bytes(view[pos+4:pos+8])
+        if box == b'moov':
+            return True
+        if box == b'mdat':
+            return False
+        if size == 1:
+            # 64-bit box size
+            if pos + 16 > len(view):
+                return False
+            size = int.from_bytes(view[pos+8:pos+16], 'big')
+        if size < 8:
+            return False
+        pos += size
+    return False
+
+# pipeProcessor scales video (bytes fed through stdin) or video_path into the
+# renditions, each one read back from its own pipe as fragmented mp4
+# (submit_unix_ms is when the job started waiting for a pipe slot)
+def pipeProcessor(data_id: str, renditions: list, video: bytes = None, video_path=None,
+        preset: str = 'slow', crf: int = 18, submit_unix_ms: float = None):
+    t = time.time() * 1000
+    token = poolMetrics.begin(submit_unix_ms)
+    resp = {
+        'succ': False,
+        'error': '',
+        'outputs': [],
+        'encode_ms': 0,
+    }
+    # the write ends are ffmpeg's once it started, the read ends ours unless it failed to
+    pipes = []
+    try:
+        for _ in renditions:
+            pipes.append(os.pipe())
+        if video is not None:
+            source = ffmpeg.input('pipe:0')
+        else:
+            source = ffmpeg.input(str(video_path))
+        args = ffmpeg.compile(scaleGraph(
+            source,
+            renditions,
+            ['pipe:%d' %w for _, w in pipes],
+            preset=preset,
+            crf=crf,
+            **pipeOutputArgs,
+        ))
+        p = subprocess.Popen(args,
+            stdin=subprocess.PIPE if video is not None else subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            pass_fds=[w for _, w in pipes],
+        )
+    except Exception as e:
+        for r, _ in pipes:
+            os.close(r)
+        poolMetrics.end(token, len(video) if video is not None else poolmetrics.fileSize(video_path))
+        resp['error'] = 'Failed to start ffmpeg (data_id: %s): %s' %(data_id, str(e))
+        return resp
+    finally:
+        for _, w in pipes:
+            os.close(w)
+    outputs = [b''] * len(pipes)
+    def drain(i, r):
+        with open(r, 'rb') as f:
+            outputs[i] = f.read()
+    def feed():
+        try:
+            p.stdin.write(video)
+        except BrokenPipeError:
+            # ffmpeg exited early, the error is in stderr
+            pass
+        finally:
+            p.stdin.close()
+    threads = [Thread(target=drain, args=(i, r)) for i, (r, _) in enumerate(pipes)]
+    if video is not None:
+        threads.append(Thread(target=feed))
+    for th in threads:
+        th.start()
+    err = p.stderr.read()
+    # reap ffmpeg with its own rusage, other jobs run ffmpeg from this process too
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    for th in threads:
+        th.join()
+    input_bytes = len(video) if video is not None else poolmetrics.fileSize(video_path)
+    cpu_s = usage.ru_utime + usage.ru_stime
+    if p.returncode != 0:
+        poolMetrics.end(token, input_bytes, cpu_s=cpu_s)
+        resp['error'] = 'FFmpeg (data_id: %s) std_err: %s' %(data_id, err.decode())
+        return resp
+    poolMetrics.end(token, input_bytes, sum([len(o) for o in outputs]), cpu_s=cpu_s)
+    resp['outputs'] = outputs
+    resp['succ'] = True
+    resp['encode_ms'] = time.time()*1000 - t
+    return resp
@@ -6,14 +6,16 @@ import time
 import random
 from pathlib import Path
 from concurrent import futures
-from threading import Lock
+from functools import partial
+from threading import Lock, BoundedSemaphore
 # worker pool
-from multiprocessing import Pool, get_context
+import worker
+from worker import videoProcessor
 # dapr
 from dapr.clients import DaprClient
 from dapr.ext.grpc import App
-# ffmpeg
-import ffmpeg
+from dapr.clients.grpc._response import TopicEventResponse
+from dapr.clients.grpc._state import StateItem
 # prometheus
 import prometheus_client
 import warnings
@@ -23,16 +25,44 @@ from pathlib import Path
 util_path = Path(__file__).parent.resolve() / '..' / 'pyutil'
 sys.path.append(str(util_path))
 import pyutil
+from pyutil import daprpool
+from pyutil import workerpool
+from pyutil import poolmetrics
+from pyutil import pubbatch
+from pyutil import chunkstore
+from pyutil import srccache
+from pyutil import jobledger
 
 warnings.filterwarnings("ignore")
 # global variables
 serviceAddress = int(os.getenv('ADDRESS', '5005'))
 promAddress = int(os.getenv('PROM_ADDRESS', '8084'))
+daprPoolSize = int(os.getenv('DAPR_POOL_SIZE', '20'))
 pubsubName = os.getenv('PUBSUB_NAME', 'video-pubsub')
 topicName = os.getenv('TOPIC_NAME', 'thumbnail')
 videoStore = os.getenv('VIDEO_STORE', 'video-store')
 thumbnailStore = os.getenv('THUMBNAIL_STORE', 'thumbnail-store')
 numWorkers = int(os.getenv('WORKERS', '10'))
+# extra thumbnail widths and sprite sheet frames produced by the same job
+# (empty/0 only extract the native size thumbnail)
+thumbnailSizes = [int(w) for w in os.getenv('THUMBNAIL_SIZES', '').split(',') if w.strip() != '']
+spriteFrames = int(os.getenv('SPRITE_FRAMES', '0'))
+spriteWidth = int(os.getenv('SPRITE_WIDTH', '160'))
+spriteCols = int(os.getenv('SPRITE_COLS', str(max(spriteFrames, 1))))
+# state store of the job ledger skipping redelivered jobs (empty disables it)
+ledgerStore = os.getenv('LEDGER_STORE', '')
+ledgerClaimTtl = int(os.getenv('LEDGER_CLAIM_TTL', '600'))
+ledgerDoneTtl = int(os.getenv('LEDGER_DONE_TTL', '86400'))
+# jobs accepted but not finished; a job waits up to ADMIT_TIMEOUT_MS for a
+# slot, beyond that its event is sent back for retry
+queueSize = int(os.getenv('QUEUE_SIZE', str(2 * numWorkers)))
+admitTimeoutMs = float(os.getenv('ADMIT_TIMEOUT_MS', '10000'))
+# handler threads, more than QUEUE_SIZE: a handler holds on until the jobs of its
+# event are done, the ones beyond the admitted jobs send events back for retry
+handlerThreads = max(int(os.getenv('HANDLER_THREADS', str(queueSize + 10))), queueSize + 1)
+# node-local cache of source videos shared with the other video workers (empty disables it)
+srcCacheDir = os.getenv('SRC_CACHE_DIR', '')
+srcCacheMB = int(os.getenv('SRC_CACHE_MB', '2048'))
 logLevel    = os.getenv('LOG_LEVEL', 'info')
 if logLevel == 'debug':
     logging.basicConfig(level=logging.DEBUG)
@@ -54,58 +84,80 @@ storeLat = prometheus_client.Histogram(
     'Latency (ms) histogram of reading & writing video store (kvs/db) for video_thumbnail requests',
     buckets=pyutil.latBuckets()
 )
+skipReq = prometheus_client.Counter(
+    'video_thumbnail_skipped_total', 
+    'Number of redelivered video-thumbnail jobs acknowledged without processing them (already done)')
+busyReq = prometheus_client.Counter(
+    'video_thumbnail_busy_total', 
+    'Number of redelivered video-thumbnail jobs sent back for retry because they are still running')
+rejectReq = prometheus_client.Counter(
+    'video_thumbnail_rejected_total', 
+    'Number of video-thumbnail events sent back for retry because the job queue was full')
+queueDepth = prometheus_client.Gauge(
+    'video_thumbnail_admitted_jobs',
+    'Number of video-thumbnail jobs accepted and not finished yet')
 e2eVideoThumbnailLat = prometheus_client.Histogram(
     'e2e_video_thumbnail_lat_hist',
     'End-to-end latency (ms) histogram of video-thumbnail.',
     buckets=pyutil.latBucketsFFmpegThumb()
 )
 
+# worker pool startup
+poolStartup = prometheus_client.Gauge(
+    'video_thumbnail_pool_startup_ms',
+    'Time (ms) taken by the worker pool to start all of its workers')
+poolWorkerRss = prometheus_client.Gauge(
+    'video_thumbnail_pool_worker_rss_bytes',
+    'Mean peak rss (bytes) of the pool workers once started')
+poolWorkers = prometheus_client.Gauge(
+    'video_thumbnail_pool_workers',
+    'Number of pool workers, i.e. jobs running ffmpeg at once')
+
 # folders to hold videos
 dataDir = Path('/tmp') / 'video'
 os.makedirs(str(dataDir), exist_ok=True)
-# worker function
-def videoProcessor(req):
-    data_id = req['data_id']
-    duration = req['duration']
-    video_path = req['video_path']
-    thumbnail_path = req['thumbnail_path']
-
-    resp = {
-        'succ': False,
-        'error': '',
-    }
-    # generate thumbnail #
-    ss = min(0.1, duration/10)
-    try:
-        (
-            ffmpeg
-            .input(str(video_path), ss=ss)
-            .output(str(thumbnail_path), vframes=1, format='image2', vcodec='mjpeg')
-            .overwrite_output()
-            .run(quiet=True)
-            # .run(capture_stdout=True)
-        )     
-        resp['succ'] = True  
-    except ffmpeg.Error as e:
-        out = e.stdout.decode()
-        err = e.stderr.decode()
-        resp['error'] = 'FFmpeg (data_id: %s) std_err: %s, std_out: %s' %(
-            data_id, err, out)
-    return resp
+srcCache = None
+if srcCacheDir != '':
+    srcCache = srccache.SourceCache(
+        name='video_thumbnail',
+        root=srcCacheDir,
+        max_bytes=srcCacheMB * 1024 * 1024,
+    )
 # worker pool
 workerPool = None
 
 # server 
 MAX_PAYLOAD = 64 * 1024 * 1024 # 64MB
 # MAX_PAYLOAD=-1
-executor = futures.ThreadPoolExecutor(max_workers=20)
+# warm dapr clients shared by all handlers of this process
+daprPool = daprpool.DaprClientPool(
+    name='video_thumbnail',
+    max_size=daprPoolSize,
+    max_grpc_message_length=MAX_PAYLOAD,
+)
+executor = futures.ThreadPoolExecutor(max_workers=handlerThreads)
+# threads reading sources and dispatching the jobs admitted
+intakeExecutor = futures.ThreadPoolExecutor(max_workers=numWorkers)
+# threads saving the thumbnails of finished jobs
+completionExecutor = futures.ThreadPoolExecutor(max_workers=numWorkers)
+admission = BoundedSemaphore(queueSize)
+jobLedger = None
+if ledgerStore != '':
+    jobLedger = jobledger.JobLedger(
+        dapr_pool=daprPool,
+        store_name=ledgerStore,
+        claim_ttl_s=ledgerClaimTtl,
+        done_ttl_s=ledgerDoneTtl,
+    )
 grpcOptions = [
     ('grpc.max_send_message_length', MAX_PAYLOAD),
     ('grpc.max_receive_message_length', MAX_PAYLOAD),
 ]
+# events beyond the handler threads are refused rather than queued in grpc
 app = App(
     thread_pool=executor, 
     options=grpcOptions,
+    maximum_concurrent_rpcs=handlerThreads,
 )
 
 reqCtr = 0
@@ -119,16 +171,26 @@ def getCtr():
         reqCtr += 1
     return ctr
 
+# keys of the extra outputs, derived from pyutil.thumbnailId
+def thumbnailSizeId(thumbnail_id: str, width: int) -> str:
+    return '%s-w%d' %(thumbnail_id, width)
+
+def spriteId(thumbnail_id: str) -> str:
+    return '%s-sprite' %thumbnail_id
+
+# ledgerKey identifies a thumbnail job by its source
+def ledgerKey(data) -> str:
+    return 'thumbnail||%s' %data['data_id']
+
 # handlers
-# @app.method(name='object_detect')
-@app.subscribe(pubsub_name=pubsubName, topic=topicName)
-def videoThumbnail(event) -> None:
+# a job runs in two phases: prepareThumbnailJob (on an intake thread) reads
+# the source, then the ffmpeg job is dispatched to the pool and
+# finishThumbnailJob (on a completion thread) saves the thumbnail
+def prepareThumbnailJob(data):
     global promReq
     global servLat
-    global workerPool
     # update req counter
     promReq.inc()
-    data = json.loads(event.Data())
     video_id = data['video_id']
     data_id = data['data_id']
     duration = data['duration']
@@ -143,19 +205,35 @@ def videoThumbnail(event) -> None:
     video_path = dataDir / ('%s-%d' %(data_id, unique_id))
     thumbnail_id = pyutil.thumbnailId(video_id)
     thumbnail_path = dataDir / ('%d-%s' %(unique_id, thumbnail_id))
-    with DaprClient(max_grpc_message_length=MAX_PAYLOAD) as d:
+    # (key, temp file) of every output
+    outputs = [(thumbnail_id, thumbnail_path)]
+    sizes = []
+    for w in thumbnailSizes:
+        size_id = thumbnailSizeId(thumbnail_id, w)
+        sizes.append((w, dataDir / ('%d-%s' %(unique_id, size_id))))
+        outputs.append((size_id, sizes[-1][1]))
+    sprite = None
+    if spriteFrames > 0:
+        sprite = {
+            'frames': spriteFrames,
+            'cols': spriteCols,
+            'width': spriteWidth,
+            'path': dataDir / ('%d-%s' %(unique_id, spriteId(thumbnail_id))),
+        }
+        outputs.append((spriteId(thumbnail_id), sprite['path']))
+    with daprPool.client() as d:
         try:
             logging.debug('%s -> %s' %(data_id, thumbnail_id))
             logging.debug('%s -> %s' %(str(video_path), str(thumbnail_path)))
-            video = d.get_state(
-                store_name=videoStore, 
-                key=data_id).data
+            # the source comes from the node-local cache when enabled
+            video_path, src_pin = srccache.localSource(srcCache, data_id,
+                partial(chunkstore.readAll, d, videoStore, data_id), video_path)
             # update prom metrics
             cur_unix_ms = time.time()*1000
             store_lat += cur_unix_ms - epoch
             epoch = cur_unix_ms
             # return if video does not exist
-            if len(video) == 0:
+            if video_path is None:
                 logging.error('Cannot find video: %s in %s, or video is empty' %(
                     data_id, videoStore))
                 # update prom metrics 
@@ -163,24 +241,42 @@ def videoThumbnail(event) -> None:
                 storeLat.observe(store_lat)
                 servLat.observe(serv_lat)
                 e2eVideoThumbnailLat.observe(cur_unix_ms - send_unix_ms)
-                return
-            # write video to a file
-            with open(str(video_path), 'wb+') as f:
-                f.write(video)
+                return None
         except Exception as e:
             logging.error('Failed to read %s from %s: %s' %(
                 data_id, videoStore, str(e)
             ))
-            return
-        # dispatch to worker pool
-        work = {
-            'data_id': data_id,
-            'duration': duration,
-            'video_path': video_path,
-            'thumbnail_path': thumbnail_path,
-        }
-        fresult = workerPool.apply_async(videoProcessor, (work,))
-        result = fresult.get()
+            return None
+    work = {
+        'data_id': data_id,
+        'duration': duration,
+        'video_path': video_path,
+        'thumbnail_path': thumbnail_path,
+        'sizes': sizes,
+        'sprite': sprite,
+    }
+    return {
+        'send_unix_ms': send_unix_ms,
+        'epoch': epoch,
+        'serv_lat': serv_lat,
+        'store_lat': store_lat,
+        'video_path': video_path,
+        'src_pin': src_pin,
+        'thumbnail_id': thumbnail_id,
+        'outputs': outputs,
+        'ledger_key': ledgerKey(data),
+        'work': work,
+    }
+
+def finishThumbnailJob(job, result) -> None:
+    global servLat
+    epoch = job['epoch']
+    serv_lat = job['serv_lat']
+    store_lat = job['store_lat']
+    send_unix_ms = job['send_unix_ms']
+    cur_unix_ms = time.time()*1000
+    saved = False
+    try:
         if not result['succ']:
             logging.error('FFmpeg error: %s' %result['error'])
         else:
@@ -188,37 +284,150 @@ def videoThumbnail(event) -> None:
             serv_lat += cur_unix_ms - epoch
             epoch = cur_unix_ms
             logging.debug('video_thumbnail serv dur_ms=%.1f' %(serv_lat))
-            # save the scaled video
-            with open(str(thumbnail_path), 'rb') as f:
-                thumbnail = f.read()
-                # logging.info('size of thumbnail=%d' %len(thumbnail))
-                resp = d.save_state(
-                    store_name=thumbnailStore, 
-                    key=thumbnail_id, 
-                    value=thumbnail
-                )
+            # save the thumbnails (and sprite) in one write
+            items = []
+            for key, path in job['outputs']:
+                with open(str(path), 'rb') as f:
+                    items.append(StateItem(key=key, value=f.read()))
+            # logging.info('size of thumbnail=%d' %len(items[0].value))
+            with daprPool.client() as d:
+                if len(items) == 1:
+                    resp = d.save_state(
+                        store_name=thumbnailStore, 
+                        key=items[0].key, 
+                        value=items[0].value
+                    )
+                else:
+                    d.save_bulk_state(
+                        store_name=thumbnailStore,
+                        states=items,
+                    )
                 # logging.info(resp.headers)
+            saved = True
             # update latency metric
             cur_unix_ms = time.time() * 1000
             store_lat += cur_unix_ms - epoch
             epoch = cur_unix_ms
-        # remove temp files
-        if os.path.exists(str(video_path)):
-            os.remove(str(video_path))
-        if os.path.exists(str(thumbnail_path)):
-            os.remove(str(thumbnail_path))                        
-        # update prom metrics 
-        serv_lat += time.time() * 1000 - epoch
-        storeLat.observe(store_lat)
-        servLat.observe(serv_lat)
-        logging.debug('e2e lat = %.1fms' %(cur_unix_ms - send_unix_ms))
-        # logging.info('---------------------------------------')
-        e2eVideoThumbnailLat.observe(cur_unix_ms - send_unix_ms)
+    except Exception as e:
+        logging.error('Failed to save %s to %s: %s' %(
+            job['thumbnail_id'], thumbnailStore, str(e)
+        ))
+    finally:
+        # remove temp files (and unpin the cached source)
+        srccache.releaseSource(srcCache, job['video_path'], job['src_pin'])
+        for _, path in job['outputs']:
+            if os.path.exists(str(path)):
+                os.remove(str(path))
+        jobDone(job['ledger_key'], saved)
+        # the event of the job can be acked
+        job['done'].set_result(saved)
+    # update prom metrics 
+    serv_lat += time.time() * 1000 - epoch
+    storeLat.observe(store_lat)
+    servLat.observe(serv_lat)
+    logging.debug('e2e lat = %.1fms' %(cur_unix_ms - send_unix_ms))
+    # logging.info('---------------------------------------')
+    e2eVideoThumbnailLat.observe(cur_unix_ms - send_unix_ms)
+
+# the pool calls back on its result thread, which must not block
+def thumbnailDone(job, result) -> None:
+    completionExecutor.submit(finishThumbnailJob, job, result)
+
+def thumbnailFailed(job, e) -> None:
+    completionExecutor.submit(finishThumbnailJob, job, {
+        'succ': False,
+        'error': str(e),
+    })
+
+# thumbnailJob prepares an admitted job and dispatches it to the worker pool
+# without waiting for it
+def thumbnailJob(data, done: futures.Future) -> None:
+    try:
+        job = prepareThumbnailJob(data)
+    except Exception as e:
+        logging.error('Failed to prepare thumbnail job of %s: %s' %(data['data_id'], str(e)))
+        job = None
+    if job is None:
+        jobDone(ledgerKey(data))
+        done.set_result(False)
+        return
+    job['done'] = done
+    try:
+        worker.poolMetrics.submitted(job['work'])
+        workerPool.apply_async(videoProcessor, (job['work'],),
+            callback=partial(thumbnailDone, job),
+            error_callback=partial(thumbnailFailed, job))
+    except Exception as e:
+        finishThumbnailJob(job, {
+            'succ': False,
+            'error': str(e),
+        })
+
+# admission bounds the jobs accepted but not finished (queued for a worker
+# or running). Jobs are admitted one at a time, each
+# waiting up to timeout_s for a slot, so batches larger than the queue get in
+# as their first jobs finish.
+def admit(timeout_s: float) -> bool:
+    if not admission.acquire(timeout=timeout_s):
+        return False
+    queueDepth.inc()
+    return True
+
+# jobDone frees the slot of a job, and records its outcome in the ledger
+# when it was claimed there
+def jobDone(ledger_key: str = None, ok: bool = False) -> None:
+    if jobLedger is not None and ledger_key is not None:
+        if ok:
+            jobLedger.done(ledger_key)
+        else:
+            jobLedger.release(ledger_key)
+    queueDepth.dec()
+    admission.release()
+
+# a batched event carries several jobs, processed as if they had been
+# delivered as separate events. The event is acked once its jobs are done,
+# so the jobs of a pod that dies are redelivered (at-least-once).
+@app.subscribe(pubsub_name=pubsubName, topic=topicName)
+def videoThumbnail(event) -> TopicEventResponse:
+    data = json.loads(event.Data())
+    jobs = pubbatch.unpackJobs(data)
+    status = 'success'
+    running = []
+    for job in jobs:
+        if not admit(admitTimeoutMs / 1000):
+            # the jobs admitted so far still run, the ledger skips them when
+            # the event is redelivered
+            rejectReq.inc()
+            status = 'retry'
+            break
+        claim = jobledger.CLAIMED
+        if jobLedger is not None:
+            claim = jobLedger.claim(ledgerKey(job))
+        if claim == jobledger.DONE:
+            # redelivered after it completed
+            skipReq.inc()
+            jobDone()
+        elif claim == jobledger.BUSY:
+            # still running elsewhere, check again on redelivery
+            busyReq.inc()
+            jobDone()
+            status = 'retry'
+        else:
+            done = futures.Future()
+            intakeExecutor.submit(thumbnailJob, job, done)
+            running.append(done)
+    futures.wait(running)
+    return TopicEventResponse(status)
 
 if __name__ == '__main__':
     # worker pool
-    workerPool = get_context("spawn").Pool(processes=numWorkers)
-    # start prometheus
-    prometheus_client.start_http_server(promAddress)
+    workerPool, startup_ms, worker_rss = workerpool.startPool(worker, numWorkers)
+    poolStartup.set(startup_ms)
+    poolWorkerRss.set(worker_rss)
+    poolWorkers.set(numWorkers)
+    logging.info('%d pool workers ready in %.1f ms, rss %.1f MB per worker' %(
+        numWorkers, startup_ms, worker_rss / (1024 * 1024)))
+    # start prometheus (with the metrics written by the pool workers)
+    poolmetrics.serveMetrics(promAddress, worker.poolMetrics)
     # start the service
     app.run(serviceAddress)
\ No newline at end of file
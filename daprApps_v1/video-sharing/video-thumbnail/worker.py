@@ -0,0 +1,76 @@
+# Jobs run by the spawn-context worker pool of video-thumbnail. Workers run this
+# module instead of server.py (see pyutil/workerpool.py), so it only imports
+# what the jobs need.
+# ffmpeg
+import ffmpeg
+# metrics
+from pyutil import poolmetrics
+
+poolMetrics = poolmetrics.PoolMetrics('video_thumbnail')
+
+# worker function
+# a job extracts the thumbnail frame and, optionally, extra sizes of it and a
+# sprite sheet of frames spread over the video, all from one input open
+def videoProcessor(req):
+    data_id = req['data_id']
+    duration = req['duration']
+    video_path = req['video_path']
+    thumbnail_path = req['thumbnail_path']
+    sizes = req.get('sizes', [])
+    sprite = req.get('sprite', None)
+
+    resp = {
+        'succ': False,
+        'error': '',
+    }
+    token = poolMetrics.begin(req.get('submit_unix_ms'))
+    # generate thumbnail #
+    ss = min(0.1, duration/10)
+    try:
+        source = ffmpeg.input(str(video_path), ss=ss)
+        if len(sizes) == 0 and sprite is None:
+            (
+                source
+                .output(str(thumbnail_path), vframes=1, format='image2', vcodec='mjpeg')
+                .overwrite_output()
+                .run(quiet=True)
+                # .run(capture_stdout=True)
+            )
+        else:
+            num = 1 + len(sizes) + (1 if sprite is not None else 0)
+            split = source.video.filter_multi_output('split', num)
+            outputs = [
+                split[0].output(str(thumbnail_path), vframes=1, format='image2', vcodec='mjpeg'),
+            ]
+            for i, (width, path) in enumerate(sizes):
+                outputs.append(
+                    split[i+1]
+                    .filter('scale', width, -2)
+                    .output(str(path), vframes=1, format='image2', vcodec='mjpeg')
+                )
+            if sprite is not None:
+                # sample the frames evenly over the rest of the video and tile them
+                fps = sprite['frames'] / max(duration - ss, 0.1)
+                rows = (sprite['frames'] + sprite['cols'] - 1) // sprite['cols']
+                outputs.append(
+                    split[num-1]
+                    .filter('fps', fps=fps)
+                    .filter('scale', sprite['width'], -2)
+                    .filter('tile', '%dx%d' %(sprite['cols'], rows))
+                    .output(str(sprite['path']), vframes=1, format='image2', vcodec='mjpeg')
+                )
+            ffmpeg.merge_outputs(*outputs).overwrite_output().run(quiet=True)
+        resp['succ'] = True  
+    except ffmpeg.Error as e:
+        out = e.stdout.decode()
+        err = e.stderr.decode()
+        resp['error'] = 'FFmpeg (data_id: %s) std_err: %s, std_out: %s' %(
+            data_id, err, out)
+    output_bytes = None
+    if resp['succ']:
+        paths = [thumbnail_path] + [path for _, path in sizes]
+        if sprite is not None:
+            paths.append(sprite['path'])
+        output_bytes = sum([poolmetrics.fileSize(path) for path in paths])
+    poolMetrics.end(token, poolmetrics.fileSize(video_path), output_bytes)
+    return resp